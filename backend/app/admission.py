@@ -0,0 +1,217 @@
+import asyncio
+import contextvars
+import math
+import time
+from collections import Counter, deque
+from typing import Dict, List
+
+from starlette.responses import JSONResponse
+
+SEARCH = "search"
+INGEST = "ingest"
+
+# slot held by the request being served, see `AdmissionMiddleware`
+_current_slot = contextvars.ContextVar("admission_slot", default=None)
+
+
+class Rejected(Exception):
+
+    def __init__(self, lane: str, reason: str, retry_after: int) -> None:
+        super().__init__(f"{lane} request rejected ({reason})")
+        self.lane = lane
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Lane():
+    """
+    One class of requests: at most `max_concurrency` run at once, at most
+    `max_queue` wait for a slot, and none waits longer than `max_queue_time`.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int,
+                 max_queue_time: float) -> None:
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_time = max_queue_time
+
+        self.active = 0
+        self.waiters = deque()
+        # moving average of how long an admitted request holds its slot
+        self.service_time = 0.0
+
+        self.admitted = 0
+        self.rejected = Counter()
+        self.queue_times = deque(maxlen=1000)
+
+    def expected_wait(self) -> float:
+        """Rough wait of a request joining the queue now (Little's law)"""
+        return (len(self.waiters) + 1) * self.service_time / self.max_concurrency
+
+    def record_service(self, seconds: float, alpha: float = 0.2) -> None:
+        self.service_time = seconds if self.service_time == 0.0 \
+            else (1 - alpha) * self.service_time + alpha * seconds
+
+    def stats(self) -> Dict:
+        queue_times = sorted(self.queue_times)
+        return {"active": self.active,
+                "queued": len(self.waiters),
+                "max_concurrency": self.max_concurrency,
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "queue_time_avg": sum(queue_times) / len(queue_times) if queue_times else 0.0,
+                "queue_time_p95": queue_times[int(0.95 * (len(queue_times) - 1))]
+                if queue_times else 0.0,
+                "queue_time_max": queue_times[-1] if queue_times else 0.0,
+                "service_time": self.service_time}
+
+
+class AdmissionController():
+    """
+    Admit requests lane by lane, shedding load early instead of letting
+    every request slow down:
+
+    - a request is rejected at once when its lane's queue is full, or when
+      the expected wait is already over the lane's queue-time budget;
+    - a queued request is rejected when the budget runs out;
+    - lanes after the first of `lanes` (the priority lane) are not admitted
+      while requests of the priority lane are queued, so searches go first
+      and ingests yield the CPU to them.
+    """
+
+    def __init__(self, lanes: List[Lane]) -> None:
+        self.lanes = {lane.name: lane for lane in lanes}
+        self.priority = lanes[0]
+
+    def _can_start(self, lane: Lane) -> bool:
+        if lane.active >= lane.max_concurrency:
+            return False
+        return lane is self.priority or not self.priority.waiters
+
+    def _reject(self, lane: Lane, reason: str) -> Rejected:
+        lane.rejected[reason] += 1
+        retry_after = max(1, math.ceil(min(lane.expected_wait(), lane.max_queue_time)))
+        return Rejected(lane.name, reason, retry_after)
+
+    def _dispatch(self) -> None:
+        for lane in self.lanes.values():
+            while lane.waiters and self._can_start(lane):
+                waiter = lane.waiters.popleft()
+                if waiter.done():
+                    continue
+                lane.active += 1
+                waiter.set_result(None)
+
+    def _leave_queue(self, lane: Lane, waiter: asyncio.Future) -> None:
+        waiter.cancel()
+        lane.waiters.remove(waiter)
+        # an emptier priority queue may let other lanes in
+        self._dispatch()
+
+    async def acquire(self, name: str) -> float:
+        """Wait for a slot of lane `name`, returns the time queued or raises `Rejected`"""
+        lane = self.lanes[name]
+        if not lane.waiters and self._can_start(lane):
+            lane.active += 1
+            lane.admitted += 1
+            lane.queue_times.append(0.0)
+            return 0.0
+
+        if len(lane.waiters) >= lane.max_queue:
+            raise self._reject(lane, "queue_full")
+        if lane.expected_wait() > lane.max_queue_time:
+            raise self._reject(lane, "expected_wait")
+
+        waiter = asyncio.get_running_loop().create_future()
+        lane.waiters.append(waiter)
+        started = time.monotonic()
+        try:
+            await asyncio.wait({waiter}, timeout=lane.max_queue_time)
+        except asyncio.CancelledError:
+            # the client went away: give back the slot if it was already handed over
+            if waiter.done():
+                self.release(name)
+            else:
+                self._leave_queue(lane, waiter)
+            raise
+
+        if not waiter.done():
+            self._leave_queue(lane, waiter)
+            raise self._reject(lane, "queue_timeout")
+
+        queue_time = time.monotonic() - started
+        lane.admitted += 1
+        lane.queue_times.append(queue_time)
+        return queue_time
+
+    def release(self, name: str, service_seconds: float = None) -> None:
+        lane = self.lanes[name]
+        lane.active -= 1
+        if service_seconds is not None:
+            lane.record_service(service_seconds)
+        self._dispatch()
+
+    def stats(self) -> Dict:
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+
+class Slot():
+    """A lane slot held by one request, released at most once"""
+
+    def __init__(self, controller: AdmissionController, lane: str) -> None:
+        self.controller = controller
+        self.lane = lane
+        self.held = True
+
+    def release(self, service_seconds: float = None) -> None:
+        if self.held:
+            self.held = False
+            self.controller.release(self.lane, service_seconds)
+
+
+def release_slot() -> None:
+    """
+    Give back the current request's slot before it finishes, for a request
+    that only waits for work admitted for another one (a coalesced search
+    follower, see `SingleFlight.wrap`). Its time is not a service time.
+    """
+    slot = _current_slot.get()
+    if slot is not None:
+        slot.release()
+
+
+class AdmissionMiddleware():
+    """
+    Pure ASGI middleware putting the requests of the paths in `routes`
+    (path -> lane name) through `controller`. Rejected requests get a 503
+    with a `Retry-After` header; every other request is passed straight through.
+    """
+
+    def __init__(self, app, controller: AdmissionController, routes: Dict[str, str]) -> None:
+        self.app = app
+        self.controller = controller
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        lane = self.routes.get(scope["path"]) if scope["type"] == "http" else None
+        if lane is None:
+            return await self.app(scope, receive, send)
+
+        try:
+            await self.controller.acquire(lane)
+        except Rejected as e:
+            print(f"Shed {scope['path']}: {e.reason}, retry after {e.retry_after}s")
+            response = JSONResponse(
+                status_code=503, headers={"Retry-After": str(e.retry_after)},
+                content={"detail": f"Server busy ({e.reason}), retry later"})
+            return await response(scope, receive, send)
+
+        slot = Slot(self.controller, lane)
+        token = _current_slot.set(slot)
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_slot.reset(token)
+            slot.release(time.monotonic() - started)
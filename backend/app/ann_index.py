@@ -0,0 +1,240 @@
+from typing import List, Optional, Tuple
+import numpy as np
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, n_iter: int = 20,
+           seed: int = 0) -> np.ndarray:
+    """Plain Lloyd k-means, returns the (n_clusters, dim) centroids"""
+    if len(vectors) < n_clusters:
+        raise ValueError(
+            f"Need at least {n_clusters} training vectors, got {len(vectors)}")
+
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assign = nearest_centroid(vectors, centroids)
+        counts = np.bincount(assign, minlength=n_clusters)
+
+        order = np.argsort(assign, kind="stable")
+        starts = np.searchsorted(assign[order], np.arange(n_clusters))
+        non_empty = counts > 0
+        sums = np.add.reduceat(vectors[order], starts[non_empty], axis=0)
+        centroids[non_empty] = sums / counts[non_empty, None]
+
+        # re-seed empty clusters on random points
+        n_empty = int((~non_empty).sum())
+        if n_empty:
+            centroids[~non_empty] = vectors[rng.choice(len(vectors), n_empty)]
+
+    return centroids
+
+
+def nearest_centroid(vectors: np.ndarray, centroids: np.ndarray,
+                     block_size: int = 65536) -> np.ndarray:
+    """L2 assignment, computed in blocks to bound the distance matrix size"""
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assign = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start+block_size]
+        distances = centroid_norms[None, :] - 2 * block @ centroids.T
+        assign[start:start+block_size] = distances.argmin(axis=1)
+    return assign
+
+
+class IVFPQIndex():
+    """
+    Inverted-file index with product-quantized residuals for dot-product
+    search over chunk embeddings.
+
+    Vectors are assigned to the nearest of `n_lists` coarse centroids and the
+    residual to that centroid is split into `n_subvectors` sub-vectors, each
+    encoded as one byte. A query scores `q.c + sum_j q_j.r_j` with a lookup
+    table over the codebooks, visits only the `nprobe` best lists and
+    re-scores the best `rerank_size` candidates exactly.
+    """
+
+    def __init__(self, dim: int = 768, n_lists: int = 1024, n_subvectors: int = 48,
+                 nprobe: int = 16, rerank_size: int = 256,
+                 keep_vectors: bool = True) -> None:
+        if dim % n_subvectors != 0:
+            raise ValueError(
+                f"dim {dim} is not divisible by n_subvectors {n_subvectors}")
+
+        self.dim = dim
+        self.n_lists = n_lists
+        self.n_subvectors = n_subvectors
+        self.sub_dim = dim // n_subvectors
+        self.n_codes = 256
+        self.nprobe = nprobe
+        self.rerank_size = rerank_size
+        self.keep_vectors = keep_vectors
+
+        self.centroids = None
+        self.codebooks = None
+
+        self.ids = []
+        self.vectors = []
+        self.list_codes = [[] for _ in range(n_lists)]
+        self.list_rows = [[] for _ in range(n_lists)]
+        self._dirty = False
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def train(self, vectors, n_iter: int = 20, max_train: int = 100000,
+              seed: int = 0) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) > max_train:
+            rng = np.random.default_rng(seed)
+            vectors = vectors[rng.choice(len(vectors), max_train, replace=False)]
+
+        self.centroids = kmeans(vectors, self.n_lists, n_iter=n_iter, seed=seed)
+        residuals = vectors - self.centroids[nearest_centroid(vectors, self.centroids)]
+
+        self.codebooks = np.empty(
+            (self.n_subvectors, self.n_codes, self.sub_dim), dtype=np.float32)
+        for j in range(self.n_subvectors):
+            sub = residuals[:, j*self.sub_dim:(j+1)*self.sub_dim]
+            self.codebooks[j] = kmeans(
+                np.ascontiguousarray(sub), self.n_codes, n_iter=n_iter, seed=seed)
+
+    def encode(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        list_ids = nearest_centroid(vectors, self.centroids)
+        residuals = vectors - self.centroids[list_ids]
+
+        codes = np.empty((len(vectors), self.n_subvectors), dtype=np.uint8)
+        for j in range(self.n_subvectors):
+            sub = residuals[:, j*self.sub_dim:(j+1)*self.sub_dim]
+            codes[:, j] = nearest_centroid(sub, self.codebooks[j])
+
+        return list_ids, codes
+
+    def add(self, vectors, ids: List) -> None:
+        """Add vectors incrementally, the index must be trained first"""
+        if not self.is_trained:
+            raise RuntimeError("IVFPQIndex.add called before train")
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) != len(ids):
+            raise ValueError("vectors and ids must have the same length")
+        if len(vectors) == 0:
+            return
+
+        first_row = len(self.ids)
+        rows = np.arange(first_row, first_row + len(vectors))
+        list_ids, codes = self.encode(vectors)
+
+        order = np.argsort(list_ids, kind="stable")
+        bounds = np.flatnonzero(np.diff(list_ids[order])) + 1
+        for group in np.split(order, bounds):
+            list_id = list_ids[group[0]]
+            self.list_codes[list_id].append(codes[group])
+            self.list_rows[list_id].append(rows[group])
+
+        self.ids.extend(ids)
+        if self.keep_vectors:
+            self.vectors.append(vectors.astype(np.float16))
+        self._dirty = True
+
+    def _compact(self) -> None:
+        # merge the per-list chunks appended by `add` into single arrays
+        if not self._dirty:
+            return
+
+        for list_id in range(self.n_lists):
+            if len(self.list_codes[list_id]) > 1:
+                self.list_codes[list_id] = [np.concatenate(self.list_codes[list_id])]
+                self.list_rows[list_id] = [np.concatenate(self.list_rows[list_id])]
+        if len(self.vectors) > 1:
+            self.vectors = [np.concatenate(self.vectors)]
+        self._dirty = False
+
+    def search(self, query, k: int = 5, nprobe: Optional[int] = None,
+               rerank_size: Optional[int] = None) -> Tuple[List, np.ndarray]:
+        """Return the ids and scores of the approximate top-k by dot product"""
+        if len(self) == 0:
+            return [], np.empty(0, dtype=np.float32)
+
+        self._compact()
+        query = np.asarray(query, dtype=np.float32)
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        rerank_size = max(rerank_size or self.rerank_size, k)
+
+        coarse_scores = self.centroids @ query
+        if nprobe < self.n_lists:
+            probe = np.argpartition(-coarse_scores, nprobe - 1)[:nprobe]
+        else:
+            probe = np.arange(self.n_lists)
+        probe = [list_id for list_id in probe if self.list_codes[list_id]]
+        if not probe:
+            return [], np.empty(0, dtype=np.float32)
+
+        codes = np.concatenate([self.list_codes[list_id][0] for list_id in probe])
+        rows = np.concatenate([self.list_rows[list_id][0] for list_id in probe])
+        lengths = [len(self.list_rows[list_id][0]) for list_id in probe]
+
+        # asymmetric distance: one lookup table per query shared by all lists
+        lookup = np.einsum("jcd,jd->jc", self.codebooks,
+                           query.reshape(self.n_subvectors, self.sub_dim))
+        scores = lookup[np.arange(self.n_subvectors), codes].sum(axis=1)
+        scores += np.repeat(coarse_scores[probe], lengths)
+
+        if self.keep_vectors and rerank_size < len(scores):
+            candidates = np.argpartition(-scores, rerank_size - 1)[:rerank_size]
+        else:
+            candidates = np.arange(len(scores))
+
+        candidate_rows = rows[candidates]
+        if self.keep_vectors:
+            scores = self.vectors[0][candidate_rows].astype(np.float32) @ query
+        else:
+            scores = scores[candidates]
+
+        top = np.argsort(-scores)[:k]
+        return [self.ids[row] for row in candidate_rows[top]], scores[top]
+
+    def save(self, file_path: str) -> None:
+        """Write the index as plain arrays, the ids must be all ints or all strings"""
+        self._compact()
+        ids = np.asarray(self.ids) if self.ids else np.empty(0, dtype=np.int64)
+        if ids.dtype.kind not in "iu" and ids.dtype.kind != "U":
+            raise ValueError("IVFPQIndex.save needs ids that are all ints or all strings")
+
+        lists = {}
+        for list_id in range(self.n_lists):
+            if self.list_codes[list_id]:
+                lists[f"codes_{list_id}"] = self.list_codes[list_id][0]
+                lists[f"rows_{list_id}"] = self.list_rows[list_id][0]
+
+        np.savez(file_path,
+                 params=np.array([self.dim, self.n_lists, self.n_subvectors,
+                                  self.nprobe, self.rerank_size, int(self.keep_vectors)]),
+                 centroids=self.centroids,
+                 codebooks=self.codebooks,
+                 ids=ids,
+                 vectors=self.vectors[0] if self.vectors else np.empty((0, self.dim), dtype=np.float16),
+                 **lists)
+
+    @classmethod
+    def load(cls, file_path: str) -> "IVFPQIndex":
+        data = np.load(file_path)
+        dim, n_lists, n_subvectors, nprobe, rerank_size, keep_vectors = data["params"].tolist()
+        index = cls(dim=dim, n_lists=n_lists, n_subvectors=n_subvectors,
+                    nprobe=nprobe, rerank_size=rerank_size,
+                    keep_vectors=bool(keep_vectors))
+        index.centroids = data["centroids"]
+        index.codebooks = data["codebooks"]
+        index.ids = data["ids"].tolist()
+        if keep_vectors:
+            index.vectors = [data["vectors"]]
+        for list_id in range(n_lists):
+            if f"codes_{list_id}" in data:
+                index.list_codes[list_id] = [data[f"codes_{list_id}"]]
+                index.list_rows[list_id] = [data[f"rows_{list_id}"]]
+
+        return index
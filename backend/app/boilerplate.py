@@ -0,0 +1,94 @@
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# "Page 3 of 12", "- 4 -", "iv", "12/40" and the like
+PAGE_NUMBER_PATTERN = re.compile(r"^(page\s*)?(#|[ivx]{1,4})(\s*(of|/)\s*#)?$|^[-\s#.|/]+$")
+ROMAN_NUMERAL_PATTERN = re.compile(r"\b[ivx]{1,4}\b")
+
+
+def normalize_line(line: str, max_numbered_words: int = 6) -> str:
+    """
+    Compare lines modulo case and spacing, and short lines also modulo
+    numbers (page numbers, dates in running headers). Longer lines keep
+    their numbers so templated content is not mistaken for boilerplate.
+    """
+    line = re.sub(r"\s+", " ", line.strip().lower())
+    if len(line.split()) <= max_numbered_words:
+        line = re.sub(r"\d+", "#", line)
+    return line
+
+
+def line_key(line: str) -> str:
+    """
+    What a normalized line is counted as: bare page numbers share one key
+    whether they are arabic ("#", already normalized) or roman numerals.
+    """
+    if PAGE_NUMBER_PATTERN.match(line):
+        return ROMAN_NUMERAL_PATTERN.sub("#", line)
+    return line
+
+
+def detect_boilerplate(page_texts: List[str], edge_lines: int = 3, min_pages: int = 3,
+                       min_ratio: float = 0.5, body_ratio: float = 0.8,
+                       known: Iterable[str] = ()) -> set:
+    """
+    Keys (see `line_key`) of the lines that are page furniture rather than
+    content:
+
+    - lines among the first / last `edge_lines` of a page (running headers
+      and footers, page numbers) found on at least `min_ratio` of the pages;
+    - lines anywhere on the page (disclaimers, watermarks) found on at least
+      `body_ratio` of the pages;
+    - the `known` keys, detected in earlier segments of the same document.
+
+    Only the `known` keys are returned for fewer than `min_pages` pages.
+    """
+    if len(page_texts) < min_pages:
+        return set(known)
+
+    edge_counts = Counter()
+    body_counts = Counter()
+    for text in page_texts:
+        lines = [line_key(normalize_line(line)) for line in text.splitlines() if line.strip()]
+        edge_counts.update(set(lines[:edge_lines] + lines[-edge_lines:]))
+        body_counts.update(set(lines))
+
+    edge_threshold = max(min_pages, min_ratio * len(page_texts))
+    body_threshold = max(min_pages, body_ratio * len(page_texts))
+    boilerplate = {line for line, count in edge_counts.items() if count >= edge_threshold}
+    boilerplate |= {line for line, count in body_counts.items() if count >= body_threshold}
+    return boilerplate | set(known)
+
+
+def strip_boilerplate(page_texts: List[str], boilerplate: Optional[set] = None,
+                      **kwargs) -> Tuple[List[str], Dict]:
+    """
+    Page texts without the `boilerplate` lines (found by `detect_boilerplate`
+    by default), and what was removed
+    """
+    if boilerplate is None:
+        boilerplate = detect_boilerplate(page_texts, **kwargs)
+    stats = {"lines_removed": 0, "words_removed": 0, "patterns": len(boilerplate)}
+    if not boilerplate:
+        return page_texts, stats
+
+    stripped = []
+    for text in page_texts:
+        kept = []
+        for line in text.splitlines():
+            if line.strip() and line_key(normalize_line(line)) in boilerplate:
+                stats["lines_removed"] += 1
+                stats["words_removed"] += len(line.split())
+            else:
+                kept.append(line)
+        stripped.append("\n".join(kept).strip())
+
+    return stripped, stats
+
+
+def savings(stats: Dict, sentence_size: int, tokens_per_word: float = 1.3) -> Dict:
+    """Rough number of chunks and embedding tokens the removed words would have cost"""
+    return {**stats,
+            "estimated_chunks_saved": round(stats["words_removed"] / sentence_size),
+            "estimated_tokens_saved": round(stats["words_removed"] * tokens_per_word)}
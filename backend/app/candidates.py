@@ -0,0 +1,73 @@
+from typing import Dict, List
+
+import numpy as np
+
+
+def collapse_adjacent(candidates: List[Dict], max_gap: int = 1) -> List[Dict]:
+    """
+    Drop the chunks within `max_gap` of a higher priority chunk kept from
+    the same file: chunks `chunk_id` n and n+1 share `overlapping_num`
+    sentences, so sending both to the reranker mostly repeats text.
+    `candidates` are in priority order and the kept chunks stay in that
+    order. Gaps are measured from kept chunks only, so a long run of
+    neighbours keeps every (max_gap + 1)th chunk rather than one.
+    """
+    kept_ids = {}
+    collapsed = []
+    for candidate in candidates:
+        file_key = candidate.get("file_key")
+        if file_key is not None:
+            # chunk ids are per file, without the file nothing is known to overlap
+            kept = kept_ids.setdefault(file_key, [])
+            if any(abs(candidate["chunk_id"] - chunk_id) <= max_gap for chunk_id in kept):
+                continue
+            kept.append(candidate["chunk_id"])
+        collapsed.append(candidate)
+
+    return collapsed
+
+
+def mmr(query_vector, vectors, k: int, diversity: float = 0.3) -> List[int]:
+    """
+    Maximal marginal relevance: greedily pick the vector maximizing
+    (1 - diversity) * sim(query, v) - diversity * max sim(v, already picked),
+    with cosine similarities. Returns the indices of the picked vectors.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if len(vectors) == 0 or k <= 0:
+        return []
+
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query_vector = np.asarray(query_vector, dtype=np.float32)
+    query_vector = query_vector / max(float(np.linalg.norm(query_vector)), 1e-12)
+
+    relevance = vectors @ query_vector
+    similarity = vectors @ vectors.T
+    redundancy = np.full(len(vectors), -np.inf, dtype=np.float32)
+    available = np.ones(len(vectors), dtype=bool)
+
+    picked = []
+    for _ in range(min(k, len(vectors))):
+        scores = (1 - diversity) * relevance - diversity * np.maximum(redundancy, 0)
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+
+    return picked
+
+
+def select_for_rerank(query_vector, candidates: List[Dict], k: int,
+                      diversity: float = 0.3) -> List[Dict]:
+    """Collapse neighbouring chunks, then keep `k` relevant and diverse candidates"""
+    candidates = collapse_adjacent(candidates)
+    if len(candidates) <= k:
+        return candidates
+
+    with_vectors = [candidate for candidate in candidates if candidate.get("embedding")]
+    without_vectors = [candidate for candidate in candidates if not candidate.get("embedding")]
+    picked = mmr(query_vector, [candidate["embedding"] for candidate in with_vectors],
+                 k, diversity=diversity)
+
+    return ([with_vectors[index] for index in picked] + without_vectors)[:k]
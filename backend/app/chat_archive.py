@@ -0,0 +1,328 @@
+import asyncio
+import json
+import shutil
+import tempfile
+import zipfile
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+from app import profiling
+from app.config import config
+
+# version 1 archives hold only the "embedding" matrix
+ARCHIVE_VERSION = 2
+MANIFEST_FILE = "manifest.json"
+FILES_FILE = "files.jsonl"
+EMBEDDINGS_FILE = "embeddings.f32"
+EXTRA_FILE = "extra.jsonl"
+
+# rows of zeros written at once for chunks without a vector field
+ZERO_BLOCK_ROWS = 65536
+
+# chunk fields stored as columns, any other field goes to extra.jsonl
+STRING_COLUMNS = ("text", "file_key", "file_name", "content_hash", "chat_id", "ingest_id")
+INT_COLUMNS = ("chunk_id", "word_size")
+LIST_COLUMNS = ("page_number",)
+
+
+class ChatArchiveWriter():
+    """
+    Write one chat's files and chunks as an uncompressed zip of columns:
+
+        manifest.json            {"version", "chat_id", "dim", "num_chunks", "num_files",
+                                  "embedding_field", "vectors"}
+        files.jsonl              one UploadedFile record per line
+        embeddings.f32           float32 (num_chunks, dim) matrix of `embedding_field`
+        <field>.f32              float32 matrix of another embedding* field, e.g. the
+                                 previous model's vectors during a re-embed,
+                                 "vectors" maps these fields to their dim
+        <field>.utf8/.offsets    string column: utf-8 blob + num_chunks+1 uint64 offsets
+        <field>.nulls            uint8 mask of chunks without the field (or vector)
+        <field>.i64              integer column
+        <field>.i64/.offsets     list-of-integers column, flattened
+        extra.jsonl              remaining fields, one JSON object per chunk
+
+    Chunks are streamed in with `add_chunks`: embeddings go straight into
+    the archive, string blobs to temporary files until `close`.
+    """
+
+    def __init__(self, file_path: str, chat_id: str, embedding_field: str = None) -> None:
+        self.chat_id = chat_id
+        self.embedding_field = embedding_field or config.embedding_field
+        self.archive = zipfile.ZipFile(file_path, mode="w",
+                                       compression=zipfile.ZIP_STORED, allowZip64=True)
+        self.embeddings = self.archive.open(EMBEDDINGS_FILE, mode="w", force_zip64=True)
+        self.dim = None
+        self.num_chunks = 0
+        self.files = []
+
+        self.blobs = {field: tempfile.TemporaryFile() for field in STRING_COLUMNS}
+        self.extra = tempfile.TemporaryFile()
+        self.offsets = {field: [0] for field in (*STRING_COLUMNS, *LIST_COLUMNS)}
+        self.nulls = {field: [] for field in (*STRING_COLUMNS, *INT_COLUMNS, *LIST_COLUMNS)}
+        self.ints = {field: [] for field in (*INT_COLUMNS, *LIST_COLUMNS)}
+        # other vector fields, the first chunks seen may not have them
+        self.vectors = {}
+        self.vector_dims = {}
+        self.vector_nulls = {}
+
+    def add_files(self, files: List[Dict]) -> None:
+        self.files.extend({key: value for key, value in record.items() if key != "_id"}
+                          for record in files)
+
+    def add_chunks(self, chunks: List[Dict]) -> None:
+        if len(chunks) == 0:
+            return
+
+        embeddings = np.asarray([chunk[self.embedding_field] for chunk in chunks],
+                                dtype=np.float32)
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(f"Embedding size {embeddings.shape[1]} does not match {self.dim}")
+        self.embeddings.write(embeddings.tobytes())
+
+        vector_fields = {key for chunk in chunks for key, value in chunk.items()
+                         if self._is_vector(key, value)}
+        for field in sorted(vector_fields | set(self.vectors)):
+            self._add_vectors(field, chunks)
+
+        for chunk in chunks:
+            for field in STRING_COLUMNS:
+                value = chunk.get(field)
+                self.nulls[field].append(value is None)
+                data = (value or "").encode("utf-8")
+                self.blobs[field].write(data)
+                self.offsets[field].append(self.offsets[field][-1] + len(data))
+
+            for field in INT_COLUMNS:
+                self.nulls[field].append(chunk.get(field) is None)
+                self.ints[field].append(chunk.get(field) or 0)
+
+            for field in LIST_COLUMNS:
+                values = chunk.get(field)
+                self.nulls[field].append(values is None)
+                self.ints[field].extend(values or [])
+                self.offsets[field].append(len(self.ints[field]))
+
+            extra = {key: value for key, value in chunk.items()
+                     if key not in KNOWN_FIELDS and key != self.embedding_field
+                     and not self._is_vector(key, value)}
+            self.extra.write(json.dumps(extra, ensure_ascii=False).encode("utf-8") + b"\n")
+
+        self.num_chunks += len(chunks)
+
+    def _is_vector(self, key: str, value) -> bool:
+        return (key != self.embedding_field and key.startswith("embedding")
+                and isinstance(value, list) and len(value) > 0
+                and all(isinstance(item, (int, float)) for item in value))
+
+    def _add_vectors(self, field: str, chunks: List[Dict]) -> None:
+        if field not in self.vectors:
+            self.vector_dims[field] = next(len(chunk[field]) for chunk in chunks
+                                           if self._is_vector(field, chunk.get(field)))
+            self.vectors[field] = tempfile.TemporaryFile()
+            self.vector_nulls[field] = [True] * self.num_chunks
+            for start in range(0, self.num_chunks, ZERO_BLOCK_ROWS):
+                rows = min(ZERO_BLOCK_ROWS, self.num_chunks - start)
+                self.vectors[field].write(
+                    np.zeros((rows, self.vector_dims[field]), dtype=np.float32).tobytes())
+
+        dim = self.vector_dims[field]
+        vectors = np.zeros((len(chunks), dim), dtype=np.float32)
+        for row, chunk in enumerate(chunks):
+            value = chunk.get(field)
+            is_vector = self._is_vector(field, value)
+            self.vector_nulls[field].append(not is_vector)
+            if is_vector:
+                if len(value) != dim:
+                    raise ValueError(f"{field} size {len(value)} does not match {dim}")
+                vectors[row] = value
+        self.vectors[field].write(vectors.tobytes())
+
+    def close(self) -> Dict:
+        self.embeddings.close()
+
+        for field in STRING_COLUMNS:
+            self._write_tmp(f"{field}.utf8", self.blobs[field])
+            self.archive.writestr(f"{field}.offsets",
+                                  np.asarray(self.offsets[field], dtype=np.uint64).tobytes())
+        for field in (*INT_COLUMNS, *LIST_COLUMNS):
+            self.archive.writestr(f"{field}.i64",
+                                  np.asarray(self.ints[field], dtype=np.int64).tobytes())
+        for field in LIST_COLUMNS:
+            self.archive.writestr(f"{field}.offsets",
+                                  np.asarray(self.offsets[field], dtype=np.uint64).tobytes())
+        for field, nulls in (*self.nulls.items(), *self.vector_nulls.items()):
+            self.archive.writestr(f"{field}.nulls", np.asarray(nulls, dtype=np.uint8).tobytes())
+        for field, tmp_file in self.vectors.items():
+            self._write_tmp(f"{field}.f32", tmp_file)
+        self._write_tmp(EXTRA_FILE, self.extra)
+        self.archive.writestr(FILES_FILE, "".join(
+            json.dumps(record, ensure_ascii=False) + "\n" for record in self.files))
+
+        manifest = {"version": ARCHIVE_VERSION,
+                    "chat_id": self.chat_id,
+                    "dim": self.dim or 0,
+                    "num_chunks": self.num_chunks,
+                    "num_files": len(self.files),
+                    "embedding_field": self.embedding_field,
+                    "vectors": self.vector_dims}
+        self.archive.writestr(MANIFEST_FILE, json.dumps(manifest))
+        self.archive.close()
+        return manifest
+
+    def abort(self) -> None:
+        self.embeddings.close()
+        self.archive.close()
+        for tmp_file in (*self.blobs.values(), *self.vectors.values(), self.extra):
+            tmp_file.close()
+
+    def _write_tmp(self, name: str, tmp_file) -> None:
+        tmp_file.seek(0)
+        with self.archive.open(name, mode="w", force_zip64=True) as f:
+            shutil.copyfileobj(tmp_file, f, 1024 * 1024)
+        tmp_file.close()
+
+
+class ChatArchiveReader():
+    """Read an archive written by `ChatArchiveWriter` back as chunk batches"""
+
+    def __init__(self, file_path: str) -> None:
+        self.archive = zipfile.ZipFile(file_path, mode="r")
+        self.manifest = json.loads(self.archive.read(MANIFEST_FILE))
+        if self.manifest["version"] not in (1, ARCHIVE_VERSION):
+            raise ValueError(f"Unsupported archive version {self.manifest['version']}")
+
+    def close(self) -> None:
+        self.archive.close()
+
+    def files(self) -> List[Dict]:
+        lines = self.archive.read(FILES_FILE).decode("utf-8").splitlines()
+        return [json.loads(line) for line in lines if line]
+
+    def _array(self, name: str, dtype) -> np.ndarray:
+        return np.frombuffer(self.archive.read(name), dtype=dtype)
+
+    def iter_chunks(self, batch_size: int = 1000) -> Iterator[List[Dict]]:
+        num_chunks, dim = self.manifest["num_chunks"], self.manifest["dim"]
+        offsets = {field: self._array(f"{field}.offsets", np.uint64).astype(np.int64)
+                   for field in (*STRING_COLUMNS, *LIST_COLUMNS)}
+        nulls = {field: self._array(f"{field}.nulls", np.uint8).astype(bool)
+                 for field in (*STRING_COLUMNS, *INT_COLUMNS, *LIST_COLUMNS)}
+        ints = {field: self._array(f"{field}.i64", np.int64)
+                for field in (*INT_COLUMNS, *LIST_COLUMNS)}
+        embedding_field = self.manifest.get("embedding_field", "embedding")
+        vector_dims = self.manifest.get("vectors", {})
+        vector_nulls = {field: self._array(f"{field}.nulls", np.uint8).astype(bool)
+                        for field in vector_dims}
+
+        embeddings = self.archive.open(EMBEDDINGS_FILE)
+        blobs = {field: self.archive.open(f"{field}.utf8") for field in STRING_COLUMNS}
+        vector_files = {field: self.archive.open(f"{field}.f32") for field in vector_dims}
+        extra = self.archive.open(EXTRA_FILE)
+        try:
+            for start in range(0, num_chunks, batch_size):
+                end = min(start + batch_size, num_chunks)
+                vectors = np.frombuffer(embeddings.read((end - start) * dim * 4),
+                                        dtype=np.float32).reshape(end - start, dim)
+                chunks = [json.loads(extra.readline()) for _ in range(start, end)]
+
+                for field in STRING_COLUMNS:
+                    data = blobs[field].read(int(offsets[field][end] - offsets[field][start]))
+                    base = offsets[field][start]
+                    for row, chunk in zip(range(start, end), chunks):
+                        if not nulls[field][row]:
+                            chunk[field] = data[offsets[field][row] - base:
+                                                offsets[field][row + 1] - base].decode("utf-8")
+
+                for field in INT_COLUMNS:
+                    for row, chunk in zip(range(start, end), chunks):
+                        if not nulls[field][row]:
+                            chunk[field] = int(ints[field][row])
+
+                for field in LIST_COLUMNS:
+                    for row, chunk in zip(range(start, end), chunks):
+                        if not nulls[field][row]:
+                            chunk[field] = ints[field][
+                                offsets[field][row]:offsets[field][row + 1]].tolist()
+
+                for chunk, vector in zip(chunks, vectors.tolist()):
+                    chunk[embedding_field] = vector
+
+                for field, field_dim in vector_dims.items():
+                    rows = np.frombuffer(vector_files[field].read((end - start) * field_dim * 4),
+                                         dtype=np.float32).reshape(end - start, field_dim)
+                    for row, chunk, vector in zip(range(start, end), chunks, rows.tolist()):
+                        if not vector_nulls[field][row]:
+                            chunk[field] = vector
+
+                yield chunks
+        finally:
+            embeddings.close()
+            extra.close()
+            for blob in (*blobs.values(), *vector_files.values()):
+                blob.close()
+
+
+KNOWN_FIELDS = {"_id", *STRING_COLUMNS, *INT_COLUMNS, *LIST_COLUMNS}
+
+
+async def export_chat(mongo_db_engine, chat_id: str, file_path: str,
+                      batch_size: int = 1000) -> Dict:
+    """Stream a chat's chunks and file records from MongoDB into an archive at `file_path`"""
+    writer = await profiling.to_thread(ChatArchiveWriter, file_path, chat_id)
+    try:
+        file_keys = set()
+        async for chunks in mongo_db_engine.iter_chunks(chat_id, batch_size=batch_size):
+            file_keys.update(chunk.get("file_key") for chunk in chunks)
+            await profiling.to_thread(writer.add_chunks, chunks)
+
+        files = await mongo_db_engine.find_files([key for key in file_keys if key], chat_id)
+        writer.add_files(files)
+    except BaseException:
+        writer.abort()
+        raise
+
+    return await profiling.to_thread(writer.close)
+
+
+async def import_chat(mongo_db_engine, file_path: str, chat_id: str = None,
+                      replace: bool = False, batch_size: int = 1000) -> Dict:
+    """
+    Load an archive (a path or a binary file object) into MongoDB with bulk
+    writes, optionally under another `chat_id`: the chat then gets its own
+    copies of the file records. No embedding is recomputed. A chat that
+    already has chunks is refused unless `replace`, which deletes them first.
+    """
+    reader = await profiling.to_thread(ChatArchiveReader, file_path)
+    try:
+        chat_id = chat_id or reader.manifest["chat_id"]
+        if await mongo_db_engine.count_chunks(chat_id) > 0:
+            if not replace:
+                raise FileExistsError(f"Chat {chat_id} already has chunks")
+            await mongo_db_engine.delete_chunks(chat_id)
+
+        files = reader.files()
+        for record in files:
+            record["chat_id"] = chat_id
+        await mongo_db_engine.upsert_file_records(files)
+
+        # read the next batch while the previous one is inserted
+        batches = reader.iter_chunks(batch_size)
+        pending = None
+        while True:
+            chunks = await profiling.to_thread(next, batches, None)
+            if pending is not None:
+                await pending
+            if chunks is None:
+                break
+            for chunk in chunks:
+                chunk["chat_id"] = chat_id
+            pending = asyncio.ensure_future(mongo_db_engine.insert_embedding(chunks))
+        await mongo_db_engine.bump_chat_version(chat_id)
+    finally:
+        reader.close()
+
+    return {**reader.manifest, "chat_id": chat_id}
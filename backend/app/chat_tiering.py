@@ -0,0 +1,196 @@
+import asyncio
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+from app import chat_archive, profiling
+from app.config import config
+from app.single_flight import SingleFlight
+
+# ChatActivity states
+HOT = "hot"                  # chunks in MongoDB
+OFFLOADING = "offloading"    # being exported, still served; an access cancels it
+EVICTING = "evicting"        # archived on S3, chunks being deleted
+COLD = "cold"                # chunks only on S3
+REHYDRATING = "rehydrating"  # being restored from S3
+
+
+class ChatTiering():
+    """
+    Keep only recently used chats in the chunk collections. Every access to
+    a chat goes through `access`, which records it in the ChatActivity
+    collection (at most every `touch_interval` seconds per worker) and
+    restores the chat from S3 first when it is cold. `offload_idle` exports
+    the chats not accessed for `idle_seconds` as chat archives (see
+    chat_archive.py) under `prefix` and deletes their chunks.
+
+    State changes are conditional updates, so workers and offload passes
+    running side by side never both act on a chat: an access during the
+    export cancels the offload, a restore is claimed by one worker while the
+    others wait for the chat to be hot. A restore or eviction left behind
+    by a dead worker is taken over after `stale_seconds`.
+    """
+
+    def __init__(self, mongo_db_engine, s3, bucket: str, prefix: str,
+                 scope_factory: Callable, idle_seconds: float,
+                 touch_interval: float = 60, stale_seconds: float = 600,
+                 wait_timeout: float = 60, poll_interval: float = 0.5,
+                 on_change: Optional[Callable[[str], None]] = None) -> None:
+        self.mongo_db_engine = mongo_db_engine
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/")
+        self.scope_factory = scope_factory
+        self.idle_seconds = idle_seconds
+        self.touch_interval = touch_interval
+        self.stale_seconds = stale_seconds
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.on_change = on_change
+        self.restores = SingleFlight()
+        # chat_id -> monotonic time it was last recorded hot by this worker
+        self._touched: Dict[str, float] = {}
+        self.offloaded = 0
+        self.restored = 0
+
+    def archive_key(self, chat_id: str) -> str:
+        return f"{self.prefix}/{chat_id}.chatidx"
+
+    async def access(self, chat_id: str) -> None:
+        """Record an access to the chat, restoring its chunks first when it is offloaded"""
+        now = time.monotonic()
+        touched = self._touched.get(chat_id)
+        if touched is not None and now - touched < self.touch_interval:
+            return
+
+        activity = await self.mongo_db_engine.touch_chat(chat_id, time.time())
+        if activity["state"] == OFFLOADING:
+            await self.mongo_db_engine.set_chat_state(
+                chat_id, [OFFLOADING], HOT, changed_at=time.time())
+        elif activity["state"] != HOT:
+            await self.restores.do(chat_id, self._restore, chat_id)
+
+        self._forget_touched(now)
+        self._touched[chat_id] = now
+
+    def _forget_touched(self, now: float) -> None:
+        if len(self._touched) < 10000:
+            return
+        self._touched = {chat_id: touched for chat_id, touched in self._touched.items()
+                         if now - touched < self.touch_interval}
+
+    async def _restore(self, chat_id: str) -> None:
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            now = time.time()
+            claimed = await self.mongo_db_engine.set_chat_state(
+                chat_id, [COLD], REHYDRATING, changed_at=now)
+            if claimed is None:
+                claimed = await self.mongo_db_engine.set_chat_state(
+                    chat_id, [REHYDRATING, EVICTING], REHYDRATING,
+                    changed_before=now - self.stale_seconds, changed_at=now)
+            if claimed is not None:
+                await self._import(chat_id, claimed)
+                return
+
+            activity = await self.mongo_db_engine.get_chat_activity(chat_id)
+            if activity is None or activity["state"] == HOT:
+                return
+            if activity["state"] == OFFLOADING:
+                await self.mongo_db_engine.set_chat_state(
+                    chat_id, [OFFLOADING], HOT, changed_at=time.time())
+                return
+
+            # restored or evicted by another worker
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Chat {chat_id} is still being restored")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _import(self, chat_id: str, activity: Dict) -> None:
+        try:
+            if activity.get("s3_key"):
+                async with self.scope_factory() as scope:
+                    upload = await scope.download_s3(self.s3, self.bucket, activity["s3_key"])
+                    with upload.open() as f:
+                        await chat_archive.import_chat(
+                            self.mongo_db_engine, f, chat_id=chat_id, replace=True)
+        except BaseException:
+            await self.mongo_db_engine.set_chat_state(
+                chat_id, [REHYDRATING], COLD, changed_at=time.time())
+            raise
+
+        await self.mongo_db_engine.set_chat_state(
+            chat_id, [REHYDRATING], HOT, changed_at=time.time())
+        self.restored += 1
+        print(f"Restored chat {chat_id} ({activity.get('num_chunks', 0)} chunks) from S3")
+        if self.on_change is not None:
+            self.on_change(chat_id)
+
+    async def offload_idle(self, limit: int = 20) -> List[Dict]:
+        """Offload up to `limit` chats not accessed for `idle_seconds`, least recent first"""
+        idle = await self.mongo_db_engine.find_idle_chats(time.time() - self.idle_seconds, limit)
+        offloaded = []
+        for activity in idle:
+            result = await self.offload(activity["chat_id"], activity["last_access"])
+            if result is not None:
+                offloaded.append(result)
+        return offloaded
+
+    async def offload(self, chat_id: str, last_access: float) -> Optional[Dict]:
+        """
+        Export the chat to S3 and delete its chunks, unless it is accessed
+        after `last_access` meanwhile. None when it was not offloaded.
+        """
+        claimed = await self.mongo_db_engine.set_chat_state(
+            chat_id, [HOT], OFFLOADING, last_access=last_access, changed_at=time.time())
+        if claimed is None:
+            return None
+
+        s3_key = None
+        try:
+            num_chunks = await self.mongo_db_engine.count_chunks(chat_id)
+            if num_chunks:
+                s3_key = self.archive_key(chat_id)
+                async with self.scope_factory() as scope:
+                    # reserve about the size of the embeddings plus the chunk text
+                    file_path = await scope.reserve_path(
+                        os.path.basename(s3_key), num_chunks * (config.embedding_dim * 4 + 2048))
+                    await chat_archive.export_chat(self.mongo_db_engine, chat_id, file_path)
+                    await profiling.to_thread(self.s3.upload_file, file_path, self.bucket, s3_key)
+        except BaseException:
+            await self.mongo_db_engine.set_chat_state(
+                chat_id, [OFFLOADING], HOT, changed_at=time.time())
+            raise
+
+        # accessed during the export: keep it, the archive is overwritten next time
+        evicting = await self.mongo_db_engine.set_chat_state(
+            chat_id, [OFFLOADING], EVICTING, changed_at=time.time(),
+            s3_key=s3_key, num_chunks=num_chunks)
+        if evicting is None:
+            return None
+
+        await self.mongo_db_engine.delete_chunks(chat_id)
+        await self.mongo_db_engine.bump_chat_version(chat_id)
+        await self.mongo_db_engine.set_chat_state(
+            chat_id, [EVICTING], COLD, changed_at=time.time())
+        self.offloaded += 1
+        if self.on_change is not None:
+            self.on_change(chat_id)
+        return {"chat_id": chat_id, "num_chunks": num_chunks, "s3_key": s3_key}
+
+    async def run_periodically(self, interval: float, limit: int) -> None:
+        """Offload pass every `interval` seconds, until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                offloaded = await self.offload_idle(limit)
+                if offloaded:
+                    print(f"Offloaded {len(offloaded)} idle chats to S3")
+            except Exception as e:
+                print(f"Error offloading idle chats: {str(e)}")
+
+    def stats(self) -> Dict:
+        return {"idle_seconds": self.idle_seconds,
+                "offloaded": self.offloaded,
+                "restored": self.restored,
+                "restoring": self.restores.stats()["in_flight"]}
@@ -1,8 +1,119 @@
 class config:
     sentence_size = 256
     overlapping_num = 3
+    pdf_extractor = "auto"
+    # drop headers, footers, page numbers and disclaimers repeated across pages
+    strip_boilerplate = True
 
     s3_bucket = "pdf-chatbot-saurabh"
     s3_root_dir = "chatpdf"
 
+    # with adaptive_batching, batch_size / embedding_concurrency are the starting
+    # values and the embedding stage adjusts them within the bounds below
+    adaptive_batching = True
     batch_size = 64
+    min_batch_size = 8
+    max_batch_size = 256
+    embedding_max_batch_tokens = 32000
+    embedding_target_latency = 2.0
+    max_embedding_concurrency = 8
+    parse_workers = 4
+    ingest_time_budget = 25.0
+    ingest_segment_pages = 20
+    num_candidates_factor = 10
+
+    # hybrid_search fetches limit * hybrid_candidates_factor chunks per search and
+    # reranks at most limit * rerank_candidates_factor of them, picked by MMR
+    hybrid_candidates_factor = 3
+    rerank_candidates_factor = 2
+    mmr_diversity = 0.3
+    # largest `expand` of vector_search / hybrid_search: chunks of context on each side
+    max_context_expand = 5
+
+    # uploads up to upload_spool_threshold bytes stay in memory, larger ones are
+    # spooled to /tmp, at most tmp_quota_bytes at once across requests. The quota
+    # is per process: gunicorn.conf.py divides it among the prefork workers
+    upload_spool_threshold = 8 * 1024 * 1024
+    tmp_quota_bytes = 384 * 1024 * 1024
+
+    # embedding model of queries and new chunks, and the chunk field searched with
+    # the "vector_index" / UploadedFile "file_vector_index" vector indexes. A model
+    # upgrade (reembed_tool.py) fills a parallel field: list it in embedding_fields
+    # so searches never return it, then point these settings at it to cut over
+    embedding_model = "jina-embeddings-v2-base-en"
+    embedding_field = "embedding"
+    embedding_fields = ("embedding",)
+    vector_index = "vector_index"
+    file_vector_index = "file_vector_index"
+    # re-embedding job: chunks read per batch, optional rate limit
+    reembed_read_batch = 1000
+    reembed_max_chunks_per_second = None
+
+    # chunks are spread over chat_partitions collections (Embedding_000, ...) by a hash
+    # of the chat id, or of its tenant prefix (before tenant_separator); each one needs
+    # its own vector and search indexes. 1 keeps the single Embedding collection.
+    # Changing it moves chats to other collections: export / import them around it
+    chat_partitions = 1
+    partition_by_tenant = False
+    tenant_separator = ":"
+
+    # chats not accessed for chat_idle_seconds are exported to S3 under cold_storage_dir
+    # and their chunks deleted, then restored on their next access. The offload pass
+    # runs every chat_offload_interval seconds in each worker, None runs it only
+    # through /offload_idle_chats. Accesses are recorded at most every chat_touch_interval
+    chat_idle_seconds = 7 * 24 * 3600
+    chat_offload_interval = None
+    chat_offload_batch = 20
+    chat_touch_interval = 60
+    cold_storage_dir = f"{s3_root_dir}/cold"
+
+    embedding_dim = 768
+    use_embedding_store = True
+    embedding_store_dir = "/tmp/embedding_store"
+    embedding_store_ttl = 60
+    # stores of at least ann_min_rows chunks are searched through an IVF/PQ index that
+    # probes ann_nprobe lists and re-scores ann_rerank_size candidates, None searches exactly
+    ann_min_rows = None
+    ann_nprobe = 16
+    ann_rerank_size = 256
+
+    use_query_cache = True
+    query_cache_threshold = 0.95
+    query_cache_size = 256
+    query_cache_max_chats = 1024
+    query_cache_ttl = 300
+
+    # admission control: per lane, requests beyond max_concurrency wait in a queue of
+    # at most max_queue requests for at most max_queue_time seconds, else get a 503.
+    # Searches have priority: ingests are not admitted while searches are queued
+    use_admission_control = True
+    search_max_concurrency = 32
+    search_max_queue = 128
+    search_max_queue_time = 2.0
+    ingest_max_concurrency = 4
+    ingest_max_queue = 16
+    ingest_max_queue_time = 30.0
+
+    # concurrent identical searches share one execution
+    use_single_flight = True
+
+    # prefork serving (gunicorn.conf.py): workers defaults to one per available core,
+    # each worker is replaced gracefully after max_requests (+ jitter) requests
+    workers = None
+    worker_max_requests = 5000
+    worker_max_requests_jitter = 500
+    worker_graceful_timeout = 30
+    # query embeddings shared by all workers through shared memory, 0 disables
+    shared_embedding_cache_slots = 8192
+
+    mongo_max_pool_size = 100
+    mongo_min_pool_size = 5
+    mongo_max_idle_time_ms = 60000
+    http_max_connections = 100
+    http_max_keepalive_connections = 20
+    http_timeout = 30.0
+    embedding_concurrency = 4
+    s3_max_pool_connections = 50
+
+    profile_dir = "/tmp/profiles"
+    profile_interval = 0.005
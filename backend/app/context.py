@@ -0,0 +1,99 @@
+import asyncio
+from typing import Dict, List, Optional
+
+# columns of an UploadedFile "neighbour_map", entry i describes the file's chunk_id i
+MAP_COLUMNS = ("first_page", "last_page", "overlap")
+NEIGHBOUR_FIELDS = ["text", "chunk_id", "file_key", "page_number"]
+
+
+def neighbour_map(chunk_metas: List[Dict]) -> Dict[str, List[int]]:
+    """
+    Neighbour map entries of consecutive chunks of a file, in chunk_id
+    order. The neighbours of chunk i are i - 1, i + 1, ..., and entry i
+    holds its first and last page and how many characters at the start of
+    its text repeat the previous chunk. The "overlap" of the chunk metas
+    (see `pdf_utils.ChunkBuilder`) moves into the map, it is not stored on
+    the chunks.
+    """
+    columns = {column: [] for column in MAP_COLUMNS}
+    for metas in sorted(chunk_metas, key=lambda metas: metas["chunk_id"]):
+        columns["first_page"].append(min(metas["page_number"]))
+        columns["last_page"].append(max(metas["page_number"]))
+        columns["overlap"].append(metas.pop("overlap", 0))
+    return columns
+
+
+def shared_prefix(previous: str, text: str) -> int:
+    """Characters at the start of `text` repeating whole lines at the end of `previous`"""
+    lines = text.split("\n")
+    for count in range(len(lines) - 1, 0, -1):
+        prefix = "\n".join(lines[:count])
+        if previous.endswith(prefix):
+            return len(prefix) + 1
+    return 0
+
+
+def merge_window(chunks: List[Dict], overlaps: Optional[List[int]] = None) -> str:
+    """Text of consecutive chunks of a file, each overlap with the previous chunk kept once"""
+    text = chunks[0]["text"]
+    for previous, chunk in zip(chunks, chunks[1:]):
+        overlap = 0
+        if chunk["chunk_id"] == previous["chunk_id"] + 1:
+            chunk_id = chunk["chunk_id"]
+            overlap = overlaps[chunk_id] if overlaps and chunk_id < len(overlaps) else None
+            # a map older than the chunks (or none): compare the texts instead
+            if not overlap or not previous["text"].endswith(chunk["text"][:overlap - 1]):
+                overlap = shared_prefix(previous["text"], chunk["text"])
+        text += "\n" + chunk["text"][overlap:]
+    return text
+
+
+def window_pages(chunks: List[Dict], neighbours: Optional[Dict] = None) -> List[int]:
+    if neighbours is None or chunks[-1]["chunk_id"] >= len(neighbours["first_page"]):
+        return sorted({page for chunk in chunks for page in chunk["page_number"]})
+
+    first = min(neighbours["first_page"][chunk["chunk_id"]] for chunk in chunks)
+    last = max(neighbours["last_page"][chunk["chunk_id"]] for chunk in chunks)
+    return list(range(first, last + 1))
+
+
+async def expand_results(mongo_db_engine, chat_id: str, results: List[Dict],
+                         expand: int) -> List[Dict]:
+    """
+    Add to each result (which needs its "file_key") a "context": its text
+    merged with the `expand` chunks before and after it in its file, and the
+    pages they span. The neighbours of all the results are read in one
+    query, alongside the files' neighbour maps.
+    """
+    windows = []
+    chunk_ids = {}
+    for item in results:
+        file_key = item.get("file_key")
+        window = range(max(item["chunk_id"] - expand, 0), item["chunk_id"] + expand + 1)
+        if file_key is not None:
+            chunk_ids.setdefault(file_key, set()).update(window)
+        windows.append(window)
+
+    if len(chunk_ids) == 0:
+        return results
+
+    maps, neighbours = await asyncio.gather(
+        mongo_db_engine.find_neighbour_maps(list(chunk_ids), chat_id),
+        mongo_db_engine.find_neighbours(
+            chat_id, {file_key: sorted(ids) for file_key, ids in chunk_ids.items()},
+            fields=NEIGHBOUR_FIELDS))
+    by_id = {(chunk["file_key"], chunk["chunk_id"]): chunk for chunk in neighbours}
+
+    for item, window in zip(results, windows):
+        file_key = item.get("file_key")
+        chunks = [by_id[(file_key, chunk_id)] for chunk_id in window
+                  if (file_key, chunk_id) in by_id]
+        if len(chunks) == 0:
+            continue
+
+        file_map = maps.get(file_key)
+        item["context"] = {"text": merge_window(chunks, file_map and file_map["overlap"]),
+                           "chunk_ids": [chunks[0]["chunk_id"], chunks[-1]["chunk_id"]],
+                           "page_number": window_pages(chunks, file_map)}
+
+    return results
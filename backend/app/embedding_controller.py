@@ -0,0 +1,158 @@
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+
+class AdaptiveBatchController():
+    """
+    Picks the embedding batch size and the number of batches in flight from
+    what the provider did with the previous batches:
+
+    - a batch answered faster than `target_latency` grows the next ones by
+      `batch_step` chunks, one slower than 1.5x the target shrinks them by a
+      quarter;
+    - batches are also cut at `max_batch_tokens` estimated tokens, estimated
+      from the characters of the chunks and the tokens-per-character ratio
+      reported by the provider's usage counts;
+    - every `2 * concurrency` successful batches without an error add one
+      slot of concurrency;
+    - a 413 halves the batch size and lowers the token cap below the payload
+      that failed, a 429 halves the concurrency and pauses new batches for
+      the Retry-After delay, other errors drop one slot.
+
+    Everything stays within the configured bounds. Each change is kept in
+    `decisions` and reported by `snapshot` for tuning.
+    """
+
+    def __init__(self, batch_size: int = 64, min_batch_size: int = 8,
+                 max_batch_size: int = 256, batch_step: int = 16,
+                 concurrency: int = 4, min_concurrency: int = 1,
+                 max_concurrency: int = 8, max_batch_tokens: int = 32000,
+                 target_latency: float = 2.0, chars_per_token: float = 4.0) -> None:
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.batch_step = batch_step
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+
+        self.batch_size = _clamp(batch_size, min_batch_size, max_batch_size)
+        self.concurrency = _clamp(concurrency, min_concurrency, max_concurrency)
+        self.max_batch_tokens = max_batch_tokens
+        self.tokens_per_char = 1 / chars_per_token
+        self.paused_until = 0.0
+
+        self.successes = 0
+        self.errors = 0
+        self.chunks = 0
+        self.tokens = 0
+        self.busy_seconds = 0.0
+        self.latency = None
+        self._since_change = 0
+        self.decisions = deque(maxlen=100)
+
+    def estimate_tokens(self, chunk: str) -> int:
+        return int(len(chunk) * self.tokens_per_char) + 1
+
+    def next_batch(self, chunks: List[str], start: int) -> int:
+        """End of the batch starting at `start`: at most `batch_size` chunks and `max_batch_tokens`"""
+        end = start
+        tokens = 0
+        while end < len(chunks) and end - start < self.batch_size:
+            tokens += self.estimate_tokens(chunks[end])
+            if tokens > self.max_batch_tokens and end > start:
+                break
+            end += 1
+        return end
+
+    def pause(self) -> float:
+        """Seconds to wait before sending the next batch"""
+        return max(self.paused_until - time.monotonic(), 0.0)
+
+    def record_success(self, batch: List[str], tokens: Optional[int], seconds: float) -> None:
+        self.successes += 1
+        self.chunks += len(batch)
+        self.busy_seconds += seconds
+        self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+
+        if tokens:
+            self.tokens += tokens
+            chars = sum(len(chunk) for chunk in batch) or 1
+            self.tokens_per_char = 0.8 * self.tokens_per_char + 0.2 * tokens / chars
+
+        if seconds > 1.5 * self.target_latency:
+            self._set(batch_size=int(self.batch_size * 0.75),
+                      reason=f"slow batch ({seconds:.2f}s)")
+        elif seconds < self.target_latency and len(batch) >= self.batch_size:
+            # only full batches say something about a bigger one
+            self._set(batch_size=self.batch_size + self.batch_step,
+                      reason=f"fast batch ({seconds:.2f}s)")
+
+        self._since_change += 1
+        if self._since_change >= 2 * self.concurrency:
+            self._set(concurrency=self.concurrency + 1, reason="no errors")
+
+    def record_error(self, status_code: Optional[int], batch: List[str],
+                     retry_after: Optional[float] = None) -> None:
+        self.errors += 1
+
+        # batches that were in flight together fail together, size the
+        # reductions on the failed batch so they do not compound
+        if status_code == 413:
+            tokens = sum(self.estimate_tokens(chunk) for chunk in batch)
+            self._set(batch_size=min(self.batch_size, len(batch) // 2),
+                      max_batch_tokens=min(self.max_batch_tokens, int(tokens * 0.8)),
+                      reason=f"413 at {len(batch)} chunks / ~{tokens} tokens")
+        elif status_code == 429:
+            delay = retry_after if retry_after is not None else min(2 ** self.errors, 30)
+            if self.pause() == 0:
+                self._set(concurrency=self.concurrency // 2,
+                          reason=f"429, pausing {delay:.1f}s")
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        else:
+            self._set(concurrency=self.concurrency - 1, reason=f"error {status_code}")
+
+        self._since_change = 0
+
+    def _set(self, reason: str, batch_size: int = None, concurrency: int = None,
+             max_batch_tokens: int = None) -> None:
+        batch_size = _clamp(self.batch_size if batch_size is None else batch_size,
+                            self.min_batch_size, self.max_batch_size)
+        concurrency = _clamp(self.concurrency if concurrency is None else concurrency,
+                             self.min_concurrency, self.max_concurrency)
+        max_batch_tokens = max(self.max_batch_tokens if max_batch_tokens is None
+                               else max_batch_tokens, 1)
+        if (batch_size, concurrency, max_batch_tokens) == \
+                (self.batch_size, self.concurrency, self.max_batch_tokens):
+            return
+
+        self.decisions.append({"time": time.time(),
+                               "batch_size": batch_size,
+                               "concurrency": concurrency,
+                               "max_batch_tokens": max_batch_tokens,
+                               "reason": reason})
+        print(f"Embedding batch_size {self.batch_size}->{batch_size}, "
+              f"concurrency {self.concurrency}->{concurrency}, "
+              f"max_batch_tokens {self.max_batch_tokens}->{max_batch_tokens}: {reason}")
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_batch_tokens = max_batch_tokens
+        self._since_change = 0
+
+    def snapshot(self) -> Dict:
+        return {"batch_size": self.batch_size,
+                "concurrency": self.concurrency,
+                "max_batch_tokens": self.max_batch_tokens,
+                "tokens_per_char": self.tokens_per_char,
+                "latency": self.latency,
+                "successes": self.successes,
+                "errors": self.errors,
+                "chunks": self.chunks,
+                "tokens": self.tokens,
+                # per request slot, multiply by concurrency for the ingest rate
+                "chunks_per_second": self.chunks / self.busy_seconds if self.busy_seconds else None,
+                "decisions": list(self.decisions)}
+
+
+def _clamp(value: int, lower: int, upper: int) -> int:
+    return max(lower, min(int(value), upper))
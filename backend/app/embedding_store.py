@@ -0,0 +1,480 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+import numpy as np
+
+from app.ann_index import IVFPQIndex
+
+VECTORS_FILE = "vectors.f32"
+META_FILE = "meta.jsonl"
+OFFSETS_FILE = "offsets.u64"
+FILE_IDS_FILE = "file_ids.u32"
+# bumped when the layout changes, older stores are rebuilt on first access
+LAYOUT_VERSION = 3
+MANIFEST_FILE = "manifest.json"
+
+# chunk fields kept next to the vectors, and the ones returned by search
+# (the same shape the Atlas $vectorSearch projection returns)
+META_FIELDS = ("text", "page_number", "chunk_id", "file_key", "file_name")
+RESULT_FIELDS = ("text", "page_number", "chunk_id")
+
+# IVF/PQ index of large stores: about this many rows per inverted list, at most
+# ANN_MAX_LISTS lists, and enough rows to train the 256-code PQ codebooks
+ANN_ROWS_PER_LIST = 256
+ANN_MAX_LISTS = 1024
+ANN_SUBVECTORS = 48
+ANN_BLOCK_ROWS = 65536
+
+
+class ChatEmbeddingStore():
+    """
+    One chat's embeddings on local disk:
+
+        vectors.f32    float32 matrix, one row per chunk
+        meta.jsonl     one JSON line of chunk metadata per row
+        offsets.u64    byte offset of each row's line in meta.jsonl
+        file_ids.u32   index into the manifest's file_keys, one per row
+        manifest.json  {"version", "build_id", "dim", "count", "meta_bytes",
+                        "file_keys", "chat_version", "validated_at"}
+        ann-<build_id>.npz  IVF/PQ index of the rows, see `search`
+
+    The manifest count is authoritative, so a crash mid-append only leaves
+    unreferenced bytes at the end of the data files. Files are memory-mapped
+    on first search and stay mapped while the process is warm.
+
+    The directory is shared by every process on the host: writes hold an
+    exclusive `fcntl` lock on `lock_path`, reads a shared one while they
+    load the manifest and map the files, and a manifest changed by another
+    process is picked up on the next search.
+    """
+
+    def __init__(self, chat_dir: str, lock_path: str, ann_min_rows: Optional[int] = None,
+                 nprobe: int = 16, rerank_size: int = 256) -> None:
+        self.chat_dir = chat_dir
+        self.lock_path = lock_path
+        self.ann_min_rows = ann_min_rows
+        self.nprobe = nprobe
+        self.rerank_size = rerank_size
+        self.manifest = None
+        self._signature = None
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._offsets = None
+        self._meta = None
+        self._file_ids = None
+        self._centroids = None
+        self._ann = None
+        self._ann_build_id = None
+
+    @property
+    def count(self) -> int:
+        return self.manifest["count"]
+
+    @property
+    def dim(self) -> int:
+        return self.manifest["dim"]
+
+    @property
+    def chat_version(self) -> Optional[int]:
+        """Version of the chat (see `AsyncMongoDB.bump_chat_version`) the rows are a snapshot of"""
+        return self.manifest.get("chat_version")
+
+    def is_stale(self, ttl: float) -> bool:
+        return time.time() - self.manifest["validated_at"] > ttl
+
+    def refresh(self) -> bool:
+        """Pick up changes made by other processes, False once the store was dropped"""
+        with self._lock, _file_lock(self.lock_path, exclusive=False):
+            return self._load(map_files=False)
+
+    def mark_validated(self, chat_version: int) -> None:
+        """Record that the store still matches `chat_version` of the chat"""
+        with self._lock, _file_lock(self.lock_path, exclusive=True):
+            manifest = _read_manifest(self.chat_dir)
+            if manifest is not None and manifest.get("chat_version") == chat_version:
+                manifest["validated_at"] = time.time()
+                self._commit(manifest)
+
+    def _load(self, map_files: bool = True) -> bool:
+        """Reload a changed manifest and map the files; holds the file lock"""
+        try:
+            signature = _signature(os.path.join(self.chat_dir, MANIFEST_FILE))
+        except FileNotFoundError:
+            return False
+
+        if signature != self._signature:
+            manifest = _read_manifest(self.chat_dir)
+            if manifest is None:
+                return False
+            if self.manifest is None or any(manifest.get(key) != self.manifest.get(key)
+                                            for key in ("build_id", "count")):
+                self._unmap()
+            self.manifest = manifest
+            self._signature = signature
+
+        if map_files and self._matrix is None and self.count > 0:
+            self._matrix = np.memmap(os.path.join(self.chat_dir, VECTORS_FILE),
+                                     dtype=np.float32, mode="r",
+                                     shape=(self.count, self.dim))
+            self._offsets = np.memmap(os.path.join(self.chat_dir, OFFSETS_FILE),
+                                      dtype=np.uint64, mode="r", shape=(self.count,))
+            # only the committed bytes: another process may append past them
+            self._meta = np.memmap(os.path.join(self.chat_dir, META_FILE),
+                                   dtype=np.uint8, mode="r",
+                                   shape=(self.manifest["meta_bytes"],))
+            self._file_ids = np.memmap(os.path.join(self.chat_dir, FILE_IDS_FILE),
+                                       dtype=np.uint32, mode="r", shape=(self.count,))
+        return True
+
+    def _open(self) -> bool:
+        """Map the files, False when there is nothing to search"""
+        with _file_lock(self.lock_path, exclusive=False):
+            self._load()
+        # a store dropped meanwhile is still served from files mapped before
+        return self._matrix is not None
+
+    def _unmap(self) -> None:
+        self._matrix = self._offsets = self._meta = None
+        self._file_ids = self._centroids = None
+
+    def _commit(self, manifest: Dict) -> None:
+        _write_manifest(self.chat_dir, manifest)
+        if self.manifest is None or any(manifest.get(key) != self.manifest.get(key)
+                                        for key in ("build_id", "count")):
+            self._unmap()
+        self.manifest = manifest
+        self._signature = _signature(os.path.join(self.chat_dir, MANIFEST_FILE))
+
+    def metadata(self, row: int) -> Dict:
+        start = int(self._offsets[row])
+        end = int(self._offsets[row + 1]) if row + 1 < self.count else None
+        line = self._meta[start:end].tobytes()
+        return json.loads(line.split(b"\n", 1)[0])
+
+    def search(self, query_vector: List[float], limit: int = 5,
+               file_keys: List[str] = None, keep_fields: List[str] = ()) -> List[Dict]:
+        """
+        Top-k by dot product, optionally over the rows of `file_keys` only.
+        Stores of at least `ann_min_rows` rows are searched over all files
+        through an IVF/PQ index, whose best `rerank_size` candidates are
+        re-scored exactly; the others are scored exactly. `keep_fields`
+        adds metadata fields or "embedding" to the results.
+        """
+        with self._lock:
+            if not self._open():
+                return []
+
+            query_vector = np.asarray(query_vector, dtype=np.float32)
+            if file_keys is None and self._uses_ann():
+                rows = self._ann_candidates(query_vector, limit)
+                scores = self._matrix[rows] @ query_vector
+            elif file_keys is None:
+                rows = None
+                scores = self._matrix @ query_vector
+            else:
+                rows = np.flatnonzero(np.isin(self._file_ids, self.file_ids(file_keys)))
+                scores = self._matrix[rows] @ query_vector
+
+            limit = min(limit, len(scores))
+            if limit == 0:
+                return []
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            top = top[np.argsort(-scores[top])]
+
+            results = []
+            for index in top:
+                row = int(index) if rows is None else int(rows[index])
+                metas = self.metadata(row)
+                item = {field: metas[field] for field in RESULT_FIELDS}
+                for field in keep_fields:
+                    item[field] = self._matrix[row].tolist() if field == "embedding" \
+                        else metas.get(field)
+                item["score"] = float(scores[index])
+                results.append(item)
+
+        return results
+
+    def _uses_ann(self) -> bool:
+        min_rows = max(self.ann_min_rows or 0, ANN_ROWS_PER_LIST)
+        return self.ann_min_rows is not None and self.count >= min_rows
+
+    def _ann_candidates(self, query_vector: np.ndarray, limit: int) -> np.ndarray:
+        ids, _ = self._ann_index().search(query_vector, k=max(limit, self.rerank_size))
+        # in file order, the exact scores read the memory-mapped rows sequentially
+        return np.sort(np.asarray(ids, dtype=np.int64))
+
+    def _ann_index(self) -> IVFPQIndex:
+        """
+        The rows' IVF/PQ index: loaded from the chat directory, or trained on
+        first use and saved there for the other processes. Rows appended
+        since are encoded with the same codebooks.
+        """
+        build_id = self.manifest["build_id"]
+        if self._ann is None or self._ann_build_id != build_id:
+            file_path = os.path.join(self.chat_dir, f"ann-{build_id}.npz")
+            try:
+                self._ann = IVFPQIndex.load(file_path)
+            except FileNotFoundError:
+                self._ann = self._train_ann(file_path)
+            self._ann_build_id = build_id
+
+        for start in range(len(self._ann), self.count, ANN_BLOCK_ROWS):
+            end = min(start + ANN_BLOCK_ROWS, self.count)
+            self._ann.add(self._matrix[start:end], ids=list(range(start, end)))
+        return self._ann
+
+    def _train_ann(self, file_path: str) -> IVFPQIndex:
+        n_subvectors = next(n for n in range(min(ANN_SUBVECTORS, self.dim), 0, -1)
+                            if self.dim % n == 0)
+        index = IVFPQIndex(dim=self.dim, n_subvectors=n_subvectors,
+                           n_lists=min(ANN_MAX_LISTS, self.count // ANN_ROWS_PER_LIST),
+                           nprobe=self.nprobe, rerank_size=self.rerank_size,
+                           keep_vectors=False)
+        index.train(self._matrix, n_iter=10)
+        for start in range(0, self.count, ANN_BLOCK_ROWS):
+            end = min(start + ANN_BLOCK_ROWS, self.count)
+            index.add(self._matrix[start:end], ids=list(range(start, end)))
+
+        tmp_path = f"{file_path}.tmp-{uuid4().hex}.npz"
+        try:
+            index.save(tmp_path)
+            os.replace(tmp_path, file_path)
+        except OSError:
+            # e.g. the directory was replaced by a rebuild meanwhile, whose store trains its own
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+        return index
+
+    def file_ids(self, file_keys: List[str]) -> List[int]:
+        known = self.manifest["file_keys"]
+        return [known.index(file_key) for file_key in file_keys if file_key in known]
+
+    def rank_files(self, query_vector: List[float], limit: int = 3) -> List[str]:
+        """File keys whose summary vector scores highest against the query"""
+        with self._lock:
+            if not self._open():
+                return []
+
+            if self._centroids is None:
+                sums = np.zeros((len(self.manifest["file_keys"]), self.dim), dtype=np.float32)
+                np.add.at(sums, np.asarray(self._file_ids), self._matrix)
+                norms = np.linalg.norm(sums, axis=1, keepdims=True)
+                self._centroids = sums / np.maximum(norms, 1e-12)
+
+            scores = self._centroids @ np.asarray(query_vector, dtype=np.float32)
+            top = np.argsort(-scores)[:limit]
+            return [self.manifest["file_keys"][file_id] for file_id in top]
+
+    def append(self, chunks: List[Dict], from_version: int, to_version: int) -> bool:
+        """
+        Append the chunks of the change that moved the chat from
+        `from_version` to `to_version`. Refused (False) when the store on
+        disk is not a snapshot of `from_version`, e.g. another process
+        rebuilt or extended it meanwhile.
+        """
+        with self._lock, _file_lock(self.lock_path, exclusive=True):
+            manifest = _read_manifest(self.chat_dir)
+            if manifest is None or manifest.get("chat_version") != from_version:
+                return False
+
+            _append_rows(self.chat_dir, chunks, manifest)
+            manifest["chat_version"] = to_version
+            self._commit(manifest)
+        return True
+
+
+def summary_vector(embeddings) -> List[float]:
+    """Document-level vector of a file: the normalized mean of its chunk embeddings"""
+    mean = np.asarray(embeddings, dtype=np.float32).mean(axis=0)
+    return (mean / max(float(np.linalg.norm(mean)), 1e-12)).tolist()
+
+
+class EmbeddingStore():
+    """
+    Per-chat local stores under `root_dir`, kept open across invocations and
+    shared by the processes of the host (see `ChatEmbeddingStore`)
+    """
+
+    def __init__(self, root_dir: str, dim: int = 768, ann_min_rows: Optional[int] = None,
+                 nprobe: int = 16, rerank_size: int = 256) -> None:
+        self.root_dir = root_dir
+        self.dim = dim
+        # search options of the chat stores, see `ChatEmbeddingStore.search`
+        self.ann_options = {"ann_min_rows": ann_min_rows, "nprobe": nprobe,
+                            "rerank_size": rerank_size}
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def chat_dir(self, chat_id: str) -> str:
+        # named by a hash: chat ids come from requests, "..", "." or "a/b" must not
+        # name (and let build / drop remove) anything but this chat's store
+        return os.path.join(self.root_dir, _store_name(chat_id))
+
+    def lock_path(self, chat_id: str) -> str:
+        # next to the chat directory, which is replaced as a whole on rebuild
+        return os.path.join(self.root_dir, f"{_store_name(chat_id)}.lock")
+
+    def open(self, chat_id: str) -> Optional[ChatEmbeddingStore]:
+        with self._lock:
+            store = self._stores.get(chat_id)
+            if store is None:
+                if not os.path.exists(os.path.join(self.chat_dir(chat_id), MANIFEST_FILE)):
+                    return None
+                store = ChatEmbeddingStore(self.chat_dir(chat_id), self.lock_path(chat_id),
+                                           **self.ann_options)
+
+        if not store.refresh() or store.manifest.get("version") != LAYOUT_VERSION:
+            with self._lock:
+                if self._stores.get(chat_id) is store:
+                    del self._stores[chat_id]
+            return None
+
+        with self._lock:
+            return self._stores.setdefault(chat_id, store)
+
+    def build(self, chat_id: str, chunks: List[Dict],
+              chat_version: int = None) -> ChatEmbeddingStore:
+        """
+        (Re)write a chat's store from its chunks, a snapshot of `chat_version`
+        of the chat (None when unknown: the store is rebuilt on next validation),
+        replacing any old copy
+        """
+        os.makedirs(self.root_dir, exist_ok=True)
+        tmp_dir = f"{self.chat_dir(chat_id)}.tmp-{uuid4().hex}"
+        os.makedirs(tmp_dir)
+        manifest = {"version": LAYOUT_VERSION,
+                    "build_id": uuid4().hex,
+                    "dim": len(chunks[0]["embedding"]) if chunks else self.dim,
+                    "count": 0, "meta_bytes": 0, "file_keys": [],
+                    "chat_version": chat_version,
+                    "validated_at": time.time()}
+        _append_rows(tmp_dir, chunks, manifest)
+        _write_manifest(tmp_dir, manifest)
+
+        with self._lock, _file_lock(self.lock_path(chat_id), exclusive=True):
+            self._stores.pop(chat_id, None)
+            # already mapped files stay readable after the directory is removed
+            shutil.rmtree(self.chat_dir(chat_id), ignore_errors=True)
+            os.rename(tmp_dir, self.chat_dir(chat_id))
+
+        return self.open(chat_id)
+
+    def append(self, chat_id: str, chunks: List[Dict], from_version: int,
+               to_version: int) -> bool:
+        """
+        Append to an existing store, see `ChatEmbeddingStore.append`. False
+        when there is no store (chats without one are built on next search)
+        or it is not at `from_version`.
+        """
+        store = self.open(chat_id)
+        return store is not None and store.append(chunks, from_version, to_version)
+
+    def drop(self, chat_id: str) -> None:
+        if not os.path.exists(self.root_dir):
+            return
+        with self._lock, _file_lock(self.lock_path(chat_id), exclusive=True):
+            self._stores.pop(chat_id, None)
+            shutil.rmtree(self.chat_dir(chat_id), ignore_errors=True)
+
+
+def _append_rows(chat_dir: str, chunks: List[Dict], manifest: Dict) -> None:
+    """
+    Append rows after the manifest's `count` ones; updates its count,
+    meta_bytes and file_keys, the caller writes it
+    """
+    vectors_path = os.path.join(chat_dir, VECTORS_FILE)
+    meta_path = os.path.join(chat_dir, META_FILE)
+    offsets_path = os.path.join(chat_dir, OFFSETS_FILE)
+    file_ids_path = os.path.join(chat_dir, FILE_IDS_FILE)
+
+    if len(chunks) == 0:
+        for path in (vectors_path, meta_path, offsets_path, file_ids_path):
+            open(path, "ab").close()
+        return
+
+    # drop bytes left behind by an interrupted append
+    count = manifest["count"]
+    if os.path.exists(vectors_path):
+        os.truncate(vectors_path, count * 4 * manifest["dim"])
+        os.truncate(offsets_path, count * 8)
+        os.truncate(file_ids_path, count * 4)
+        os.truncate(meta_path, manifest["meta_bytes"])
+
+    vectors = np.asarray([chunk["embedding"] for chunk in chunks], dtype=np.float32)
+    with open(vectors_path, "ab") as f:
+        f.write(vectors.tobytes())
+
+    offsets = []
+    position = manifest["meta_bytes"]
+    with open(meta_path, "ab") as f:
+        for chunk in chunks:
+            line = json.dumps({field: chunk.get(field) for field in META_FIELDS},
+                              ensure_ascii=False).encode("utf-8") + b"\n"
+            offsets.append(position)
+            f.write(line)
+            position += len(line)
+
+    with open(offsets_path, "ab") as f:
+        f.write(np.asarray(offsets, dtype=np.uint64).tobytes())
+
+    file_keys = manifest["file_keys"]
+    positions = {file_key: file_id for file_id, file_key in enumerate(file_keys)}
+    file_ids = []
+    for chunk in chunks:
+        if chunk.get("file_key") not in positions:
+            positions[chunk.get("file_key")] = len(file_keys)
+            file_keys.append(chunk.get("file_key"))
+        file_ids.append(positions[chunk.get("file_key")])
+    with open(file_ids_path, "ab") as f:
+        f.write(np.asarray(file_ids, dtype=np.uint32).tobytes())
+
+    manifest["count"] = count + len(chunks)
+    manifest["meta_bytes"] = position
+
+
+def _store_name(chat_id: str) -> str:
+    return hashlib.sha256(chat_id.encode("utf-8")).hexdigest()
+
+
+def _write_manifest(chat_dir: str, manifest: Dict) -> None:
+    tmp_path = os.path.join(chat_dir, f"{MANIFEST_FILE}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(chat_dir, MANIFEST_FILE))
+
+
+def _read_json(file_path: str) -> Dict:
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def _read_manifest(chat_dir: str) -> Optional[Dict]:
+    try:
+        return _read_json(os.path.join(chat_dir, MANIFEST_FILE))
+    except FileNotFoundError:
+        return None
+
+
+def _signature(file_path: str):
+    # the manifest is replaced, never rewritten in place
+    stat = os.stat(file_path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+@contextlib.contextmanager
+def _file_lock(lock_path: str, exclusive: bool):
+    """Lock shared by the processes of the host (and the threads of this one)"""
+    with open(lock_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
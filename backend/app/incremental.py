@@ -0,0 +1,69 @@
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from . import pdf_utils
+
+# fields of a stored chunk that depend on its position in the document
+POSITION_FIELDS = ("chunk_id", "page_number", "word_size", "file_name")
+
+
+def diff_chunks(chunk_metas: List[Dict],
+                stored_chunks: List[Dict]) -> Tuple[List[Dict], List[Tuple], List]:
+    """
+    Match freshly parsed chunks against the chunks already stored for the
+    same file by content hash.
+
+    Returns
+        new_chunks: chunks whose text is not stored yet and must be embedded
+        moved: (stored _id, changed fields) for reused chunks whose position changed
+        removed_ids: _ids of stored chunks that no longer exist in the document
+    """
+    matcher = ChunkMatcher(stored_chunks)
+    new_chunks, moved = matcher.match(chunk_metas)
+
+    return new_chunks, moved, matcher.remaining_ids()
+
+
+class ChunkMatcher():
+    """
+    Pool of stored chunks that freshly parsed chunks are matched against,
+    possibly over several calls when a document is ingested in segments.
+    Every stored chunk is reused at most once.
+    """
+
+    def __init__(self, stored_chunks: List[Dict]) -> None:
+        self.stored_by_hash = defaultdict(list)
+        for item in stored_chunks:
+            hash_value = item.get("content_hash") or pdf_utils.content_hash(item["text"])
+            self.stored_by_hash[hash_value].append(item)
+
+    def match(self, chunk_metas: List[Dict],
+              claim: Dict = None) -> Tuple[List[Dict], List[Tuple]]:
+        """
+        Returns the chunks to embed and the (stored _id, fields to set)
+        updates. With `claim`, every reused chunk gets those fields set too,
+        even when its position did not change.
+        """
+        new_chunks = []
+        moved = []
+        for metas in chunk_metas:
+            candidates = self.stored_by_hash.get(metas["content_hash"])
+            if not candidates:
+                new_chunks.append(metas)
+                continue
+
+            stored = candidates.pop()
+            changed = {field: metas[field] for field in POSITION_FIELDS
+                       if stored.get(field) != metas[field]}
+            if "content_hash" not in stored:
+                changed["content_hash"] = metas["content_hash"]
+            if claim:
+                changed.update(claim)
+            if changed:
+                moved.append((stored["_id"], changed))
+
+        return new_chunks, moved
+
+    def remaining_ids(self) -> List:
+        return [item["_id"]
+                for items in self.stored_by_hash.values() for item in items]
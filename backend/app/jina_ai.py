@@ -1,71 +1,211 @@
-import requests
-from typing import List, Tuple
+import asyncio
+import time
+import httpx
+from collections import deque
+from typing import List, Optional, Tuple
 
-class JinaAI:
-    def __init__(self, api_key: str):
+from app.embedding_controller import AdaptiveBatchController
+from app.shared_cache import SharedEmbeddingCache
+from app.single_flight import SingleFlight
+
+EMBEDDINGS_URL = 'https://api.jina.ai/v1/embeddings'
+RERANK_URL = "https://api.jina.ai/v1/rerank"
+EMBEDDING_MODEL = 'jina-embeddings-v2-base-en'
+RERANK_MODEL = "jina-reranker-v1-base-en"
+
+
+class AsyncJinaAI:
+    """
+    Jina embeddings and reranking on one pooled `httpx.AsyncClient`, started
+    on first use. Call `close` on shutdown.
+
+    With a `shared_cache`, single-text (query) embeddings are shared across
+    the serving workers.
+
+    With a `controller`, batch sizes and the number of batches in flight
+    are adapted at runtime (see `AdaptiveBatchController`), and batches
+    rejected with 413 / 429 / 5xx are retried up to `max_retries` times.
+    """
+
+    def __init__(self, api_key: str, max_connections: int = 100,
+                 max_keepalive_connections: int = 20, timeout: float = 30.0,
+                 concurrency: int = 4, batch_size: int = 64,
+                 controller: Optional[AdaptiveBatchController] = None,
+                 max_retries: int = 5, model: str = EMBEDDING_MODEL,
+                 shared_cache: Optional[SharedEmbeddingCache] = None):
         self.api_key = api_key
         self.headers = {
             'Content-Type': 'application/json',
             'Authorization': f'Bearer {api_key}'
         }
-        
-    def get_embeddings(self, chunks: List[str]) -> List[List[float]]:
-        """Generate embeddings for text chunks"""
-        url = 'https://api.jina.ai/v1/embeddings'
-        
-        data = {
-            'input': chunks,
-            'model': 'jina-embeddings-v2-base-en'
-        }
-        
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive_connections)
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.controller = controller
+        self.max_retries = max_retries
+        self.model = model
+        self.shared_cache = shared_cache
+        self.client = None
+        # identical concurrent get_embeddings inputs (the same query) share one request
+        self.single_flight = SingleFlight()
+
+    async def start(self) -> None:
+        if self.client is None:
+            self.client = httpx.AsyncClient(headers=self.headers, limits=self.limits,
+                                            timeout=self.timeout)
+
+    async def close(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def _post(self, url: str, data: dict) -> dict:
+        await self.start()
+        response = await self.client.post(url, json=data)
+        response.raise_for_status()
+        return response.json()
+
+    async def get_embeddings(self, chunks: List[str]) -> List[List[float]]:
+        """Generate embeddings for text chunks; concurrent identical calls share one request"""
+        # single texts are queries, caching ingestion batches would only evict them
+        cacheable = self.shared_cache is not None and len(chunks) == 1
+        if cacheable:
+            cached = self.shared_cache.get(self.model, chunks[0])
+            if cached is not None:
+                return [cached]
+
+        embeddings, _ = await self.single_flight.do(tuple(chunks), self._embed, chunks)
+        if cacheable:
+            self.shared_cache.put(self.model, chunks[0], embeddings[0])
+        return embeddings
+
+    async def _embed(self, chunks: List[str]) -> Tuple[List[List[float]], Optional[int]]:
+        # embeddings and the number of tokens billed for them
         try:
-            response = requests.post(url, headers=self.headers, json=data)
-            response.raise_for_status()  # Raise exception for bad status codes
-            
-            return [item['embedding'] for item in response.json()['data']]
-            
+            result = await self._post(EMBEDDINGS_URL, {'input': chunks,
+                                                       'model': self.model})
+            tokens = result.get('usage', {}).get('total_tokens')
+            return [item['embedding'] for item in result['data']], tokens
+
         except Exception as e:
             print(f"Error generating embeddings: {str(e)}")
             raise
-            
-    def rerank(self, query: str, chunks: List[str], top_n: int = 5) -> Tuple[List[int], List[float]]:
+
+    async def get_embeddings_in_batches(self, chunks: List[str], batch_size: int = None) -> List[List[float]]:
+        """
+        Generate embeddings for text chunks, up to `concurrency` batches in
+        flight. Without `batch_size` the controller, if any, sizes the batches.
+        """
+        if batch_size is None and self.controller is not None:
+            return await self._get_embeddings_adaptive(chunks)
+        batch_size = batch_size or self.batch_size
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def embed(batch):
+            async with semaphore:
+                return await self.get_embeddings(batch)
+
+        batches = await asyncio.gather(*[embed(chunks[start:start+batch_size])
+                                         for start in range(0, len(chunks), batch_size)])
+        return [embedding for batch in batches for embedding in batch]
+
+    async def _get_embeddings_adaptive(self, chunks: List[str]) -> List[List[float]]:
+        controller = self.controller
+        embeddings = [None] * len(chunks)
+        retries = deque()  # (start, end, attempts) of failed batches
+        cursor = 0
+        in_flight = 0
+        changed = asyncio.Condition()
+
+        def has_work():
+            return bool(retries) or cursor < len(chunks)
+
+        def can_send():
+            # idle workers also wake up to exit once everything is embedded
+            return ((in_flight < controller.concurrency and has_work())
+                    or (in_flight == 0 and not has_work()))
+
+        async def worker():
+            nonlocal cursor, in_flight
+            while True:
+                async with changed:
+                    await changed.wait_for(can_send)
+                    if not has_work():
+                        return
+                    if retries:
+                        start, end, attempts = retries.popleft()
+                    else:
+                        start, end, attempts = cursor, controller.next_batch(chunks, cursor), 0
+                        cursor = end
+                    in_flight += 1
+
+                try:
+                    await asyncio.sleep(controller.pause())
+                    batch = chunks[start:end]
+                    started = time.monotonic()
+                    try:
+                        batch_embeddings, tokens = await self._embed(batch)
+                    except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                        status_code, retry_after = _error_details(e)
+                        controller.record_error(status_code, batch, retry_after)
+                        retryable = status_code in (None, 413, 429) or status_code >= 500
+                        if not retryable or attempts >= self.max_retries \
+                                or (status_code == 413 and len(batch) == 1):
+                            raise
+
+                        middle = (start + end) // 2
+                        if status_code == 413:
+                            retries.extend([(start, middle, attempts + 1), (middle, end, attempts + 1)])
+                        else:
+                            retries.append((start, end, attempts + 1))
+                        continue
+
+                    controller.record_success(batch, tokens, time.monotonic() - started)
+                    embeddings[start:end] = batch_embeddings
+                finally:
+                    async with changed:
+                        in_flight -= 1
+                        changed.notify_all()
+
+        workers = [asyncio.create_task(worker()) for _ in range(controller.max_concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            raise
+
+        return embeddings
+
+    async def rerank(self, query: str, chunks: List[str], top_n: int = 5) -> Tuple[List[int], List[float]]:
         """Rerank chunks based on relevance to query"""
-        url = "https://api.jina.ai/v1/rerank"
-        
-        data = {
-            "model": "jina-reranker-v1-base-en",
-            "query": query,
-            "documents": chunks,
-            "top_n": top_n
-        }
-        
         try:
-            response = requests.post(url, headers=self.headers, json=data)
-            response.raise_for_status()
-            
-            results = response.json()['results']
+            result = await self._post(RERANK_URL, {"model": RERANK_MODEL,
+                                                   "query": query,
+                                                   "documents": chunks,
+                                                   "top_n": top_n})
+            results = result['results']
             indices = [r['index'] for r in results]
             scores = [r['relevance_score'] for r in results]
-            
+
             return indices, scores
-            
+
         except Exception as e:
             print(f"Error reranking documents: {str(e)}")
             raise
 
-    def test_connection(self) -> bool:
-        """Test if the Jina AI connection is working"""
-        try:
-            # Test embeddings
-            test_chunks = ["Test sentence."]
-            embeddings = self.get_embeddings(test_chunks)
-            
-            # Test reranking
-            test_query = "test"
-            indices, scores = self.rerank(test_query, test_chunks)
-            
-            return True
-            
-        except Exception as e:
-            print(f"Connection test failed: {str(e)}")
-            return False
\ No newline at end of file
+
+def _error_details(error: Exception) -> Tuple[Optional[int], Optional[float]]:
+    """HTTP status code (None for connection errors / timeouts) and Retry-After seconds"""
+    if not isinstance(error, httpx.HTTPStatusError):
+        return None, None
+
+    retry_after = error.response.headers.get("retry-after")
+    try:
+        retry_after = float(retry_after) if retry_after is not None else None
+    except ValueError:
+        retry_after = None
+    return error.response.status_code, retry_after
@@ -1,169 +1,587 @@
-from typing import Dict, List
-from pymongo import MongoClient
+import hashlib
+from typing import Dict, List, Union
+from app.config import config
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteMany, InsertOne, ReplaceOne, ReturnDocument, UpdateOne
 
 DB_NAME = "RAG"
 FILE_COLLECTION = "UploadedFile"
 EMBEDDING_COLLECTION = "Embedding"
+CHECKPOINT_COLLECTION = "IngestCheckpoint"
+REEMBED_COLLECTION = "ReembedJob"
+CHAT_ACTIVITY_COLLECTION = "ChatActivity"
+CHAT_VERSION_COLLECTION = "ChatVersion"
 
 
-class MongoDB():
+def chunk_collection(chat_id: str) -> str:
+    """
+    Collection holding the chunks of `chat_id`. With `config.chat_partitions`
+    > 1, chats are spread over Embedding_000, Embedding_001, ... by a stable
+    hash of the chat id, or of its tenant (the part before
+    `config.tenant_separator`) with `config.partition_by_tenant`, so every
+    query only touches the indexes of its own partition.
+    """
+    if config.chat_partitions <= 1:
+        return EMBEDDING_COLLECTION
 
-    def __init__(self, mongodb_url) -> None:
-        self.client = MongoClient(mongodb_url)
-        self.db_name = DB_NAME
-        self.db = self.client[self.db_name]
+    key = chat_id.split(config.tenant_separator, 1)[0] if config.partition_by_tenant else chat_id
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return f"{EMBEDDING_COLLECTION}_{int.from_bytes(digest, 'little') % config.chat_partitions:03d}"
 
-    def file_exist(self, file_name: str) -> bool:
-        collection = self.db[FILE_COLLECTION]
-        results = collection.find_one({"file_name": file_name})
-        return results is not None
 
-    def insert_file(self, file_name: str, file_key, full_text: str) -> None:
-        # if not self.file_exist(file_name):
-        collection = self.db[FILE_COLLECTION]
+def chunk_collections() -> List[str]:
+    if config.chat_partitions <= 1:
+        return [EMBEDDING_COLLECTION]
+    return [f"{EMBEDDING_COLLECTION}_{bucket:03d}" for bucket in range(config.chat_partitions)]
 
-        if file_key.startswith('/'):
-            file_key = file_key[1:]
 
-        result = collection.insert_one(
-            {'file_name': file_name,
-             'file_key': file_key,
-             "file_url": f"https://d3ise5tbc77djz.cloudfront.net/{file_key}",
-             'full_text': full_text}
-        )
-        return result
-
-    def insert_embedding(self, embeddings) -> List:
-        # if not self.file_exist(file_name):
-        collection = self.db[EMBEDDING_COLLECTION]
-        collection.insert_many(embeddings)
-
-    def vector_search(self, query_vector: List[float],
-                      chat_id: str, limit: int = 5) -> List[Dict]:
-
-        # create a vector search index
-        # {
-        #   "fields": [
-        #     {
-        #       "numDimensions": 768,
-        #       "path": "embedding",
-        #       "similarity": "dotProduct",
-        #       "type": "vector"
-        #     },
-        #     {
-        #       "path": "file_key",
-        #       "type": "filter"
-        #     },
-        #     {
-        #       "path": "chat_id",
-        #       "type": "filter"
-        #     }
-        #   ]
-        # }
-
-        results = self.db[EMBEDDING_COLLECTION].aggregate([
-            {
+def summary_field(embedding_field: str = None) -> str:
+    """UploadedFile field holding the file summaries of a chunk embedding field"""
+    return "summary_" + (embedding_field or config.embedding_field)
 
-                "$vectorSearch": {
-                    "index": "vector_index",
-                    "path": "embedding",
-                    "queryVector": query_vector,
-                    "numCandidates": limit,
-                    "limit": limit,
-                    "filter": {"chat_id": {"$eq": chat_id}}
-                }
 
-            },
-            {
+def file_record(file_name: str, file_key: str, full_text: str,
+                chat_id: str = None, summary_embedding: List[float] = None,
+                neighbour_map: Dict = None) -> Dict:
+    if file_key.startswith('/'):
+        file_key = file_key[1:]
 
-                '$project': {
-                    'embedding': 0,
-                    "_id": 0,
-                    "chat_id": 0,
-                    "word_size": 0,
-                    "file_key": 0,
-                    "file_name": 0,
-                    "score": {"$meta": "vectorSearchScore"},
-                }
+    record = {'file_name': file_name,
+              'file_key': file_key,
+              "file_url": f"https://d3ise5tbc77djz.cloudfront.net/{file_key}",
+              'full_text': full_text}
+    if chat_id is not None:
+        record['chat_id'] = chat_id
+    if summary_embedding is not None:
+        # mean of the file's chunk embeddings, used to route queries to files
+        record[summary_field()] = summary_embedding
+    if neighbour_map is not None:
+        # page range and overlap of every chunk of the file, see context.py
+        record['neighbour_map'] = neighbour_map
+    return record
 
-            }
 
-        ])
+def group_by_chat(chunks: List[Dict]) -> Dict[str, List[Dict]]:
+    groups = {}
+    for chunk in chunks:
+        groups.setdefault(chunk.get("chat_id"), []).append(chunk)
+    return groups
 
-        return list(results)
 
-    def keyword_search(self, query: str, chat_id: str, limit: int = 5) -> List[Dict]:
-        """
-        [
+def mirror_embedding(chunks: List[Dict]) -> List[Dict]:
+    """
+    Once searches read a re-embedded field (`config.embedding_field`), new
+    chunks, embedded with the new model, carry their vector in it too.
+    """
+    if config.embedding_field != "embedding":
+        for chunk in chunks:
+            if "embedding" in chunk:
+                chunk[config.embedding_field] = chunk["embedding"]
+    return chunks
+
+
+def hidden_fields(keep_fields: List[str] = ()) -> Dict:
+    """Search result projection: drop the vectors and bookkeeping fields"""
+    projection = {field: 0 for field in ("_id", "chat_id", "word_size", "file_key",
+                                         "file_name", "content_hash", "ingest_id")
+                  if field not in keep_fields}
+    # a kept "embedding" is the searched vector, see `searched_embedding`
+    projection.update({field: 0 for field in config.embedding_fields
+                       if field != "embedding" or field not in keep_fields})
+    return projection
+
+
+def searched_embedding(keep_fields: List[str] = ()) -> List[Dict]:
+    # stages returning the searched vector as "embedding" when it is kept
+    if "embedding" not in keep_fields or config.embedding_field == "embedding":
+        return []
+    return [{"$set": {"embedding": f"${config.embedding_field}"}}]
+
+
+def array_prefix(field_path: str, length: int = None) -> Union[str, Dict]:
+    """Aggregation expression of the first `length` items of an array field (all by default)"""
+    if length is None:
+        return field_path
+    if length == 0:
+        return {"$literal": []}
+    return {"$slice": [field_path, length]}
+
+
+def file_filter(file_key: Union[str, Dict], chat_id: str = None) -> Dict:
+    """
+    UploadedFile query of a file (or of a condition on file_key): with
+    `chat_id`, the chat's own record (or one recorded before records
+    carried a chat id), not another chat's copy
+    """
+    query = {"file_key": file_key}
+    if chat_id is not None:
+        query["chat_id"] = {"$in": [chat_id, None]}
+    return query
+
+
+def file_record_operations(records: List[Dict]) -> List:
+    # a chat imported under another chat_id gets its own copies of the records
+    return [ReplaceOne({"chat_id": record.get("chat_id"), "file_key": record["file_key"]},
+                       record, upsert=True)
+            for record in records]
+
+
+def chunk_operations(new_chunks: List[Dict], moved: List,
+                     removed_ids: List) -> List:
+    operations = [InsertOne(chunk) for chunk in mirror_embedding(new_chunks)]
+    operations += [UpdateOne({"_id": _id}, {"$set": fields})
+                   for _id, fields in moved]
+    if removed_ids:
+        operations.append(DeleteMany({"_id": {"$in": removed_ids}}))
+    return operations
+
+
+def vector_search_pipeline(query_vector: List[float],
+                           chat_id: str, limit: int = 5,
+                           file_keys: List[str] = None,
+                           keep_fields: List[str] = ()) -> List[Dict]:
+    """`keep_fields` are returned too, e.g. "file_key" / "embedding" for post-processing"""
+
+    # create a vector search index
+    # {
+    #   "fields": [
+    #     {
+    #       "numDimensions": 768,
+    #       "path": "embedding",
+    #       "similarity": "dotProduct",
+    #       "type": "vector"
+    #     },
+    #     {
+    #       "path": "file_key",
+    #       "type": "filter"
+    #     },
+    #     {
+    #       "path": "chat_id",
+    #       "type": "filter"
+    #     }
+    #   ]
+    # }
+
+    search_filter = {"chat_id": {"$eq": chat_id}}
+    if file_keys is not None:
+        search_filter["file_key"] = {"$in": file_keys}
+
+    return [
         {
-            $search: {
-            index: "default",
-            compound: {
-                filter: [
-                {
-                    equals: {
-                    value: "6c718ece-1949-4db8-865c-54743e05f6cd",
-                    path: "chat_id"
-                    }
-                }
-                ],
-                should: [
-                {
-                    text: {
-                    query: "How much is the range of Inflation Protected ?",
-                    path: "text"
-                    }
-                }
-                ]
+
+            "$vectorSearch": {
+                "index": config.vector_index,
+                "path": config.embedding_field,
+                "queryVector": query_vector,
+                "numCandidates": min(limit * config.num_candidates_factor, 10000),
+                "limit": limit,
+                "filter": search_filter
             }
+
+        },
+        *searched_embedding(keep_fields),
+        {
+
+            '$project': {
+                **hidden_fields(keep_fields),
+                "score": {"$meta": "vectorSearchScore"},
             }
+
         }
-        ]
-        """
 
-        search_query = [
+    ]
+
+
+def keyword_search_pipeline(query: str, chat_id: str, limit: int = 5,
+                            file_keys: List[str] = None,
+                            keep_fields: List[str] = ()) -> List[Dict]:
+    """
+    [
+    {
+        $search: {
+        index: "default",
+        compound: {
+            filter: [
+            {
+                equals: {
+                value: "6c718ece-1949-4db8-865c-54743e05f6cd",
+                path: "chat_id"
+                }
+            }
+            ],
+            should: [
             {
-                '$search': {
-                    'index': 'default',
-                    'compound': {
-                        'filter': [
-                            {
-                                'text': {
-                                    'query': chat_id,
-                                    'path': 'chat_id'
-                                }
+                text: {
+                query: "How much is the range of Inflation Protected ?",
+                path: "text"
+                }
+            }
+            ]
+        }
+        }
+    }
+    ]
+    """
+
+    search_query = [
+        {
+            '$search': {
+                'index': 'default',
+                'compound': {
+                    'filter': [
+                        {
+                            'text': {
+                                'query': chat_id,
+                                'path': 'chat_id'
                             }
-                        ],
-                        'must': [
-                            {
-                                'text': {
-                                    'query': query,
-                                    'path': 'text'
-                                }
+                        }
+                    ],
+                    'must': [
+                        {
+                            'text': {
+                                'query': query,
+                                'path': 'text'
                             }
-                        ]
-                    }
-                }
-            }, {
-                '$addFields': {
-                    'score': {
-                        '$meta': 'searchScore'
-                    }
+                        }
+                    ]
                 }
-            }, {
-                '$project': {
-                    'embedding': 0,
-                    "_id": 0,
-                    "word_size": 0,
-                    "chat_id": 0,
-                    "file_key": 0,
-                    "file_name": 0,
+            }
+        }, {
+            '$addFields': {
+                'score': {
+                    '$meta': 'searchScore'
                 }
-            }, {
-                '$limit': limit
             }
-        ]
+        },
+        *searched_embedding(keep_fields),
+        {
+            '$project': hidden_fields(keep_fields)
+        }, {
+            '$limit': limit
+        }
+    ]
 
-        results = list(self.db[EMBEDDING_COLLECTION].aggregate(search_query))
+    if file_keys is not None:
+        # needs `file_key` mapped as a "token" field in the search index
+        search_query[0]['$search']['compound']['filter'].append(
+            {'in': {'path': 'file_key', 'value': file_keys}})
+
+    return search_query
+
+
+def file_search_pipeline(query_vector: List[float], chat_id: str,
+                         limit: int = 3) -> List[Dict]:
+
+    # create a vector search index named "file_vector_index" on UploadedFile
+    # {
+    #   "fields": [
+    #     {
+    #       "numDimensions": 768,
+    #       "path": "summary_embedding",
+    #       "similarity": "dotProduct",
+    #       "type": "vector"
+    #     },
+    #     {
+    #       "path": "chat_id",
+    #       "type": "filter"
+    #     }
+    #   ]
+    # }
+
+    return [
+        {
+            "$vectorSearch": {
+                "index": config.file_vector_index,
+                "path": summary_field(),
+                "queryVector": query_vector,
+                "numCandidates": min(limit * config.num_candidates_factor, 10000),
+                "limit": limit,
+                "filter": {"chat_id": {"$eq": chat_id}}
+            }
+        },
+        {
+            '$project': {
+                "_id": 0,
+                "file_key": 1,
+                "score": {"$meta": "vectorSearchScore"},
+            }
+        }
+    ]
+
+
+class AsyncMongoDB():
+    """
+    Chat, file and ingestion storage on motor, with the records and
+    aggregation pipelines built by the functions above. The client is
+    pooled and lazily bound to the running event loop on first use.
+    """
+
+    def __init__(self, mongodb_url) -> None:
+        self.client = AsyncIOMotorClient(
+            mongodb_url,
+            maxPoolSize=config.mongo_max_pool_size,
+            minPoolSize=config.mongo_min_pool_size,
+            maxIdleTimeMS=config.mongo_max_idle_time_ms,
+            # no connection / monitor threads before the first operation, so an
+            # instance created before gunicorn forks its workers is safe to use in them
+            connect=False)
+        self.db_name = DB_NAME
+        self.db = self.client[self.db_name]
+
+    def close(self) -> None:
+        self.client.close()
+
+    async def insert_embedding(self, embeddings) -> List:
+        if len(embeddings) == 0:
+            return None
+
+        for chat_id, chunks in group_by_chat(embeddings).items():
+            await self.db[chunk_collection(chat_id)].insert_many(mirror_embedding(chunks))
+
+    async def append_file_text(self, file_name: str, file_key: str, text: str,
+                               reset: bool = False, chat_id: str = None,
+                               neighbour_map: Dict = None, text_offset: int = None,
+                               map_offset: int = None) -> None:
+        """
+        Upsert the file record, appending `text` to its full_text and
+        `neighbour_map` to its map. With offsets (the length of the text and
+        map before this segment) whatever lies past them is replaced, so a
+        segment written again after a failed checkpoint save is not doubled.
+        """
+        record = file_record(file_name, file_key, text, chat_id,
+                             neighbour_map=neighbour_map)
+        # pipeline update: wrap values so text like "$5" is not read as a field path
+        fields = {key: {"$literal": value} for key, value in record.items()}
+        if not reset:
+            previous_text = {"$ifNull": ["$full_text", ""]}
+            if text_offset is not None:
+                previous_text = {"$substrCP": [previous_text, 0, text_offset]}
+            fields["full_text"] = {"$concat": [previous_text, {"$literal": text}]}
+            if neighbour_map is not None:
+                # no map to extend (ingestion begun before maps existed): leave it out
+                fields["neighbour_map"] = {"$cond": [
+                    {"$ifNull": ["$neighbour_map", False]},
+                    {column: {"$concatArrays": [
+                        array_prefix(f"$neighbour_map.{column}", map_offset),
+                        {"$literal": values}]}
+                     for column, values in neighbour_map.items()},
+                    "$$REMOVE"]}
+        return await self.db[FILE_COLLECTION].update_one(
+            file_filter(record["file_key"], chat_id), [{"$set": fields}], upsert=True)
+
+    async def find_chunks(self, chat_id: str, fields: List[str],
+                          file_key: str = None, unclaimed_by: str = None,
+                          claimed_from: int = None) -> List[Dict]:
+        """
+        With `unclaimed_by`, chunks of that ingestion are left out, except
+        those at or after chunk_id `claimed_from`.
+        """
+        query = {"chat_id": chat_id}
+        if file_key is not None:
+            query["file_key"] = file_key
+        if unclaimed_by is not None and claimed_from is not None:
+            query["$or"] = [{"ingest_id": {"$ne": unclaimed_by}},
+                            {"ingest_id": unclaimed_by, "chunk_id": {"$gte": claimed_from}}]
+        elif unclaimed_by is not None:
+            query["ingest_id"] = {"$ne": unclaimed_by}
+
+        projection = {field: 1 for field in fields}
+        return await self.db[chunk_collection(chat_id)].find(
+            query, projection).to_list(length=None)
+
+    async def find_neighbours(self, chat_id: str, chunk_ids: Dict[str, List[int]],
+                              fields: List[str]) -> List[Dict]:
+        """The chunks `chunk_ids[file_key]` of each file of the chat, in one query"""
+        if len(chunk_ids) == 0:
+            return []
+
+        query = {"chat_id": chat_id,
+                 "$or": [{"file_key": file_key, "chunk_id": {"$in": ids}}
+                         for file_key, ids in chunk_ids.items()]}
+        projection = {"_id": 0, **{field: 1 for field in fields}}
+        return await self.db[chunk_collection(chat_id)].find(
+            query, projection).to_list(length=None)
+
+    async def find_neighbour_maps(self, file_keys: List[str],
+                                  chat_id: str = None) -> Dict[str, Dict]:
+        records = await self.db[FILE_COLLECTION].find(
+            {**file_filter({"$in": file_keys}, chat_id),
+             "neighbour_map": {"$exists": True}},
+            {"_id": 0, "file_key": 1, "neighbour_map": 1}).to_list(length=None)
+        return {record["file_key"]: record["neighbour_map"] for record in records}
+
+    async def count_chunks(self, chat_id: str) -> int:
+        return await self.db[chunk_collection(chat_id)].count_documents({"chat_id": chat_id})
+
+    async def iter_chunks(self, chat_id: str, batch_size: int = 1000):
+        """All of a chat's chunk documents, `batch_size` at a time"""
+        cursor = self.db[chunk_collection(chat_id)].find(
+            {"chat_id": chat_id}, {"_id": 0}, batch_size=batch_size)
+        batch = []
+        async for chunk in cursor:
+            batch.append(chunk)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def delete_chunks(self, chat_id: str) -> None:
+        await self.db[chunk_collection(chat_id)].delete_many({"chat_id": chat_id})
+
+    async def find_files(self, file_keys: List[str], chat_id: str = None) -> List[Dict]:
+        return await self.db[FILE_COLLECTION].find(
+            file_filter({"$in": file_keys}, chat_id), {"_id": 0}).to_list(length=None)
+
+    async def upsert_file_records(self, records: List[Dict]) -> None:
+        """Write complete UploadedFile records, replacing those of the same chat and file_key"""
+        if len(records) == 0:
+            return None
+
+        return await self.db[FILE_COLLECTION].bulk_write(
+            file_record_operations(records), ordered=False)
+
+    async def write_chunk_changes(self, new_chunks: List[Dict], moved: List,
+                                  removed_ids: List, chat_id: str) -> None:
+        operations = chunk_operations(new_chunks, moved, removed_ids)
+        if len(operations) == 0:
+            return None
+
+        return await self.db[chunk_collection(chat_id)].bulk_write(operations, ordered=False)
+
+    async def set_file_summary(self, file_key: str, summary_embedding: List[float],
+                               field: str = None, chat_id: str = None) -> None:
+        if file_key.startswith('/'):
+            file_key = file_key[1:]
+
+        await self.db[FILE_COLLECTION].update_one(
+            file_filter(file_key, chat_id),
+            {"$set": {field or summary_field(): summary_embedding}})
+
+    async def rank_files(self, query_vector: List[float], chat_id: str,
+                         limit: int = 3) -> List[str]:
+        """File keys of the chat whose summary embedding best matches the query"""
+        cursor = self.db[FILE_COLLECTION].aggregate(
+            file_search_pipeline(query_vector, chat_id, limit))
+        return [item["file_key"] for item in await cursor.to_list(length=None)]
+
+    async def vector_search(self, query_vector: List[float],
+                            chat_id: str, limit: int = 5,
+                            file_keys: List[str] = None,
+                            keep_fields: List[str] = ()) -> List[Dict]:
+        cursor = self.db[chunk_collection(chat_id)].aggregate(
+            vector_search_pipeline(query_vector, chat_id, limit, file_keys, keep_fields))
+        return await cursor.to_list(length=None)
+
+    async def keyword_search(self, query: str, chat_id: str, limit: int = 5,
+                             file_keys: List[str] = None,
+                             keep_fields: List[str] = ()) -> List[Dict]:
+        cursor = self.db[chunk_collection(chat_id)].aggregate(
+            keyword_search_pipeline(query, chat_id, limit, file_keys, keep_fields))
+        return await cursor.to_list(length=None)
+
+    async def count_chunks_missing(self, field: str,
+                                   collection: str = EMBEDDING_COLLECTION) -> int:
+        return await self.db[collection].count_documents({field: {"$exists": False}})
+
+    async def find_chunks_missing(self, field: str, after_id=None, limit: int = 1000,
+                                  collection: str = EMBEDDING_COLLECTION) -> List[Dict]:
+        """The next chunks in `_id` order without `field`, as {"_id", "text"}"""
+        query = {field: {"$exists": False}}
+        if after_id is not None:
+            query["_id"] = {"$gt": after_id}
+        return await self.db[collection].find(
+            query, {"text": 1}).sort("_id", 1).limit(limit).to_list(length=None)
+
+    async def set_chunk_vectors(self, field: str, ids: List, vectors: List,
+                                collection: str = EMBEDDING_COLLECTION) -> None:
+        if len(ids) == 0:
+            return None
+
+        return await self.db[collection].bulk_write(
+            [UpdateOne({"_id": _id}, {"$set": {field: vector}})
+             for _id, vector in zip(ids, vectors)], ordered=False)
+
+    async def find_file_keys(self, after_id=None, limit: int = 100) -> List[Dict]:
+        """The next UploadedFile records in `_id` order, as {"_id", "file_key", "chat_id"}"""
+        query = {} if after_id is None else {"_id": {"$gt": after_id}}
+        return await self.db[FILE_COLLECTION].find(
+            query, {"file_key": 1, "chat_id": 1}).sort("_id", 1).limit(limit).to_list(length=None)
+
+    async def find_file_vectors(self, file_key: str, field: str,
+                                chat_id: str = None) -> List[List[float]]:
+        # files recorded without a chat_id predate partitioning
+        collection = chunk_collection(chat_id) if chat_id else EMBEDDING_COLLECTION
+        chunks = await self.db[collection].find(
+            {"file_key": file_key, field: {"$type": "array"}},
+            {"_id": 0, field: 1}).to_list(length=None)
+        return [chunk[field] for chunk in chunks]
+
+    async def get_reembed_job(self, job_id: str) -> Dict:
+        return await self.db[REEMBED_COLLECTION].find_one({"job_id": job_id}, {"_id": 0})
+
+    async def save_reembed_job(self, job: Dict) -> None:
+        await self.db[REEMBED_COLLECTION].replace_one(
+            {"job_id": job["job_id"]}, job, upsert=True)
+
+    async def get_checkpoint(self, chat_id: str, file_key: str) -> Dict:
+        return await self.db[CHECKPOINT_COLLECTION].find_one(
+            {"chat_id": chat_id, "file_key": file_key}, {"_id": 0})
+
+    async def save_checkpoint(self, checkpoint: Dict) -> None:
+        await self.db[CHECKPOINT_COLLECTION].replace_one(
+            {"chat_id": checkpoint["chat_id"], "file_key": checkpoint["file_key"]},
+            checkpoint, upsert=True)
+
+    async def get_chat_version(self, chat_id: str) -> int:
+        record = await self.db[CHAT_VERSION_COLLECTION].find_one(
+            {"chat_id": chat_id}, {"_id": 0, "version": 1})
+        return record["version"] if record is not None else 0
+
+    async def bump_chat_version(self, chat_id: str) -> int:
+        """
+        Count a change of the chat's chunks, the new version. Every process
+        compares it with the version its local copies (embedding store,
+        query cache) were derived from.
+        """
+        record = await self.db[CHAT_VERSION_COLLECTION].find_one_and_update(
+            {"chat_id": chat_id}, {"$inc": {"version": 1}},
+            projection={"_id": 0, "version": 1}, upsert=True,
+            return_document=ReturnDocument.AFTER)
+        return record["version"]
+
+    async def touch_chat(self, chat_id: str, now: float) -> Dict:
+        """Record an access to the chat, a chat seen for the first time is hot"""
+        return await self.db[CHAT_ACTIVITY_COLLECTION].find_one_and_update(
+            {"chat_id": chat_id},
+            {"$set": {"last_access": now},
+             "$setOnInsert": {"state": "hot", "changed_at": now}},
+            projection={"_id": 0}, upsert=True, return_document=ReturnDocument.AFTER)
+
+    async def get_chat_activity(self, chat_id: str) -> Dict:
+        return await self.db[CHAT_ACTIVITY_COLLECTION].find_one({"chat_id": chat_id}, {"_id": 0})
+
+    async def find_idle_chats(self, before: float, limit: int = 20) -> List[Dict]:
+        """Hot chats not accessed since `before`, least recently accessed first"""
+        return await self.db[CHAT_ACTIVITY_COLLECTION].find(
+            {"state": "hot", "last_access": {"$lt": before}}, {"_id": 0}
+        ).sort("last_access", 1).limit(limit).to_list(length=None)
+
+    async def set_chat_state(self, chat_id: str, from_states: List[str], state: str,
+                             last_access: float = None, changed_before: float = None,
+                             **fields) -> Dict:
+        """
+        Move the chat to `state` only if it is in one of `from_states` (and
+        was last accessed at `last_access` / last changed before
+        `changed_before`, when given). The updated record, None when the
+        chat did not match.
+        """
+        query = {"chat_id": chat_id, "state": {"$in": from_states}}
+        if last_access is not None:
+            query["last_access"] = last_access
+        if changed_before is not None:
+            query["changed_at"] = {"$lt": changed_before}
 
-        return results
+        return await self.db[CHAT_ACTIVITY_COLLECTION].find_one_and_update(
+            query, {"$set": {"state": state, **fields}},
+            projection={"_id": 0}, return_document=ReturnDocument.AFTER)
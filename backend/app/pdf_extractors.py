@@ -0,0 +1,207 @@
+import io
+import os
+from typing import List
+
+from pypdf import PdfReader
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # optional, much faster on long documents
+    pdfium = None
+
+try:
+    from pdfminer.high_level import extract_pages as pdfminer_extract_pages
+    from pdfminer.layout import LTTextContainer
+except ImportError:  # optional
+    pdfminer_extract_pages = None
+
+
+class PDFExtractor():
+    """
+    Turn a PDF into one text string per page. `file_path` may also be the
+    PDF's bytes, for uploads that are kept in memory.
+    """
+
+    name = None
+
+    @classmethod
+    def available(cls) -> bool:
+        return True
+
+    def page_count(self, file_path: str) -> int:
+        return len(PdfReader(_stream(file_path)).pages)
+
+    def extract_pages(self, file_path: str, page_numbers: List[int] = None) -> List[str]:
+        """Texts of all pages, or of the 0-based `page_numbers` only"""
+        raise NotImplementedError
+
+
+class PypdfExtractor(PDFExtractor):
+    name = "pypdf"
+
+    def extract_pages(self, file_path: str, page_numbers: List[int] = None) -> List[str]:
+        reader = PdfReader(_stream(file_path))
+        if page_numbers is None:
+            page_numbers = range(len(reader.pages))
+        return [reader.pages[page_num].extract_text() for page_num in page_numbers]
+
+
+class PdfiumExtractor(PDFExtractor):
+    name = "pdfium"
+
+    @classmethod
+    def available(cls) -> bool:
+        return pdfium is not None
+
+    def page_count(self, file_path: str) -> int:
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+
+    def extract_pages(self, file_path: str, page_numbers: List[int] = None) -> List[str]:
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            if page_numbers is None:
+                page_numbers = range(len(pdf))
+            texts = []
+            for page_num in page_numbers:
+                page = pdf[page_num]
+                text_page = page.get_textpage()
+                texts.append(text_page.get_text_range())
+                text_page.close()
+                page.close()
+            return texts
+        finally:
+            pdf.close()
+
+
+class PdfminerExtractor(PDFExtractor):
+    name = "pdfminer"
+
+    @classmethod
+    def available(cls) -> bool:
+        return pdfminer_extract_pages is not None
+
+    def extract_pages(self, file_path: str, page_numbers: List[int] = None) -> List[str]:
+        texts = []
+        for layout in pdfminer_extract_pages(_stream(file_path), page_numbers=page_numbers):
+            texts.append("".join(element.get_text() for element in layout
+                                 if isinstance(element, LTTextContainer)))
+        return texts
+
+
+def _stream(file_path):
+    return io.BytesIO(file_path) if isinstance(file_path, bytes) else file_path
+
+
+def _size(file_path) -> int:
+    return len(file_path) if isinstance(file_path, bytes) else os.path.getsize(file_path)
+
+
+EXTRACTORS = {extractor.name: extractor
+              for extractor in (PypdfExtractor, PdfiumExtractor, PdfminerExtractor)}
+
+# backend chosen by `probe_extractor` for scanned PDFs
+NO_TEXT_LAYER = "none"
+
+
+def normalize_page_text(text: str) -> str:
+    # backends differ in line endings and stray form feeds / NULs
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text.replace("\x0c", "\n").replace("\x00", "").strip()
+
+
+def page_count(file_path: str) -> int:
+    if PdfiumExtractor.available():
+        return PdfiumExtractor().page_count(file_path)
+    return PypdfExtractor().page_count(file_path)
+
+
+def available_extractors() -> List[str]:
+    return [name for name, extractor in EXTRACTORS.items() if extractor.available()]
+
+
+def select_extractors(file_path: str, large_pdf_pages: int = 200,
+                      large_pdf_bytes: int = 20 * 1024 * 1024) -> List[str]:
+    """
+    Order the installed backends for this document using cheap signals:
+    small documents keep pypdf (the historical output), long or large ones
+    go to pdfium first. pdfminer is the slowest and is kept as a fallback.
+    """
+    preferred = ["pypdf", "pdfium", "pdfminer"]
+
+    if _size(file_path) > large_pdf_bytes:
+        preferred = ["pdfium", "pypdf", "pdfminer"]
+    elif PdfiumExtractor.available():
+        try:
+            if PdfiumExtractor().page_count(file_path) > large_pdf_pages:
+                preferred = ["pdfium", "pypdf", "pdfminer"]
+        except Exception as e:
+            print(f"Error counting pages with pdfium: {str(e)}")
+
+    return [name for name in preferred if EXTRACTORS[name].available()]
+
+
+def has_text_layer(extractor: PDFExtractor, file_path: str, probe_pages: int = 5) -> bool:
+    """Scanned PDFs without a text layer yield no text on a few spread-out pages"""
+    page_count = extractor.page_count(file_path)
+    step = max(page_count // probe_pages, 1)
+    page_numbers = list(range(0, page_count, step))[:probe_pages]
+    return any(text.strip() for text in extractor.extract_pages(file_path, page_numbers))
+
+
+def probe_extractor(file_path: str, backend: str = "auto") -> str:
+    """
+    The backend to read every page segment of a document with: `backend`
+    unless "auto", else the first backend picked by `select_extractors`
+    that reads the probe pages, or NO_TEXT_LAYER when they have no text.
+    """
+    if backend != "auto":
+        return backend
+
+    last_error = None
+    for name in select_extractors(file_path):
+        try:
+            if has_text_layer(EXTRACTORS[name](), file_path):
+                return name
+            print("No text layer found in the PDF")
+            return NO_TEXT_LAYER
+
+        except Exception as e:
+            print(f"Error probing the PDF with {name}: {str(e)}")
+            last_error = e
+
+    raise last_error
+
+
+def extract_pages(file_path: str, backend: str = "auto",
+                  page_numbers: List[int] = None) -> List[str]:
+    """
+    Extract page texts with `backend`, or with the backends picked by
+    `select_extractors` when "auto", falling back to the next one on failure.
+    NO_TEXT_LAYER (see `probe_extractor`) yields empty pages.
+    """
+    if backend == NO_TEXT_LAYER:
+        return [""] * (len(page_numbers) if page_numbers is not None else page_count(file_path))
+
+    names = select_extractors(file_path) if backend == "auto" else [backend]
+    probe = backend == "auto" and page_numbers is None
+
+    last_error = None
+    for name in names:
+        extractor = EXTRACTORS[name]()
+        try:
+            if probe and not has_text_layer(extractor, file_path):
+                print("No text layer found in the PDF")
+                return [""] * extractor.page_count(file_path)
+
+            return [normalize_page_text(text)
+                    for text in extractor.extract_pages(file_path, page_numbers)]
+
+        except Exception as e:
+            print(f"Error extracting text with {name}: {str(e)}")
+            last_error = e
+
+    raise last_error
@@ -1,26 +1,40 @@
 
-from . import pdf_utils
+from . import boilerplate, pdf_extractors, pdf_utils
 # from .vertex_ai import TextEmbedding
 import os
+import threading
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
 
 
 class PDFParser():
-    def __init__(self, sentence_size=256, overlapping_num=3) -> None:
+    def __init__(self, sentence_size=256, overlapping_num=3, extractor="auto",
+                 strip_boilerplate=False) -> None:
         self.sentence_size = sentence_size
         self.overlapping_num = overlapping_num
+        self.extractor = extractor
+        self.strip_boilerplate = strip_boilerplate
+        self._executor = None
+        self._executor_lock = threading.Lock()
 
-    def parse(self, file_path):
+    def __getstate__(self):
+        # the parser is sent to the pool's processes with every file, not the pool itself
+        state = self.__dict__.copy()
+        state["_executor"] = state["_executor_lock"] = None
+        return state
 
-        file_name = os.path.basename(file_path)
-        full_text, page_sentence_list = pdf_utils.parse_pdf(file_path)
+    def parse(self, file_path, with_stats=False):
+
+        # in-memory uploads are parsed from their bytes and have no name here
+        file_name = os.path.basename(file_path) if isinstance(file_path, str) else None
+        full_text, page_sentence_list = pdf_utils.parse_pdf(
+            file_path, extractor=self.extractor, strip_boilerplate=self.strip_boilerplate)
 
         chunk_metas = pdf_utils.merge_sentences_to_chunks(
             page_sentence_list,
             sentence_size=self.sentence_size,
             overlapping_num=self.overlapping_num)
 
-        for metas in chunk_metas:
-            metas["file_name"] = file_name
+        self.annotate(chunk_metas, file_name)
 
         # chunks = []
         # for metas in chunk_metas:
@@ -34,7 +48,98 @@ class PDFParser():
         #  "page_number": List[int],
         #  "word_size": int,
         #  "chunk_id": int,
+        #  "content_hash": str,
         #  "embedding": List[List[float]]
         #  }
 
+        if with_stats:
+            return full_text, chunk_metas, self.boilerplate_savings(page_sentence_list)
         return full_text, chunk_metas
+
+    def boilerplate_savings(self, sentence_table):
+        """What boilerplate stripping saved on these pages, None when it did not run"""
+        if sentence_table.boilerplate is None:
+            return None
+        return boilerplate.savings(sentence_table.boilerplate, self.sentence_size)
+
+    @staticmethod
+    def annotate(chunk_metas, file_name):
+        for metas in chunk_metas:
+            metas["file_name"] = file_name
+            metas["content_hash"] = pdf_utils.content_hash(metas["text"])
+        return chunk_metas
+
+    def page_count(self, file_path):
+        return pdf_extractors.page_count(file_path)
+
+    def chunker(self, state=None):
+        return pdf_utils.ChunkBuilder(sentence_size=self.sentence_size,
+                                      overlapping_num=self.overlapping_num,
+                                      state=state)
+
+    def probe(self, file_path):
+        """Extractor backend for every `parse_pages` call on this document"""
+        return pdf_extractors.probe_extractor(file_path, self.extractor)
+
+    def parse_pages(self, file_path, page_numbers, known_boilerplate=(), extractor=None):
+        """
+        Text and sentences of a page range, for segment-by-segment ingestion.
+        `known_boilerplate` is the `boilerplate_lines` of the earlier segments,
+        `extractor` the backend picked by `probe`.
+        """
+        return pdf_utils.parse_pdf(file_path, extractor=extractor or self.extractor,
+                                   page_numbers=page_numbers,
+                                   strip_boilerplate=self.strip_boilerplate,
+                                   known_boilerplate=known_boilerplate)
+
+    def parse_many(self, file_paths, max_workers=None, with_stats=False):
+        """
+        Parse several PDFs in parallel. Returns one item per path, either the
+        result of `parse` or the exception raised for that file.
+        """
+        try:
+            results = self._collect(self.executor(max_workers), file_paths, with_stats)
+        except BrokenExecutor:
+            # broken before this batch: start a new pool
+            self.close()
+            results = self._collect(self.executor(max_workers), file_paths, with_stats)
+
+        if any(isinstance(result, BrokenExecutor) for result in results):
+            # a worker died mid-batch (e.g. out of memory), the next batch gets a new pool
+            self.close()
+        return results
+
+    def executor(self, max_workers=None):
+        """
+        The pool of `parse_many`, created on first use with `max_workers`
+        and kept for the life of the process. Created lazily, so each
+        prefork worker gets its own.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                try:
+                    self._executor = ProcessPoolExecutor(max_workers=max_workers)
+                except (OSError, NotImplementedError):
+                    # no /dev/shm for process pools on AWS Lambda, fall back to threads
+                    self._executor = ThreadPoolExecutor(max_workers=max_workers)
+            return self._executor
+
+    def close(self):
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _collect(self, executor, file_paths, with_stats=False):
+        futures = [executor.submit(self.parse, file_path, with_stats)
+                   for file_path in file_paths]
+
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"Error parsing pdf: {str(e)}")
+                results.append(e)
+
+        return results
@@ -1,74 +1,204 @@
-from pypdf import PdfReader
+import hashlib
+from array import array
 from textblob import TextBlob
+from . import boilerplate
+from .pdf_extractors import extract_pages
 import nltk
 nltk_download_dir = "/tmp/nltk_data"
 nltk.data.path.append(nltk_download_dir)
+_nltk_ready = False
 
 
-def parse_pdf(file_path):
+def ensure_nltk_data():
+    """Download the sentence tokenizer data once per process, if it is not installed"""
+    global _nltk_ready
+    if not _nltk_ready:
+        try:
+            nltk.data.find('tokenizers/punkt')
+        except LookupError:
+            nltk.download('punkt', download_dir=nltk_download_dir)
+        _nltk_ready = True
 
-    nltk.download('punkt', download_dir=nltk_download_dir)
 
-    reader = PdfReader(file_path)
-    full_text = ""
-    page_sentence_list = []
-    for page_num, page in enumerate(reader.pages):
-        text = page.extract_text().strip()
-        full_text += "\n"+text
-        blob = TextBlob(text)
+def parse_pdf(file_path, extractor="auto", page_numbers=None, strip_boilerplate=False,
+              known_boilerplate=()):
+    """
+    (full_text, SentenceTable) of the document or of `page_numbers`. With
+    `strip_boilerplate`, lines repeated across the parsed pages (headers,
+    footers, page numbers, disclaimers) or in `known_boilerplate` are
+    removed first and counted in the table's `boilerplate` stats. The
+    table's `boilerplate_lines` carry them on to the next page segment.
+    """
 
-        for sentence in blob.sentences:
-            tmp_dict = {}
-            tmp_dict["page_number"] = page_num
-            tmp_dict["sentence"] = sentence
-            page_sentence_list.append(tmp_dict)
+    ensure_nltk_data()
 
-    return full_text, page_sentence_list
+    texts = extract_pages(file_path, backend=extractor, page_numbers=page_numbers)
+    if page_numbers is None:
+        page_numbers = range(len(texts))
+
+    stats = None
+    lines = set()
+    if strip_boilerplate:
+        lines = boilerplate.detect_boilerplate(texts, known=known_boilerplate)
+        texts, stats = boilerplate.strip_boilerplate(texts, lines)
+
+    full_text, sentence_table = split_sentences(texts, page_numbers)
+    sentence_table.boilerplate = stats
+    sentence_table.boilerplate_lines = lines
+
+    return full_text, sentence_table
+
+
+def split_sentences(texts, page_numbers):
+
+    sentence_table = SentenceTable()
+    for page_num, text in zip(page_numbers, texts):
+        sentence_table.add_page(page_num, text)
+
+    full_text = "".join("\n"+text for text in sentence_table.pages)
+
+    return full_text, sentence_table
+
+
+class SentenceTable():
+    """
+    Compact sentence store for a parsed document: the page texts are kept
+    once and every sentence is an (offset, length) slice of its page, with
+    its page number and word count in parallel typed arrays. TextBlob
+    objects only live while their page is being split.
+    """
+
+    def __init__(self):
+        self.pages = []
+        self.page_index = array("I")
+        self.page_numbers = array("I")
+        self.offsets = array("I")
+        self.lengths = array("I")
+        self.word_counts = array("I")
+        # what boilerplate.strip_boilerplate removed, if it ran, and the line keys it removed
+        self.boilerplate = None
+        self.boilerplate_lines = set()
+
+    def add_page(self, page_number, text):
+        page_index = len(self.pages)
+        self.pages.append(text)
+
+        for sentence in TextBlob(text).sentences:
+            self.page_index.append(page_index)
+            self.page_numbers.append(page_number)
+            self.offsets.append(sentence.start)
+            self.lengths.append(sentence.end - sentence.start)
+            self.word_counts.append(len(sentence.words))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def sentence(self, i):
+        offset = self.offsets[i]
+        return self.pages[self.page_index[i]][offset:offset + self.lengths[i]]
+
+    def __iter__(self):
+        """(page_number, sentence text, word count) per sentence"""
+        for i in range(len(self.offsets)):
+            yield self.page_numbers[i], self.sentence(i), self.word_counts[i]
+
+
+def iter_sentences(page_sentence_list):
+    if isinstance(page_sentence_list, SentenceTable):
+        return iter(page_sentence_list)
+
+    # list of {"page_number": int, "sentence": TextBlob Sentence}
+    return ((item["page_number"], str(item["sentence"]), len(item["sentence"].words))
+            for item in page_sentence_list)
 
 
 def merge_sentences_to_chunks(page_sentence_list, sentence_size=128, overlapping_num=3):
 
-    chunks = []
-    accumulate_len = 0
-    sentence_sizes = []
-    windows_sentences = []
-    windows_page_numbers = []
-
-    chunk_id = 0
-    for item in page_sentence_list:
-
-        page_number = item["page_number"]
-        sentence = item["sentence"]
-
-        word_len = len(sentence.words)
-        if accumulate_len+word_len <= sentence_size or len(windows_sentences) == 0:
-            windows_sentences.append(str(sentence))
-            windows_page_numbers.append(page_number)
-            accumulate_len += word_len
-            sentence_sizes.append(word_len)
-
-        else:
-            windows_context = "\n".join(windows_sentences)
-            chunks.append({"text": windows_context,
-                          "page_number": list(set(windows_page_numbers)),
-                           "word_size": accumulate_len,
-                           "chunk_id": chunk_id
-                           }
-                          )
-            # initialize
-            chunk_id += 1
-            windows_sentences = windows_sentences[-overlapping_num:].copy()+[
-                str(sentence)]
-            windows_page_numbers = windows_page_numbers[-overlapping_num:].copy()+[
-                page_number]
-            accumulate_len = sum(sentence_sizes[-overlapping_num:]) + word_len
-
-    if len(windows_sentences) > 0:
-        windows_context = "\n".join(windows_sentences)
-        chunks.append({"text": windows_context,
-                      "page_number": list(set(windows_page_numbers)),
-                       "word_size": accumulate_len,
-                       "chunk_id": chunk_id
-                       })
+    builder = ChunkBuilder(sentence_size=sentence_size,
+                           overlapping_num=overlapping_num)
+    chunks = builder.add(page_sentence_list)
+    chunks += builder.finish()
 
     return chunks
+
+
+class ChunkBuilder():
+    """
+    Incremental form of `merge_sentences_to_chunks`: sentences can be fed
+    page range by page range, and the sliding window can be saved with
+    `state()` and restored, so a document chunked in several invocations
+    yields exactly the same chunks as one pass over all its pages.
+    """
+
+    def __init__(self, sentence_size=128, overlapping_num=3, state=None):
+        self.sentence_size = sentence_size
+        self.overlapping_num = overlapping_num
+
+        state = state or {}
+        self.accumulate_len = state.get("accumulate_len", 0)
+        self.sentence_sizes = state.get("sentence_sizes", [])
+        self.windows_sentences = state.get("windows_sentences", [])
+        self.windows_page_numbers = state.get("windows_page_numbers", [])
+        self.chunk_id = state.get("chunk_id", 0)
+        # leading sentences of the window repeated from the previous chunk
+        self.overlap_sentences = state.get("overlap_sentences", 0)
+
+    def state(self):
+        return {"accumulate_len": self.accumulate_len,
+                # only the tail is ever read back
+                "sentence_sizes": self._tail(self.sentence_sizes),
+                "windows_sentences": list(self.windows_sentences),
+                "windows_page_numbers": list(self.windows_page_numbers),
+                "chunk_id": self.chunk_id,
+                "overlap_sentences": self.overlap_sentences}
+
+    def add(self, page_sentence_list):
+        chunks = []
+
+        for page_number, sentence, word_len in iter_sentences(page_sentence_list):
+
+            if self.accumulate_len+word_len <= self.sentence_size or len(self.windows_sentences) == 0:
+                self.windows_sentences.append(sentence)
+                self.windows_page_numbers.append(page_number)
+                self.accumulate_len += word_len
+                self.sentence_sizes.append(word_len)
+
+            else:
+                chunks.append(self._window_chunk())
+                # initialize
+                self.chunk_id += 1
+                carried = self._tail(self.windows_sentences)
+                self.overlap_sentences = len(carried)
+                self.windows_sentences = carried+[
+                    sentence]
+                self.windows_page_numbers = self._tail(self.windows_page_numbers)+[
+                    page_number]
+                self.accumulate_len = sum(self._tail(self.sentence_sizes)) + word_len
+
+        return chunks
+
+    def _tail(self, items):
+        # the last overlapping_num items; items[-0:] would be all of them
+        if self.overlapping_num <= 0:
+            return []
+        return items[-self.overlapping_num:]
+
+    def finish(self):
+        if len(self.windows_sentences) > 0:
+            return [self._window_chunk()]
+        return []
+
+    def _window_chunk(self):
+        windows_context = "\n".join(self.windows_sentences)
+        overlap = self.overlap_sentences
+        return {"text": windows_context,
+                "page_number": list(set(self.windows_page_numbers)),
+                "word_size": self.accumulate_len,
+                "chunk_id": self.chunk_id,
+                # characters of text repeating the previous chunk, separator included
+                "overlap": len("\n".join(self.windows_sentences[:overlap])) + 1 if overlap else 0
+                }
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
@@ -0,0 +1,283 @@
+import asyncio
+import contextvars
+import functools
+import hmac
+import os
+import sys
+import time
+import threading
+import weakref
+from collections import Counter
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs
+from uuid import uuid4
+
+from starlette import concurrency
+
+from app.config import config
+
+PROFILE_HEADER = "x-profile-token"
+PROFILE_QUERY_PARAM = "profile"
+PROFILE_SUFFIX = ".folded"
+
+
+def profiling_token() -> Optional[str]:
+    """Token that authorizes profiling, profiling is disabled when unset"""
+    return os.getenv("PROFILE_TOKEN") or None
+
+
+def is_authorized(token: Optional[str]) -> bool:
+    expected = profiling_token()
+    return expected is not None and token is not None and \
+        hmac.compare_digest(token.encode(), expected.encode())
+
+
+# sampler of the request being served, inherited by its tasks and worker threads
+_current_sampler = contextvars.ContextVar("profile_sampler", default=None)
+
+
+async def run_in_threadpool(func, *args, **kwargs):
+    """`starlette.concurrency.run_in_threadpool`, sampled with a profiled request"""
+    sampler = _current_sampler.get()
+    if sampler is not None:
+        func = functools.partial(sampler.run_sampled, func)
+    return await concurrency.run_in_threadpool(func, *args, **kwargs)
+
+
+async def to_thread(func, *args, **kwargs):
+    """`asyncio.to_thread`, sampled with a profiled request"""
+    sampler = _current_sampler.get()
+    if sampler is not None:
+        func = functools.partial(sampler.run_sampled, func)
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+
+class StackSampler():
+    """
+    Sample the call stacks of one request at a fixed interval and keep the
+    counts in the collapsed format used by flamegraph.pl / speedscope:
+
+        MainThread;server.py:dispatch;app/pdf_utils.py:parse_pdf;pypdf/_page.py:extract_text 42
+
+    Only the request's own work is sampled: the event loop thread while it
+    runs one of the request's tasks (see `track_tasks`), and worker threads
+    while they run a call the request dispatched through `run_in_threadpool`
+    or `to_thread`. Other requests served meanwhile and idle waits are left out.
+    """
+
+    IDLE_FRAMES = ("threading.py", "queue.py", "selectors.py")
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.loop = None
+        self.loop_thread = None
+        self.tasks = weakref.WeakSet()
+        self._threads = Counter()
+        self._threads_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def track_tasks(self) -> contextvars.Token:
+        """Sample the current task, and the tasks and worker calls it starts, on this loop"""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        _install_task_factory(self.loop)
+        self.tasks.add(asyncio.current_task())
+        return _current_sampler.set(self)
+
+    def untrack_tasks(self, context_token: contextvars.Token) -> None:
+        """Undo `track_tasks` once the request is done"""
+        _current_sampler.reset(context_token)
+        _uninstall_task_factory(self.loop)
+
+    def run_sampled(self, func, *args, **kwargs):
+        thread_id = threading.get_ident()
+        with self._threads_lock:
+            self._threads[thread_id] += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._threads_lock:
+                self._threads[thread_id] -= 1
+                if self._threads[thread_id] == 0:
+                    del self._threads[thread_id]
+
+    def _sampled_threads(self) -> set:
+        with self._threads_lock:
+            thread_ids = set(self._threads)
+        if self.loop is not None and asyncio.current_task(self.loop) in self.tasks:
+            thread_ids.add(self.loop_thread)
+        return thread_ids
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            thread_ids = self._sampled_threads()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id not in thread_ids:
+                    continue
+                if os.path.basename(frame.f_code.co_filename) in self.IDLE_FRAMES:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{_short_path(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def dump(self, file_path: str) -> None:
+        with open(file_path, mode="w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+# loop -> [number of profiled requests, factory installed, factory it replaced]
+_replaced_factories = weakref.WeakKeyDictionary()
+
+
+def _install_task_factory(loop) -> None:
+    """
+    Tasks created while a request is profiled join its sampled tasks, e.g. the
+    coroutines of an `asyncio.gather`. Installed on top of any factory already
+    set while at least one request of the loop is profiled.
+    """
+    if loop in _replaced_factories:
+        _replaced_factories[loop][0] += 1
+        return
+
+    factory = loop.get_task_factory()
+
+    def task_factory(loop, coro, **kwargs):
+        if factory is not None:
+            task = factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        sampler = _current_sampler.get()
+        if sampler is not None:
+            sampler.tasks.add(task)
+        return task
+
+    loop.set_task_factory(task_factory)
+    _replaced_factories[loop] = [1, task_factory, factory]
+
+
+def _uninstall_task_factory(loop) -> None:
+    """Restore the replaced factory once the loop's last profiled request is done"""
+    installed = _replaced_factories[loop]
+    installed[0] -= 1
+    if installed[0] == 0:
+        del _replaced_factories[loop]
+        # a factory set on top of it since then stays
+        if loop.get_task_factory() is installed[1]:
+            loop.set_task_factory(installed[2])
+
+
+def _short_path(file_path: str) -> str:
+    # keep the package-relative part so frames stay readable in the flame graph
+    for marker in ("site-packages/", "dist-packages/"):
+        if marker in file_path:
+            return file_path.split(marker, 1)[1]
+    if f"/python{sys.version_info.major}.{sys.version_info.minor}/" in file_path:
+        # standard library
+        return file_path.split(f"/python{sys.version_info.major}.{sys.version_info.minor}/", 1)[1]
+    return os.path.relpath(file_path) if os.path.isabs(file_path) else file_path
+
+
+def list_profiles() -> List[Dict]:
+    if not os.path.isdir(config.profile_dir):
+        return []
+
+    profiles = []
+    for file_name in os.listdir(config.profile_dir):
+        if not file_name.endswith(PROFILE_SUFFIX):
+            continue
+        stat = os.stat(os.path.join(config.profile_dir, file_name))
+        profiles.append({"profile_id": file_name[:-len(PROFILE_SUFFIX)],
+                         "size": stat.st_size,
+                         "created_at": stat.st_mtime})
+
+    return sorted(profiles, key=lambda item: item["created_at"], reverse=True)
+
+
+def profile_path(profile_id: str) -> Optional[str]:
+    file_path = os.path.join(config.profile_dir,
+                             os.path.basename(profile_id) + PROFILE_SUFFIX)
+    return file_path if os.path.exists(file_path) else None
+
+
+class ProfilingMiddleware():
+    """
+    Pure ASGI middleware: requests carrying a valid `X-Profile-Token` header
+    or `?profile=<token>` query flag are sampled for their whole lifetime and
+    the collapsed stacks are written to `config.profile_dir`. Every other
+    request is passed straight through.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or profiling_token() is None:
+            return await self.app(scope, receive, send)
+
+        token = _request_token(scope)
+        if token is None:
+            return await self.app(scope, receive, send)
+
+        if not is_authorized(token):
+            print(f"Rejected profiling request for {scope['path']}")
+            return await self.app(scope, receive, send)
+
+        profile_id = f"{int(time.time())}-{uuid4().hex[:8]}"
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", profile_id.encode()))
+                message["headers"] = headers
+            await send(message)
+
+        sampler = StackSampler(interval=config.profile_interval)
+        context_token = sampler.track_tasks()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            sampler.untrack_tasks(context_token)
+            # joining the sampler and writing the file block: off the event loop
+            await concurrency.run_in_threadpool(_save_profile, sampler, profile_id)
+            print(f"Saved profile {profile_id} for {scope['path']} "
+                  f"({sampler.samples} samples)")
+
+
+def _save_profile(sampler: StackSampler, profile_id: str) -> None:
+    sampler.stop()
+    os.makedirs(config.profile_dir, exist_ok=True)
+    sampler.dump(os.path.join(config.profile_dir, profile_id + PROFILE_SUFFIX))
+
+
+def _request_token(scope) -> Optional[str]:
+    for key, value in scope.get("headers", []):
+        if key == PROFILE_HEADER.encode():
+            return value.decode()
+
+    query_string = scope.get("query_string", b"")
+    if query_string and PROFILE_QUERY_PARAM.encode() in query_string:
+        values = parse_qs(query_string.decode()).get(PROFILE_QUERY_PARAM)
+        if values:
+            return values[0]
+
+    return None
@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional
+
+import numpy as np
+
+
+class ChatQueryCache():
+    """
+    Recent query embeddings of one chat and their final results. Embeddings
+    are kept L2-normalized in a fixed-size matrix so a lookup is a single
+    matrix-vector product; the least recently used row is overwritten when
+    the cache is full.
+    """
+
+    def __init__(self, dim: int, max_entries: int, chat_version: Optional[int] = None) -> None:
+        # version of the chat (see `AsyncMongoDB.bump_chat_version`) the results were read at
+        self.chat_version = chat_version
+        self.vectors = np.zeros((max_entries, dim), dtype=np.float32)
+        self.used = np.zeros(max_entries, dtype=bool)
+        self.last_used = np.zeros(max_entries, dtype=np.int64)
+        self.created_at = np.zeros(max_entries, dtype=np.float64)
+        self.params = [None] * max_entries
+        self.results = [None] * max_entries
+        self.tick = 0
+
+    def get(self, vector: np.ndarray, params: Hashable, threshold: float,
+            ttl: float) -> Optional[List[Dict]]:
+        scores = self.vectors @ vector
+        fresh = self.used & (time.time() - self.created_at <= ttl)
+        scores[~fresh] = -np.inf
+        candidates = np.flatnonzero(scores >= threshold)
+        for row in candidates[np.argsort(-scores[candidates])]:
+            if self.params[row] == params:
+                self.tick += 1
+                self.last_used[row] = self.tick
+                return self.results[row]
+        return None
+
+    def put(self, vector: np.ndarray, params: Hashable, results: List[Dict]) -> None:
+        free = np.flatnonzero(~self.used)
+        row = free[0] if len(free) else int(np.argmin(self.last_used))
+
+        self.tick += 1
+        self.vectors[row] = vector
+        self.used[row] = True
+        self.last_used[row] = self.tick
+        self.created_at[row] = time.time()
+        self.params[row] = params
+        self.results[row] = results
+
+
+class SemanticQueryCache():
+    """
+    Per-chat cache of search results keyed by query meaning rather than
+    query text: a query whose embedding has a cosine similarity of at least
+    `threshold` with a cached query of the same chat (and the same search
+    parameters) gets the cached results. At most `max_chats` chats are kept,
+    the least recently used one is evicted first.
+
+    Callers pass the chat's current version: results cached at another
+    version of the chat are not returned, whichever worker changed it.
+    Entries also expire after `ttl` seconds, and changes made in this
+    process call `invalidate`.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 256,
+                 max_chats: int = 1024, ttl: float = 300) -> None:
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_chats = max_chats
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._chats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: str, embedding: List[float], params: Hashable = None,
+            chat_version: Optional[int] = None) -> Optional[List[Dict]]:
+        vector = _normalize(embedding)
+        with self._lock:
+            chat_cache = self._chats.get(chat_id)
+            results = None
+            if chat_cache is not None and chat_cache.chat_version == chat_version:
+                self._chats.move_to_end(chat_id)
+                results = chat_cache.get(vector, params, self.threshold, self.ttl)
+
+            if results is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        # callers may annotate the items they return
+        return [dict(item) for item in results]
+
+    def put(self, chat_id: str, embedding: List[float], results: List[Dict],
+            params: Hashable = None, chat_version: Optional[int] = None) -> None:
+        vector = _normalize(embedding)
+        with self._lock:
+            chat_cache = self._chats.get(chat_id)
+            if chat_cache is not None and chat_cache.chat_version != chat_version:
+                if _is_newer(chat_cache.chat_version, chat_version):
+                    return  # read before a change another request already cached after
+                chat_cache = None
+            if chat_cache is None:
+                chat_cache = ChatQueryCache(len(vector), self.max_entries, chat_version)
+                self._chats[chat_id] = chat_cache
+                if len(self._chats) > self.max_chats:
+                    self._chats.popitem(last=False)
+            self._chats.move_to_end(chat_id)
+            chat_cache.put(vector, params, [dict(item) for item in results])
+
+    def invalidate(self, chat_id: str) -> None:
+        with self._lock:
+            self._chats.pop(chat_id, None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "chats": len(self._chats)}
+
+
+def _is_newer(version: Optional[int], other: Optional[int]) -> bool:
+    return version is not None and other is not None and version > other
+
+
+def _normalize(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    return vector / max(float(np.linalg.norm(vector)), 1e-12)
@@ -0,0 +1,165 @@
+import asyncio
+import datetime
+import time
+from typing import Dict, Optional
+
+from app.config import config
+from app.embedding_store import summary_vector
+from app.mongodb_engine import chunk_collections, summary_field
+
+
+class ReembedJob():
+    """
+    Re-embed the stored `text` of every chunk with another model into the
+    parallel chunk field `target_field`, then recompute the file summaries
+    into `summary_<target_field>`. Searches keep reading the current field
+    meanwhile, both can be queried side by side until the cutover.
+
+    Chunks are read partition by partition (see `chunk_collection`) in `_id`
+    order, `read_batch` at a time, and embedded through
+    `jina_ai.get_embeddings_in_batches` (batch sizes and concurrency adapt
+    when it has a controller). The next batch is read while the
+    previous one is embedded. After each write the position is saved to the
+    `ReembedJob` collection, so a stopped job resumes where it left off;
+    chunks that already have `target_field` are skipped, so running the job
+    again later catches up with chunks ingested in between.
+    """
+
+    def __init__(self, mongo_db_engine, jina_ai, target_field: str, job_id: str = None,
+                 read_batch: int = 1000, max_chunks_per_second: Optional[float] = None,
+                 progress_interval: float = 30.0) -> None:
+        if target_field in ("embedding", config.embedding_field):
+            raise ValueError(f"Cannot re-embed into the searched field {target_field}")
+
+        self.mongo_db_engine = mongo_db_engine
+        self.jina_ai = jina_ai
+        self.target_field = target_field
+        self.job_id = job_id or target_field
+        self.read_batch = read_batch
+        self.max_chunks_per_second = max_chunks_per_second
+        self.progress_interval = progress_interval
+        self.job = None
+        self.run_started = None
+        self.run_processed = 0
+
+    async def _load(self) -> Dict:
+        job = await self.mongo_db_engine.get_reembed_job(self.job_id)
+        if job is not None and job["model"] != self.jina_ai.model:
+            raise ValueError(f"Job {self.job_id} re-embeds with {job['model']}, "
+                             f"not {self.jina_ai.model}")
+
+        pending = 0
+        for collection in chunk_collections():
+            pending += await self.mongo_db_engine.count_chunks_missing(
+                self.target_field, collection=collection)
+        if job is None or job["status"] == "complete":
+            # a new job, or a catch-up run over the chunks ingested since
+            job = {"job_id": self.job_id,
+                   "model": self.jina_ai.model,
+                   "target_field": self.target_field,
+                   "processed": 0,
+                   "collection": None,
+                   "last_id": None,
+                   "last_file_id": None,
+                   "status": "embedding",
+                   "started_at": _now()}
+        job["total"] = job["processed"] + pending
+        return job
+
+    async def _save(self) -> None:
+        elapsed = time.monotonic() - self.run_started
+        throughput = self.run_processed / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.job["total"] - self.job["processed"], 0)
+        self.job.update({"throughput": round(throughput, 2),
+                         "eta_seconds": round(remaining / throughput) if throughput else None,
+                         "updated_at": _now()})
+        await self.mongo_db_engine.save_reembed_job(self.job)
+
+    async def run(self) -> Dict:
+        self.job = await self._load()
+        self.run_started = time.monotonic()
+        self.run_processed = 0
+
+        if self.job["status"] == "embedding":
+            collections = chunk_collections()
+            if self.job.get("collection") in collections:
+                collections = collections[collections.index(self.job["collection"]):]
+            for collection in collections:
+                if collection != self.job.get("collection"):
+                    self.job.update({"collection": collection, "last_id": None})
+                await self._embed_chunks(collection)
+            self.job["status"] = "summaries"
+            await self._save()
+
+        await self._update_summaries()
+        self.job.update({"status": "complete", "collection": None, "last_id": None,
+                         "last_file_id": None})
+        await self._save()
+        print(f"Re-embedded {self.job['processed']} chunks into {self.target_field}")
+        return self.job
+
+    async def _embed_chunks(self, collection: str) -> None:
+        last_report = time.monotonic()
+        next_batch = asyncio.ensure_future(self.mongo_db_engine.find_chunks_missing(
+            self.target_field, self.job["last_id"], self.read_batch, collection=collection))
+        try:
+            while True:
+                chunks = await next_batch
+                if not chunks:
+                    return
+                next_batch = asyncio.ensure_future(self.mongo_db_engine.find_chunks_missing(
+                    self.target_field, chunks[-1]["_id"], self.read_batch,
+                    collection=collection))
+
+                # empty chunks get a null vector: marked done, never matched
+                texts = [chunk["text"] for chunk in chunks if chunk.get("text")]
+                vectors = iter(await self.jina_ai.get_embeddings_in_batches(texts))
+                await self.mongo_db_engine.set_chunk_vectors(
+                    self.target_field, [chunk["_id"] for chunk in chunks],
+                    [next(vectors) if chunk.get("text") else None for chunk in chunks],
+                    collection=collection)
+
+                self.run_processed += len(chunks)
+                self.job["processed"] += len(chunks)
+                self.job["last_id"] = chunks[-1]["_id"]
+                await self._save()
+
+                if time.monotonic() - last_report > self.progress_interval:
+                    last_report = time.monotonic()
+                    print(f"Re-embedding {self.job_id}: {self.job['processed']}/"
+                          f"{self.job['total']} chunks, {self.job['throughput']} chunks/s, "
+                          f"ETA {self.job['eta_seconds']}s")
+
+                await self._throttle()
+        finally:
+            next_batch.cancel()
+
+    async def _throttle(self) -> None:
+        if not self.max_chunks_per_second:
+            return
+        ahead = (self.run_processed / self.max_chunks_per_second
+                 - (time.monotonic() - self.run_started))
+        if ahead > 0:
+            await asyncio.sleep(ahead)
+
+    async def _update_summaries(self) -> None:
+        field = summary_field(self.target_field)
+        while True:
+            files = await self.mongo_db_engine.find_file_keys(self.job["last_file_id"])
+            if not files:
+                return
+
+            for record in files:
+                vectors = await self.mongo_db_engine.find_file_vectors(
+                    record["file_key"], self.target_field, chat_id=record.get("chat_id"))
+                if vectors:
+                    await self.mongo_db_engine.set_file_summary(
+                        record["file_key"], summary_vector(vectors), field=field,
+                        chat_id=record.get("chat_id"))
+
+            self.job["last_file_id"] = files[-1]["_id"]
+            await self.mongo_db_engine.save_reembed_job(self.job)
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
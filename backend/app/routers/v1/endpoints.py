@@ -1,16 +1,30 @@
 import os
-import numpy as np
+import time
+import asyncio
 import boto3
-from app import utils
+from botocore.config import Config as BotoConfig
+from typing import List
+from uuid import uuid4
+from app import admission, candidates, chat_archive, context, incremental
+from app.chat_tiering import ChatTiering
 from app.config import config
-from app.jina_ai import JinaAI
-from app.mongodb_engine import MongoDB
+from app.embedding_store import EmbeddingStore, META_FIELDS, summary_vector
+from app.embedding_controller import AdaptiveBatchController
+from app.jina_ai import AsyncJinaAI
+from app.mongodb_engine import AsyncMongoDB, file_record
 from app.pdf_parser import PDFParser
-from fastapi import APIRouter, File, UploadFile, Form
+from app.profiling import run_in_threadpool
+from app.query_cache import SemanticQueryCache
+from app.shared_cache import SharedEmbeddingCache
+from app.single_flight import SingleFlight
+from app.uploads import SpooledUpload, TempSpace, UploadScope, upload_keys
+from fastapi import APIRouter, File, HTTPException, UploadFile, Form
 import dotenv
 import datetime
 
-from app.routers.v1.payload import DeleteFilePayLoad
+from app.routers.v1.payload import (DeleteFilePayLoad, ExportChatPayLoad, ImportChatPayLoad,
+                                    ResumeIngestPayLoad)
+from app.routers.v1.responses import FastJSONResponse, IngestResponse, SearchResult
 dotenv.load_dotenv()
 
 
@@ -22,108 +36,724 @@ router = APIRouter(
 )
 
 
-s3 = boto3.client('s3')
+s3 = boto3.client('s3', config=BotoConfig(
+    max_pool_connections=config.s3_max_pool_connections))
 
 
-def upload_file_to_s3(file_path, file_key):
-    s3.upload_file(file_path, config.s3_bucket, file_key)
+async def upload_file_to_s3(upload, file_key):
+    # boto3 clients are thread safe, run the blocking call off the event loop
+    if upload.path is not None:
+        await run_in_threadpool(s3.upload_file, upload.path, config.s3_bucket, file_key)
+    else:
+        await run_in_threadpool(s3.upload_fileobj, upload.open(), config.s3_bucket, file_key)
 
 
-pdf_parser = PDFParser(sentence_size=config.sentence_size,
-                       overlapping_num=config.overlapping_num)
-
-mongo_db_engine = MongoDB(mongodb_url=os.getenv("MONGODB_URL"))
-jina_ai = JinaAI(api_key=os.getenv("JINA_API_KEY"))
-
+# bytes that requests may spool to /tmp at once, see `upload_scope`
+temp_space = TempSpace(quota_bytes=config.tmp_quota_bytes)
 
-@router.post("/ingest_file")
-async def ingest_file(file_key: str = Form(...), chat_id: str = Form(...), file: UploadFile = File(...)):
 
-    file_path = utils.save_file(file=file)
-    upload_file_to_s3(file_path, file_key)
+def upload_scope():
+    """Temp files of one request: small ones in memory, all removed on exit"""
+    return UploadScope(temp_space, spool_threshold=config.upload_spool_threshold)
 
-    full_text, chunk_metas = pdf_parser.parse(file_path=file_path)
-
-    chunks = [chunk['text'] for chunk in chunk_metas]
-    embeddings = jina_ai.get_embeddings(chunks)
-    for embedding, metas in zip(embeddings, chunk_metas):
-        metas['embedding'] = embedding
 
+pdf_parser = PDFParser(sentence_size=config.sentence_size,
+                       overlapping_num=config.overlapping_num,
+                       extractor=config.pdf_extractor,
+                       strip_boilerplate=config.strip_boilerplate)
+
+mongo_db_engine = AsyncMongoDB(mongodb_url=os.getenv("MONGODB_URL"))
+jina_ai = AsyncJinaAI(api_key=os.getenv("JINA_API_KEY"),
+                      max_connections=config.http_max_connections,
+                      max_keepalive_connections=config.http_max_keepalive_connections,
+                      timeout=config.http_timeout,
+                      concurrency=config.embedding_concurrency,
+                      batch_size=config.batch_size,
+                      controller=AdaptiveBatchController(
+                          batch_size=config.batch_size,
+                          min_batch_size=config.min_batch_size,
+                          max_batch_size=config.max_batch_size,
+                          concurrency=config.embedding_concurrency,
+                          max_concurrency=config.max_embedding_concurrency,
+                          max_batch_tokens=config.embedding_max_batch_tokens,
+                          target_latency=config.embedding_target_latency
+                      ) if config.adaptive_batching else None,
+                      model=config.embedding_model,
+                      # created at import: before the fork when gunicorn preloads the app
+                      shared_cache=SharedEmbeddingCache(
+                          dim=config.embedding_dim, slots=config.shared_embedding_cache_slots
+                      ) if config.shared_embedding_cache_slots else None)
+embedding_store = EmbeddingStore(root_dir=config.embedding_store_dir,
+                                 dim=config.embedding_dim,
+                                 ann_min_rows=config.ann_min_rows,
+                                 nprobe=config.ann_nprobe,
+                                 rerank_size=config.ann_rerank_size)
+query_cache = SemanticQueryCache(threshold=config.query_cache_threshold,
+                                 max_entries=config.query_cache_size,
+                                 max_chats=config.query_cache_max_chats,
+                                 ttl=config.query_cache_ttl)
+
+# identical concurrent searches (same route and parameters) share one execution
+search_flights = SingleFlight()
+
+
+def coalesce(route):
+    # followers give back their search slot while the leader's call runs
+    return search_flights.wrap(route, on_follow=admission.release_slot) \
+        if config.use_single_flight else route
+
+
+# search lane first: it has priority over ingest
+admission_control = admission.AdmissionController([
+    admission.Lane(admission.SEARCH, max_concurrency=config.search_max_concurrency,
+                   max_queue=config.search_max_queue,
+                   max_queue_time=config.search_max_queue_time),
+    admission.Lane(admission.INGEST, max_concurrency=config.ingest_max_concurrency,
+                   max_queue=config.ingest_max_queue,
+                   max_queue_time=config.ingest_max_queue_time)])
+
+# routes of this router going through `admission_control`, see server.py
+ADMISSION_ROUTES = {
+    "/vector_search": admission.SEARCH,
+    "/keyword_search": admission.SEARCH,
+    "/hybrid_search": admission.SEARCH,
+    "/ingest_file": admission.INGEST,
+    "/ingest_files": admission.INGEST,
+    "/resume_ingest": admission.INGEST,
+    "/import_chat": admission.INGEST,
+}
+
+
+
+def chat_changed(chat_id):
+    """
+    The chat's chunks were offloaded or restored: drop what this worker derived
+    from them, other workers see the new chat version
+    """
+    embedding_store.drop(chat_id)
+    query_cache.invalidate(chat_id)
+
+
+# idle chats' chunks move to S3 and back on their next access, see `activate_chat`
+chat_tiering = ChatTiering(
+    mongo_db_engine, s3, bucket=config.s3_bucket, prefix=config.cold_storage_dir,
+    scope_factory=upload_scope, idle_seconds=config.chat_idle_seconds,
+    touch_interval=config.chat_touch_interval, on_change=chat_changed
+) if config.chat_idle_seconds else None
+offload_task = None
+
+# fields the hybrid candidates carry for collapsing and MMR, dropped before returning
+CANDIDATE_FIELDS = ["file_key", "embedding"]
+
+
+async def startup():
+    global offload_task
+    await jina_ai.start()
+    if chat_tiering is not None and config.chat_offload_interval:
+        offload_task = asyncio.create_task(chat_tiering.run_periodically(
+            config.chat_offload_interval, config.chat_offload_batch))
+
+
+async def shutdown():
+    if offload_task is not None:
+        offload_task.cancel()
+    await jina_ai.close()
+    mongo_db_engine.close()
+    pdf_parser.close()
+
+
+async def activate_chat(chat_id):
+    """Record an access to the chat, restoring it from S3 first when it was offloaded"""
+    if chat_tiering is None:
+        return
+    try:
+        await chat_tiering.access(chat_id)
+    except TimeoutError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+
+async def local_embedding_store(chat_id, chat_version=None):
+    """
+    Open the chat's local embedding store, rebuilding it from MongoDB when it
+    is missing or was built from another version of the chat. The version is
+    checked after `config.embedding_store_ttl`, or right away when the caller
+    already read it.
+    """
+    store = embedding_store.open(chat_id)
+    stale = store is None or store.is_stale(config.embedding_store_ttl)
+    if not stale and chat_version is None:
+        return store
+
+    if chat_version is None:
+        chat_version = await mongo_db_engine.get_chat_version(chat_id)
+    if store is not None and store.chat_version == chat_version:
+        if stale:
+            await run_in_threadpool(store.mark_validated, chat_version)
+        return store
+
+    chunks = await mongo_db_engine.find_chunks(
+        chat_id, fields=[config.embedding_field, *META_FIELDS])
+    for chunk in chunks:
+        chunk["embedding"] = chunk.pop(config.embedding_field)
+    chunks.sort(key=lambda chunk: (chunk.get("file_key") or "", chunk["chunk_id"]))
+    # changed while the chunks were read: not a snapshot of any version
+    if await mongo_db_engine.get_chat_version(chat_id) != chat_version:
+        chat_version = None
+    return await run_in_threadpool(embedding_store.build, chat_id, chunks, chat_version)
+
+
+async def change_chunks(chat_id, write, appended=None):
+    """
+    Run `write()`, which changes the chat's chunks in MongoDB, between two
+    bumps of the chat's version, so every worker's embedding store and query
+    cache of the chat are invalidated. When the change only inserted the
+    chunks `appended`, this worker's store is extended instead of dropped,
+    provided it was built before the change and no other change interleaved.
+    """
+    started = await mongo_db_engine.bump_chat_version(chat_id)
+    await write()
+    chat_version = await mongo_db_engine.bump_chat_version(chat_id)
+    query_cache.invalidate(chat_id)
+
+    if appended is None or chat_version != started + 1 or not await run_in_threadpool(
+            embedding_store.append, chat_id, appended, started - 1, chat_version):
+        embedding_store.drop(chat_id)
+
+
+@router.post("/ingest_file", response_model=IngestResponse)
+async def ingest_file(file_key: str = Form(...), chat_id: str = Form(...), file: UploadFile = File(...),
+                      time_budget: float = Form(None)):
+    """
+    Ingest a PDF page segment by page segment within `time_budget` seconds
+    (`config.ingest_time_budget` by default). Documents that do not fit are
+    returned as "partial" and continue with `/resume_ingest`.
+    """
+    deadline = time.monotonic() + (time_budget or config.ingest_time_budget)
+    await activate_chat(chat_id)
+
+    async with upload_scope() as scope:
+        upload = await scope.spool(file)
+        _, page_count = await asyncio.gather(
+            upload_file_to_s3(upload, file_key),
+            run_in_threadpool(pdf_parser.page_count, upload.source))
+
+        checkpoint = {"chat_id": chat_id,
+                      "file_key": file_key,
+                      "ingest_id": uuid4().hex,
+                      "page_count": page_count,
+                      "next_page": 0,
+                      "chunker": None,
+                      "boilerplate_lines": [],
+                      "text_length": 0,
+                      "extractor": None,
+                      "status": "running"}
+
+        return await ingest_segments(upload.source, checkpoint, deadline)
+
+
+@router.post("/resume_ingest", response_model=IngestResponse)
+async def resume_ingest(payload: ResumeIngestPayLoad):
+    deadline = time.monotonic() + (payload.time_budget or config.ingest_time_budget)
+    await activate_chat(payload.chat_id)
+
+    checkpoint = await mongo_db_engine.get_checkpoint(payload.chat_id, payload.file_key)
+    if checkpoint is None:
+        raise HTTPException(status_code=404, detail="No ingestion found for this file")
+    if checkpoint["status"] == "complete":
+        return ingest_response(checkpoint)
+
+    async with upload_scope() as scope:
+        upload = await scope.download_s3(s3, config.s3_bucket, payload.file_key)
+        return await ingest_segments(upload.source, checkpoint, deadline)
+
+
+async def ingest_segments(source, checkpoint, deadline):
+    """
+    Parse, embed and store the document `config.ingest_segment_pages` pages
+    at a time from the checkpoint on. Every segment is searchable as soon as
+    it is written and the checkpoint is saved after it; the loop stops early
+    when the next segment would not fit before `deadline`.
+    """
+    chat_id = checkpoint["chat_id"]
+    file_key = checkpoint["file_key"]
+    ingest_id = checkpoint["ingest_id"]
     file_name = os.path.basename(file_key)
-    _ = mongo_db_engine.insert_file(
-        file_name, file_key, full_text)
 
-    for chunk in chunk_metas:
-        chunk['chat_id'] = chat_id
-        chunk['file_key'] = file_key
-        chunk['file_name'] = file_name
-
-    # chunk_metas: List[
-    # {"text": str,
-    # "page_number": List[int]),
-    # "word_size": int,
-    # "chunk_id": int
-    # "file_name": str,
-    # "embedding": List[List[float]]
-    # "file_key":str
-    # uploaded_file_id: str
-    # chat_id: str
-    # }[
-
-    mongo_db_engine.insert_embedding(chunk_metas)
+    chunker = pdf_parser.chunker(state=checkpoint["chunker"])
+    if checkpoint.get("extractor") is None:
+        # probing reads a few pages spread over the document, not over one segment
+        checkpoint["extractor"] = await run_in_threadpool(pdf_parser.probe, source)
+
+    # chunks of an earlier version of this file_key not reused by this ingestion yet,
+    # re-uploads only embed the chunks that changed. Chunks this ingestion wrote past
+    # the checkpoint, before a failure kept it from being saved, are reused as well.
+    matcher = incremental.ChunkMatcher(await mongo_db_engine.find_chunks(
+        chat_id, fields=["text", "content_hash", *incremental.POSITION_FIELDS],
+        file_key=file_key, unclaimed_by=ingest_id,
+        claimed_from=(checkpoint["chunker"] or {}).get("chunk_id", 0)))
+
+    segment_seconds = None
+    while checkpoint["status"] != "complete":
+        if segment_seconds is not None and time.monotonic() + segment_seconds > deadline:
+            checkpoint["status"] = "partial"
+            break
+
+        started = time.monotonic()
+        first_page = checkpoint["next_page"]
+        last_page = min(first_page + config.ingest_segment_pages, checkpoint["page_count"])
+        is_last = last_page == checkpoint["page_count"]
+
+        # lines found in earlier segments are stripped even from a segment too short to detect them
+        full_text, page_sentence_list = await run_in_threadpool(
+            pdf_parser.parse_pages, source, list(range(first_page, last_page)),
+            checkpoint.get("boilerplate_lines", ()), checkpoint["extractor"])
+
+        savings = pdf_parser.boilerplate_savings(page_sentence_list)
+        if savings is not None:
+            totals = checkpoint.get("boilerplate") or {}
+            checkpoint["boilerplate"] = {key: totals.get(key, 0) + value
+                                         for key, value in savings.items()}
+            checkpoint["boilerplate_lines"] = sorted(page_sentence_list.boilerplate_lines)
+
+        chunk_metas = chunker.add(page_sentence_list)
+        if is_last:
+            chunk_metas += chunker.finish()
+        pdf_parser.annotate(chunk_metas, file_name)
+        neighbour_map = context.neighbour_map(chunk_metas)
+
+        for chunk in chunk_metas:
+            chunk['chat_id'] = chat_id
+            chunk['file_key'] = file_key
+            chunk['ingest_id'] = ingest_id
+
+        # chunk_metas: List[
+        # {"text": str,
+        # "page_number": List[int]),
+        # "word_size": int,
+        # "chunk_id": int
+        # "content_hash": str,
+        # "file_name": str,
+        # "embedding": List[List[float]]
+        # "file_key":str
+        # "ingest_id": str
+        # uploaded_file_id: str
+        # chat_id: str
+        # }[
+
+        new_chunks, moved = matcher.match(chunk_metas, claim={"ingest_id": ingest_id})
+        removed_ids = matcher.remaining_ids() if is_last else []
+
+        chunks = [chunk['text'] for chunk in new_chunks]
+        embeddings = await jina_ai.get_embeddings_in_batches(chunks)
+        for embedding, metas in zip(embeddings, new_chunks):
+            metas['embedding'] = embedding
+
+        # from the checkpoint's offsets: a segment retried after a failure is not appended twice
+        _ = await mongo_db_engine.append_file_text(
+            file_name, file_key, full_text, reset=first_page == 0, chat_id=chat_id,
+            neighbour_map=neighbour_map, text_offset=checkpoint.get("text_length"),
+            map_offset=(checkpoint["chunker"] or {}).get("chunk_id", 0))
+
+        repositioned = any(field in incremental.POSITION_FIELDS
+                           for _, fields in moved for field in fields)
+        await change_chunks(
+            chat_id,
+            lambda: mongo_db_engine.write_chunk_changes(new_chunks, moved, removed_ids, chat_id),
+            appended=None if repositioned or removed_ids else new_chunks)
+
+        if is_last:
+            file_chunks = await mongo_db_engine.find_chunks(
+                chat_id, fields=[config.embedding_field], file_key=file_key)
+            if file_chunks:
+                await mongo_db_engine.set_file_summary(file_key, summary_vector(
+                    [chunk[config.embedding_field] for chunk in file_chunks]), chat_id=chat_id)
+
+        checkpoint["next_page"] = last_page
+        checkpoint["chunker"] = chunker.state()
+        if "text_length" in checkpoint:  # not in checkpoints saved before it was recorded
+            checkpoint["text_length"] += len(full_text)
+        checkpoint["status"] = "complete" if is_last else "running"
+        await mongo_db_engine.save_checkpoint(checkpoint)
+
+        segment_seconds = time.monotonic() - started
+
+    if checkpoint["status"] == "partial":
+        await mongo_db_engine.save_checkpoint(checkpoint)
+
+    return ingest_response(checkpoint)
+
+
+def ingest_response(checkpoint):
+    if checkpoint["status"] == "complete":
+        response = {"messages": "Ingested file successfully"}
+    else:
+        response = {"messages": f"Ingested {checkpoint['next_page']} of {checkpoint['page_count']} pages",
+                    "status": "partial",
+                    "resumable": True,
+                    "chat_id": checkpoint["chat_id"],
+                    "file_key": checkpoint["file_key"],
+                    "next_page": checkpoint["next_page"],
+                    "page_count": checkpoint["page_count"]}
+
+    if checkpoint.get("boilerplate") is not None:
+        response["boilerplate"] = checkpoint["boilerplate"]
+    return FastJSONResponse(response)
+
+
+@router.post("/ingest_files")
+async def ingest_files(key_prefix: str = Form(...), chat_id: str = Form(...),
+                       files: List[UploadFile] = File(...)):
+    """
+    Ingest many PDFs (or one zip archive of PDFs) into a chat. Files are
+    parsed in parallel and their chunks are packed together into
+    shared embedding requests and a single bulk insert.
+    """
+    await activate_chat(chat_id)
+    async with upload_scope() as scope:
+        uploads = []
+        for file in files:
+            upload = await scope.spool(file)
+            if upload.file_name.lower().endswith(".zip"):
+                uploads.extend(await scope.extract_pdfs(upload))
+            else:
+                uploads.append(upload)
+
+        return await ingest_uploads(uploads, key_prefix, chat_id)
+
+
+async def ingest_uploads(uploads, key_prefix, chat_id):
+    """
+    Upload, parse, embed and store `uploads` as files of the chat. A file
+    failing to parse or embed is reported on its own and its S3 object is
+    deleted again, unless its file_key already had chunks referring to it.
+    """
+    file_keys = upload_keys(key_prefix, [upload.file_name for upload in uploads])
+
+    s3_uploads = asyncio.gather(*[upload_file_to_s3(upload, file_key)
+                                  for upload, file_key in zip(uploads, file_keys)],
+                                return_exceptions=True)
+    parsing = run_in_threadpool(pdf_parser.parse_many, [upload.source for upload in uploads],
+                                max_workers=config.parse_workers, with_stats=True)
+    upload_results, parsed = await asyncio.gather(s3_uploads, parsing)
+
+    uploaded = [file_key for file_key, error in zip(file_keys, upload_results) if error is None]
+    # re-uploaded files keep the chunks whose text did not change, only the others are embedded
+    stored = dict(zip(uploaded, await asyncio.gather(*[mongo_db_engine.find_chunks(
+        chat_id, fields=["text", "content_hash", config.embedding_field,
+                         *incremental.POSITION_FIELDS],
+        file_key=file_key) for file_key in uploaded])))
+
+    statuses = {}
+    ingested = []
+    for file_key, upload_error, result in zip(file_keys, upload_results, parsed):
+        file_name = os.path.basename(file_key)
+        error = upload_error or (
+            result if isinstance(result, Exception) else None)
+        if error is not None:
+            statuses[file_key] = {"file_key": file_key, "status": "failed",
+                                  "error": str(error)}
+            continue
+
+        full_text, chunk_metas, savings = result
+        for chunk in chunk_metas:
+            chunk['chat_id'] = chat_id
+            chunk['file_key'] = file_key
+            chunk['file_name'] = file_name
+
+        file_new, file_moved, file_removed = incremental.diff_chunks(
+            chunk_metas, stored[file_key])
+        ingested.append((file_key, full_text, chunk_metas, file_new, file_moved, file_removed))
+        statuses[file_key] = {"file_key": file_key, "status": "ingested",
+                              "num_chunks": len(chunk_metas),
+                              "boilerplate": savings}
+
+    errors = await embed_files([file_new for _, _, _, file_new, _, _ in ingested])
+    for (file_key, *_), error in zip(ingested, errors):
+        if error is not None:
+            statuses[file_key] = {"file_key": file_key, "status": "failed",
+                                  "error": str(error)}
+    ingested = [item for item, error in zip(ingested, errors) if error is None]
+
+    new_chunks, moved, removed_ids = [], [], []
+    file_records = []
+    for file_key, full_text, chunk_metas, file_new, file_moved, file_removed in ingested:
+        new_chunks.extend(file_new)
+        moved.extend(file_moved)
+        removed_ids.extend(file_removed)
+        removed = set(file_removed)
+        file_embeddings = [chunk[config.embedding_field] for chunk in stored[file_key]
+                           if chunk["_id"] not in removed]
+        file_embeddings += [chunk['embedding'] for chunk in file_new]
+        file_records.append(file_record(
+            os.path.basename(file_key), file_key, full_text, chat_id,
+            summary_vector(file_embeddings) if file_embeddings else None,
+            context.neighbour_map(chunk_metas)))
+
+    await delete_uploads([file_key for file_key in uploaded if not stored[file_key]
+                          and statuses[file_key]["status"] == "failed"])
+
+    # a failed write fails the request: sending it again reuses the same keys and chunks
+    await mongo_db_engine.upsert_file_records(file_records)
+    repositioned = any(field in incremental.POSITION_FIELDS
+                       for _, fields in moved for field in fields)
+    await change_chunks(
+        chat_id,
+        lambda: mongo_db_engine.write_chunk_changes(new_chunks, moved, removed_ids, chat_id),
+        appended=None if repositioned or removed_ids else new_chunks)
+
+    statuses = list(statuses.values())
+    num_ingested = sum(status["status"] == "ingested" for status in statuses)
+    return {"messages": f"Ingested {num_ingested} of {len(statuses)} files",
+            "files": statuses}
+
+
+async def embed_files(new_chunks_by_file):
+    """
+    Embed the new chunks of several files, packed into shared requests. When
+    that fails, the files are embedded one by one so that only the failing
+    ones are lost. Returns each file's error, None once its chunks are embedded.
+    """
+    new_chunks = [chunk for file_new in new_chunks_by_file for chunk in file_new]
+    if not new_chunks:
+        return [None] * len(new_chunks_by_file)
+
+    try:
+        embeddings = await jina_ai.get_embeddings_in_batches(
+            [chunk['text'] for chunk in new_chunks])
+    except Exception as e:
+        if len(new_chunks_by_file) == 1:
+            return [e]
+        print(f"Error embedding {len(new_chunks_by_file)} files, retrying each: {str(e)}")
+        errors = await asyncio.gather(*[embed_files([file_new])
+                                        for file_new in new_chunks_by_file])
+        return [file_errors[0] for file_errors in errors]
+
+    for embedding, metas in zip(embeddings, new_chunks):
+        metas['embedding'] = embedding
+    return [None] * len(new_chunks_by_file)
+
+
+async def delete_uploads(file_keys):
+    """Delete uploaded S3 objects that no record refers to, errors are only logged"""
+    for start in range(0, len(file_keys), 1000):  # delete_objects takes 1000 keys at most
+        try:
+            await run_in_threadpool(
+                s3.delete_objects, Bucket=config.s3_bucket,
+                Delete={"Objects": [{"Key": key} for key in file_keys[start:start + 1000]]})
+        except Exception as e:
+            print(f"Error deleting uploads: {str(e)}")
+
+
+async def route_files(embedding, chat_id, top_files, chat_version=None):
+    """
+    First stage of a two-stage search: the `top_files` files of the chat whose
+    summary vector is closest to the query. None searches the whole chat.
+    `chat_version`, when already read, validates the local store right away.
+    """
+    if top_files <= 0:
+        return None
+
+    if config.use_embedding_store:
+        store = await local_embedding_store(chat_id, chat_version)
+        file_keys = store.rank_files(embedding, limit=top_files)
+    else:
+        file_keys = await mongo_db_engine.rank_files(
+            query_vector=embedding, chat_id=chat_id, limit=top_files)
+
+    # files ingested before summary vectors existed are not ranked
+    return file_keys or None
+
+
+async def search_by_embedding(embedding, chat_id, limit, file_keys=None, keep_fields=(),
+                              chat_version=None):
+    if config.use_embedding_store:
+        store = await local_embedding_store(chat_id, chat_version)
+        return store.search(embedding, limit=limit, file_keys=file_keys,
+                            keep_fields=keep_fields)
+
+    return await mongo_db_engine.vector_search(
+        query_vector=embedding, chat_id=chat_id, limit=limit, file_keys=file_keys,
+        keep_fields=keep_fields)
+
+
+@router.get("/vector_search", response_model=List[SearchResult])
+@coalesce
+async def vector_search(query: str, chat_id: str, limit: int = 5, top_files: int = 0,
+                        expand: int = 0):
+    """
+    `top_files` > 0 restricts the search to the chat's best matching files,
+    `expand` > 0 adds each result's `expand` neighbouring chunks on each side
+    as its "context"
+    """
+    await activate_chat(chat_id)
+    expand = min(max(expand, 0), config.max_context_expand)
+
+    embedding = (await jina_ai.get_embeddings([query]))[0]
+    file_keys = await route_files(embedding, chat_id, top_files)
+
+    results = await search_by_embedding(embedding, chat_id, limit, file_keys,
+                                        keep_fields=["file_key"] if expand else ())
+    if expand:
+        await context.expand_results(mongo_db_engine, chat_id, results, expand)
+        for item in results:
+            item.pop("file_key", None)
+
+    return FastJSONResponse(results)
+
+
+@router.get("/keyword_search", response_model=List[SearchResult])
+@coalesce
+async def keyword_search(query: str, chat_id: str, limit: int = 5, top_files: int = 0):
+    await activate_chat(chat_id)
+    file_keys = None
+    if top_files > 0:
+        embedding = (await jina_ai.get_embeddings([query]))[0]
+        file_keys = await route_files(embedding, chat_id, top_files)
+
+    results = await mongo_db_engine.keyword_search(
+        query=query, chat_id=chat_id, limit=limit, file_keys=file_keys)
+
+    return FastJSONResponse(results)
+
+
+@router.get("/hybrid_search", response_model=List[SearchResult])
+@coalesce
+async def hybrid_search(query: str, chat_id: str, limit: int = 5, top_files: int = 0,
+                        expand: int = 0):
+    """
+    Keyword + vector search, reranked. Each search fetches
+    `hybrid_candidates_factor` times `limit` candidates; neighbouring chunks
+    are collapsed and MMR keeps `rerank_candidates_factor` times `limit`
+    relevant but diverse ones for the reranker. Rephrasings of a recent
+    query of the chat are answered from `query_cache`. `expand` adds
+    neighbouring chunks as with `vector_search`.
+    """
+    await activate_chat(chat_id)
+    expand = min(max(expand, 0), config.max_context_expand)
+    # embed once: the cache lookup, the file routing, the vector search and MMR share it.
+    # The chat version keys the cache, changes made by any worker miss it
+    embeddings, chat_version = await asyncio.gather(
+        jina_ai.get_embeddings([query]), mongo_db_engine.get_chat_version(chat_id))
+    embedding = embeddings[0]
+
+    cache_params = (limit, top_files, expand)
+    if config.use_query_cache:
+        cached = query_cache.get(chat_id, embedding, cache_params, chat_version)
+        if cached is not None:
+            return FastJSONResponse(cached)
+
+    file_keys = await route_files(embedding, chat_id, top_files, chat_version)
+    num_candidates = limit * config.hybrid_candidates_factor
+    keyword_search_results, vector_search_results = await asyncio.gather(
+        mongo_db_engine.keyword_search(
+            query=query, chat_id=chat_id, limit=num_candidates, file_keys=file_keys,
+            keep_fields=CANDIDATE_FIELDS),
+        search_by_embedding(embedding, chat_id, num_candidates, file_keys,
+                            keep_fields=CANDIDATE_FIELDS, chat_version=chat_version))
+
+    deduplicated_search_result = deduplicate(vector_search_results, keyword_search_results,
+                                             id_field=('file_key', 'chunk_id'))
+    selected = candidates.select_for_rerank(
+        embedding, deduplicated_search_result, k=limit * config.rerank_candidates_factor,
+        diversity=config.mmr_diversity)
+
+    reranked_results = await rerank_results(query, selected, limit)
+    if expand:
+        await context.expand_results(mongo_db_engine, chat_id, reranked_results, expand)
+    for item in reranked_results:
+        for field in CANDIDATE_FIELDS:
+            item.pop(field, None)
+
+    if config.use_query_cache:
+        query_cache.put(chat_id, embedding, reranked_results, cache_params, chat_version)
+
+    return FastJSONResponse(reranked_results)
+
+
+async def rerank_results(query, search_results, limit):
+
+    chunks = [item["text"] for item in search_results]
+
+    reranked_indics, relevance_scores = await jina_ai.rerank(
+        query=query, chunks=chunks, top_n=limit)
 
-    return {"messages": "Ingested file successfully"}
+    reranked_results = [search_results[index] for index in reranked_indics]
 
+    for score, item in zip(relevance_scores, reranked_results):
+        item["score"] = score
 
-@router.get("/vector_search")
-async def vector_search(query: str, chat_id: str, limit: int = 5):
+    return reranked_results
 
-    embedding = jina_ai.get_embeddings([query])[0]
 
-    results = mongo_db_engine.vector_search(
-        query_vector=embedding, chat_id=chat_id, limit=limit)
+@router.get("/embedding_stats")
+async def embedding_stats():
+    """Current embedding batch size / concurrency and the controller's recent decisions"""
+    if jina_ai.controller is None:
+        return {"adaptive_batching": False, "batch_size": jina_ai.batch_size,
+                "concurrency": jina_ai.concurrency}
 
-    return results
+    return {"adaptive_batching": True, **jina_ai.controller.snapshot()}
 
 
-@router.get("/keyword_search")
-async def keyword_search(query: str, chat_id: str, limit: int = 5):
-    results = mongo_db_engine.keyword_search(
-        query=query, chat_id=chat_id, limit=limit)
+@router.get("/reembed_status")
+async def reembed_status(job_id: str):
+    """Progress, throughput and ETA of a re-embedding job (see reembed_tool.py)"""
+    job = await mongo_db_engine.get_reembed_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No re-embedding job {job_id}")
 
-    return results
+    for field in ("last_id", "last_file_id"):
+        if job.get(field) is not None:
+            job[field] = str(job[field])
+    return job
 
 
-@router.get("/hybrid_search")
-async def hybrid_search(query: str, chat_id: str, limit: int = 5):
-    keyword_search_results = await keyword_search(
-        query=query, chat_id=chat_id, limit=limit)
+@router.post("/export_chat")
+async def export_chat(payload: ExportChatPayLoad):
+    """Write the chat's files and chunks, embeddings included, as one archive on S3"""
+    s3_key = payload.s3_key or f"{config.s3_root_dir}/exports/{payload.chat_id}.chatidx"
+    await activate_chat(payload.chat_id)
 
-    vector_search_results = await vector_search(
-        query=query, chat_id=chat_id, limit=limit)
+    async with upload_scope() as scope:
+        # reserve about the size of the embeddings plus the chunk text
+        num_chunks = await mongo_db_engine.count_chunks(payload.chat_id)
+        file_path = await scope.reserve_path(
+            os.path.basename(s3_key), num_chunks * (config.embedding_dim * 4 + 2048))
 
-    deduplicated_search_result = deduplicate(vector_search_results,
-                                             keyword_search_results, id_field='chunk_id')
+        manifest = await chat_archive.export_chat(mongo_db_engine, payload.chat_id, file_path)
+        upload = SpooledUpload(os.path.basename(s3_key), path=file_path)
+        size = upload.size
+        await upload_file_to_s3(upload, s3_key)
 
-    chunks = [item["text"] for item in deduplicated_search_result]
+    return {**manifest, "s3_key": s3_key, "size": size}
 
-    reranked_indics, relevance_scores = jina_ai.rerank(
-        query=query, chunks=chunks, top_n=limit)
 
-    reranked_results = np.array(deduplicated_search_result)[
-        reranked_indics].tolist()
+@router.post("/import_chat")
+async def import_chat(payload: ImportChatPayLoad):
+    """Restore an exported chat, under `chat_id` if given, without re-embedding"""
+    if payload.chat_id:
+        await activate_chat(payload.chat_id)
+    async with upload_scope() as scope:
+        upload = await scope.download_s3(s3, config.s3_bucket, payload.s3_key)
+        try:
+            with upload.open() as f:
+                manifest = await chat_archive.import_chat(
+                    mongo_db_engine, f, chat_id=payload.chat_id, replace=payload.replace)
+        except FileExistsError as e:
+            raise HTTPException(status_code=409, detail=str(e))
 
-    for score, item in zip(relevance_scores, reranked_results):
-        item["score"] = score
+    embedding_store.drop(manifest["chat_id"])
+    query_cache.invalidate(manifest["chat_id"])
 
-    return reranked_results
+    return manifest
 
 
 @router.delete("/delete_file")
 async def delete_file(payload: DeleteFilePayLoad):
     file_key = payload.file_key
 
-    s3.delete_object(
+    await run_in_threadpool(
+        s3.delete_object,
         Bucket=config.s3_bucket,
         Key=file_key
     )
@@ -131,15 +761,31 @@ async def delete_file(payload: DeleteFilePayLoad):
     return {"message": "File deleted successfully"}
 
 
+@router.post("/offload_idle_chats")
+async def offload_idle_chats(limit: int = None):
+    """Move up to `limit` chats idle for `config.chat_idle_seconds` to S3 now"""
+    if chat_tiering is None:
+        raise HTTPException(status_code=400, detail="Chat offloading is disabled")
+
+    offloaded = await chat_tiering.offload_idle(limit or config.chat_offload_batch)
+    return {"offloaded": offloaded}
+
+
 def deduplicate(search_results_1, search_results_2, id_field):
+    """`id_field` is a field name, or a tuple of fields forming the id"""
+
+    def item_id(item):
+        if isinstance(id_field, tuple):
+            return tuple(item.get(field) for field in id_field)
+        return item[id_field]
 
     deduplicated = search_results_1.copy()
 
-    search_ids = set([item[id_field]
+    search_ids = set([item_id(item)
                       for item in search_results_1])
 
     for item in search_results_2:
-        if item[id_field] not in search_ids:
+        if item_id(item) not in search_ids:
             deduplicated.append(item)
 
     return deduplicated
@@ -154,4 +800,13 @@ start_time = start_time.strftime(DATE_FORMAT)
 @router.get(f"/health_check")
 async def health_check():
     response = f"The server is up since {start_time}"
-    return {"message": response, "start_hk_time": start_time}
\ No newline at end of file
+    return {"message": response, "start_hk_time": start_time,
+            "query_cache": query_cache.stats(),
+            "temp_space": temp_space.stats(),
+            "admission": admission_control.stats(),
+            "single_flight": {"search": search_flights.stats(),
+                              "embeddings": jina_ai.single_flight.stats()},
+            "chat_tiering": chat_tiering.stats() if chat_tiering is not None else None,
+            "worker_pid": os.getpid(),
+            "shared_embedding_cache": jina_ai.shared_cache.stats()
+            if jina_ai.shared_cache is not None else None}
\ No newline at end of file
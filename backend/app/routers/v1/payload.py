@@ -1,5 +1,23 @@
+from typing import Optional
 from pydantic import BaseModel
 
 
 class DeleteFilePayLoad(BaseModel):
     file_key: str
+
+
+class ResumeIngestPayLoad(BaseModel):
+    file_key: str
+    chat_id: str
+    time_budget: Optional[float] = None
+
+
+class ExportChatPayLoad(BaseModel):
+    chat_id: str
+    s3_key: Optional[str] = None
+
+
+class ImportChatPayLoad(BaseModel):
+    s3_key: str
+    chat_id: Optional[str] = None
+    replace: bool = False
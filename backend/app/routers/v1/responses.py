@@ -0,0 +1,62 @@
+import json
+from typing import Dict, List, Optional
+
+import numpy as np
+from pydantic import BaseModel
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:  # optional, several times faster than json
+    orjson = None
+
+
+class SearchContext(BaseModel):
+    text: str
+    chunk_ids: List[int]
+    page_number: List[int]
+
+
+class SearchResult(BaseModel):
+    text: str
+    chunk_id: int
+    page_number: List[int]
+    score: float
+    # with `expand`: the result with its neighbouring chunks
+    context: Optional[SearchContext] = None
+
+
+class IngestResponse(BaseModel):
+    messages: str
+    status: Optional[str] = None
+    resumable: Optional[bool] = None
+    chat_id: Optional[str] = None
+    file_key: Optional[str] = None
+    next_page: Optional[int] = None
+    page_count: Optional[int] = None
+    boilerplate: Optional[Dict[str, int]] = None
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class FastJSONResponse(Response):
+    """
+    JSON response rendered straight from plain dicts / lists with orjson
+    (json without it). Endpoints declare their `response_model` for the
+    API schema and return this response, which skips FastAPI's
+    `jsonable_encoder` walk and response model validation.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":"),
+                          default=_json_default).encode("utf-8")
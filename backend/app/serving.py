@@ -0,0 +1,60 @@
+import gc
+import math
+import os
+from typing import Optional
+
+
+def available_cores() -> int:
+    """CPUs this process may use: its affinity, capped by a cgroup CPU quota (containers)"""
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cores = min(cores, max(1, math.ceil(quota)))
+    return cores
+
+
+def cgroup_cpu_quota() -> Optional[float]:
+    """CPUs granted by the cgroup v2 `cpu.max` or v1 `cfs_quota_us`, None when unlimited"""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+
+def worker_count(configured: Optional[int] = None) -> int:
+    """`configured`, or one worker per available core"""
+    return configured if configured else available_cores()
+
+
+def preload() -> None:
+    """
+    Load in the master, before forking, what every worker would otherwise
+    load on its first request: NLTK data and the sentence tokenizer. Then
+    move everything allocated so far out of the garbage collector's reach,
+    so collections in the workers do not touch (and copy) the shared pages.
+    """
+    from app import pdf_utils
+
+    pdf_utils.ensure_nltk_data()
+    try:
+        pdf_utils.split_sentences(["Warm up the tokenizer. It is shared."], [0])
+    except Exception as e:
+        print(f"Could not preload the sentence tokenizer: {str(e)}")
+
+    gc.collect()
+    gc.freeze()
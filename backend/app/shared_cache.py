@@ -0,0 +1,75 @@
+import hashlib
+import mmap
+import multiprocessing
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+class SharedEmbeddingCache():
+    """
+    Direct-mapped table of text -> embedding in an anonymous shared memory
+    mapping. Created before the serving workers are forked (see
+    gunicorn.conf.py), it is the same memory in every worker, so a query
+    embedded by one worker is a hit in all the others.
+
+    Each slot holds a version, a 64-bit key hash and the vector. Writers
+    take a process-shared lock and make the version odd while writing;
+    readers take no lock and drop a slot whose version is odd or changed
+    while they copied it. A newer key simply overwrites its slot.
+    """
+
+    def __init__(self, dim: int, slots: int) -> None:
+        self.dim = dim
+        self.slots = slots
+        self._buffer = mmap.mmap(-1, slots * (16 + 4 * dim))
+        self._versions = np.ndarray((slots,), dtype=np.uint64, buffer=self._buffer)
+        self._keys = np.ndarray((slots,), dtype=np.uint64, buffer=self._buffer,
+                                offset=8 * slots)
+        self._vectors = np.ndarray((slots, dim), dtype=np.float32, buffer=self._buffer,
+                                   offset=16 * slots)
+        self._lock = multiprocessing.Lock()
+        # per worker
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(namespace: str, text: str) -> int:
+        digest = hashlib.blake2b(f"{namespace}\0{text}".encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") or 1  # 0 marks an empty slot
+
+    def get(self, namespace: str, text: str) -> Optional[List[float]]:
+        key = self.key(namespace, text)
+        slot = key % self.slots
+        version = int(self._versions[slot])
+        if version % 2 == 0 and int(self._keys[slot]) == key:
+            vector = self._vectors[slot].tolist()
+            if int(self._versions[slot]) == version:
+                self.hits += 1
+                return vector
+
+        self.misses += 1
+        return None
+
+    def put(self, namespace: str, text: str, vector: List[float]) -> None:
+        if len(vector) != self.dim:
+            return
+        key = self.key(namespace, text)
+        slot = key % self.slots
+        # never wait on a worker that died holding the lock, the entry is optional
+        if not self._lock.acquire(timeout=0.01):
+            return
+        try:
+            self._versions[slot] += 1
+            self._keys[slot] = key
+            self._vectors[slot] = vector
+            self._versions[slot] += 1
+        finally:
+            self._lock.release()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {"slots": self.slots,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
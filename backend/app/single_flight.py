@@ -0,0 +1,78 @@
+import asyncio
+import functools
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class _Call():
+
+    def __init__(self, task: asyncio.Task) -> None:
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight():
+    """
+    Concurrent calls with the same key share one in-flight computation:
+    the first caller (the leader) starts it, callers arriving before it
+    finishes (followers) wait for the same result. Nothing is kept once it
+    finishes, this is not a cache.
+
+    The computation runs in its own task, so a caller that is cancelled
+    (its client went away) does not cancel it for the others; it is
+    cancelled when every caller has gone. When it fails, every caller gets
+    the error and the next call with the key starts afresh.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, _Call] = {}
+        self.calls = 0
+        self.executions = 0
+
+    async def do(self, key: Hashable, fn: Callable[..., Awaitable], *args, **kwargs) -> Any:
+        self.calls += 1
+        call = self._calls.get(key)
+        if call is None:
+            self.executions += 1
+            call = _Call(asyncio.ensure_future(fn(*args, **kwargs)))
+            self._calls[key] = call
+            call.task.add_done_callback(functools.partial(self._forget, key, call))
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+
+    def _forget(self, key: Hashable, call: _Call, task: asyncio.Task) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not task.cancelled():
+            # retrieve the error so an unawaited failure is not logged as lost
+            task.exception()
+
+    def wrap(self, fn: Callable[..., Awaitable],
+             on_follow: Callable[[], None] = None) -> Callable[..., Awaitable]:
+        """
+        `fn` with calls of the same keyword arguments coalesced, keeps its
+        signature for FastAPI. `on_follow` is called by every follower
+        before it waits.
+        """
+
+        @functools.wraps(fn)
+        async def wrapper(**kwargs):
+            key = (fn.__name__, *sorted(kwargs.items()))
+            if on_follow is not None and key in self._calls:
+                on_follow()
+            return await self.do(key, fn, **kwargs)
+
+        return wrapper
+
+    def stats(self) -> Dict:
+        coalesced = self.calls - self.executions
+        return {"calls": self.calls,
+                "executions": self.executions,
+                "coalesced": coalesced,
+                "coalescing_ratio": coalesced / self.calls if self.calls else 0.0,
+                "in_flight": len(self._calls)}
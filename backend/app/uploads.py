@@ -0,0 +1,226 @@
+import asyncio
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+from typing import Dict, List, Optional, Union
+
+from app import profiling
+
+TMP_DIR = "/tmp"
+
+
+class TempSpace():
+    """
+    Budget for bytes spooled to local disk by the requests of this process
+    (each prefork worker has its own, see gunicorn.conf.py). A reservation
+    that does not fit waits until other requests release theirs; one larger
+    than the whole quota only runs when nothing else holds space.
+    """
+
+    def __init__(self, quota_bytes: int) -> None:
+        self.quota_bytes = quota_bytes
+        self.used_bytes = 0
+        self.waiting = 0
+        self._condition = asyncio.Condition()
+
+    async def reserve(self, size: int) -> None:
+        async with self._condition:
+            self.waiting += 1
+            try:
+                await self._condition.wait_for(
+                    lambda: self.used_bytes + size <= self.quota_bytes or self.used_bytes == 0)
+            finally:
+                self.waiting -= 1
+            self.used_bytes += size
+
+    async def release(self, size: int) -> None:
+        async with self._condition:
+            self.used_bytes -= size
+            self._condition.notify_all()
+
+    def stats(self) -> Dict:
+        return {"quota_bytes": self.quota_bytes,
+                "used_bytes": self.used_bytes,
+                "waiting": self.waiting}
+
+
+class SpooledUpload():
+    """A file of the request, kept in memory (`data`) or spilled to disk (`path`)"""
+
+    def __init__(self, file_name: str, data: Optional[bytes] = None,
+                 path: Optional[str] = None) -> None:
+        self.file_name = file_name
+        self.data = data
+        self.path = path
+
+    @property
+    def source(self) -> Union[bytes, str]:
+        # what the PDF parsers accept: the bytes themselves or a path
+        return self.data if self.data is not None else self.path
+
+    @property
+    def size(self) -> int:
+        return len(self.data) if self.data is not None else os.path.getsize(self.path)
+
+    def open(self):
+        return io.BytesIO(self.data) if self.data is not None else open(self.path, "rb")
+
+
+class UploadScope():
+    """
+    The temporary files of one request. Files up to `spool_threshold` bytes
+    stay in memory, larger ones are written under a private directory after
+    reserving their size from `temp_space`. Leaving the `async with` block,
+    normally or on an error, deletes the directory and releases the space.
+    """
+
+    def __init__(self, temp_space: TempSpace, spool_threshold: int,
+                 tmp_dir: str = TMP_DIR) -> None:
+        self.temp_space = temp_space
+        self.spool_threshold = spool_threshold
+        self.tmp_dir = tmp_dir
+        self.reserved_bytes = 0
+        self._dir = None
+
+    async def __aenter__(self) -> "UploadScope":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.cleanup()
+
+    async def cleanup(self) -> None:
+        if self._dir is not None:
+            await profiling.to_thread(shutil.rmtree, self._dir, True)
+            self._dir = None
+        if self.reserved_bytes:
+            await self.temp_space.release(self.reserved_bytes)
+            self.reserved_bytes = 0
+
+    async def reserve(self, size: int) -> None:
+        await self.temp_space.reserve(size)
+        self.reserved_bytes += size
+
+    async def release(self, size: int) -> None:
+        await self.temp_space.release(size)
+        self.reserved_bytes -= size
+
+    async def reserve_path(self, file_name: str, size: int) -> str:
+        """A new path under the request's directory, once `size` bytes are available"""
+        await self.reserve(size)
+        return self._new_path(file_name)
+
+    def _new_path(self, file_name: str) -> str:
+        if self._dir is None:
+            os.makedirs(self.tmp_dir, exist_ok=True)
+            self._dir = tempfile.mkdtemp(prefix="upload-", dir=self.tmp_dir)
+        file_dir = tempfile.mkdtemp(dir=self._dir)
+        return os.path.join(file_dir, os.path.basename(file_name))
+
+    async def spool(self, file) -> SpooledUpload:
+        """
+        Take over a FastAPI `UploadFile`. Starlette has already written
+        bodies over 1 MB to a temporary file of its own: that copy counts
+        toward the quota too and is closed (deleted) as soon as it is read.
+        """
+        size = await profiling.to_thread(_stream_size, file.file)
+        spooled_size = size if _on_disk(file.file) else 0
+        in_memory = size <= self.spool_threshold
+
+        # one reservation for both copies, so two requests cannot each hold half
+        await self.reserve(spooled_size + (0 if in_memory else size))
+        try:
+            if in_memory:
+                upload = SpooledUpload(file.filename, data=await file.read())
+            else:
+                path = self._new_path(file.filename)
+                await profiling.to_thread(_copy_to_path, file.file, path)
+                upload = SpooledUpload(file.filename, path=path)
+        finally:
+            if spooled_size:
+                await profiling.to_thread(file.file.close)
+                await self.release(spooled_size)
+
+        return upload
+
+    async def extract_pdfs(self, upload: SpooledUpload) -> List[SpooledUpload]:
+        """The PDFs of a zip archive, spooled like uploads"""
+        pdfs = []
+        with upload.open() as f, zipfile.ZipFile(f) as archive:
+            for member in archive.infolist():
+                # keep the folders, two of them may each hold a report.pdf
+                file_name = _relative_path(member.filename)
+                if member.is_dir() or not file_name.lower().endswith(".pdf"):
+                    continue
+                if os.path.basename(file_name).startswith("._"):  # macOS resource forks
+                    continue
+
+                if member.file_size <= self.spool_threshold:
+                    data = await profiling.to_thread(archive.read, member)
+                    pdfs.append(SpooledUpload(file_name, data=data))
+                    continue
+
+                path = await self.reserve_path(file_name, member.file_size)
+                await profiling.to_thread(_extract_member, archive, member, path)
+                pdfs.append(SpooledUpload(file_name, path=path))
+
+        return pdfs
+
+    async def download_s3(self, s3, bucket: str, key: str) -> SpooledUpload:
+        file_name = os.path.basename(key)
+        head = await profiling.to_thread(s3.head_object, Bucket=bucket, Key=key)
+        if head["ContentLength"] <= self.spool_threshold:
+            buffer = io.BytesIO()
+            await profiling.to_thread(s3.download_fileobj, bucket, key, buffer)
+            return SpooledUpload(file_name, data=buffer.getvalue())
+
+        path = await self.reserve_path(file_name, head["ContentLength"])
+        await profiling.to_thread(s3.download_file, bucket, key, path)
+        return SpooledUpload(file_name, path=path)
+
+
+def upload_keys(key_prefix: str, file_names: List[str]) -> List[str]:
+    """
+    S3 keys of a batch of uploads: the prefix plus each file's path (inside
+    its zip archive for extracted files). A name seen before in the batch
+    gets a "-2", "-3"... suffix so no upload overwrites another.
+    """
+    keys = []
+    for file_name in file_names:
+        key = f"{key_prefix.rstrip('/')}/{_relative_path(file_name)}"
+        root, ext = os.path.splitext(key)
+        suffix = 1
+        while key in keys:
+            suffix += 1
+            key = f"{root}-{suffix}{ext}"
+        keys.append(key)
+    return keys
+
+
+def _relative_path(file_name: str) -> str:
+    # no absolute paths or ".." out of the prefix, "\\" from zips made on Windows
+    parts = file_name.replace("\\", "/").split("/")
+    return "/".join(part for part in parts if part not in ("", ".", ".."))
+
+
+def _stream_size(stream) -> int:
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+
+def _on_disk(stream) -> bool:
+    # a SpooledTemporaryFile moves to disk ("rolls over") past its max_size
+    return isinstance(stream, tempfile.SpooledTemporaryFile) and stream._rolled
+
+
+def _copy_to_path(stream, path: str) -> None:
+    with open(path, "wb") as f:
+        shutil.copyfileobj(stream, f, 1024 * 1024)
+
+
+def _extract_member(archive: zipfile.ZipFile, member: zipfile.ZipInfo, path: str) -> None:
+    with archive.open(member) as src, open(path, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
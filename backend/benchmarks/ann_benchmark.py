@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.ann_index import IVFPQIndex  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description='recall / latency of IVFPQIndex against exact dot-product search')
+
+parser.add_argument('--num_vectors', type=int, default=1000000)
+parser.add_argument('--num_queries', type=int, default=200)
+parser.add_argument('--dim', type=int, default=768)
+parser.add_argument('--n_lists', type=int, default=1024)
+parser.add_argument('--n_subvectors', type=int, default=48)
+parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16, 32])
+parser.add_argument('--k', type=int, default=10)
+
+# pylint:disable=redefined-outer-name,invalid-name
+
+
+def synthetic_embeddings(num_vectors, dim, n_topics=2000, seed=0):
+    """Clustered, L2-normalised vectors, closer to real embeddings than pure noise"""
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((n_topics, dim)).astype(np.float32)
+    vectors = np.empty((num_vectors, dim), dtype=np.float32)
+    for start in range(0, num_vectors, 100000):
+        size = min(100000, num_vectors - start)
+        noise = 0.6 * rng.standard_normal((size, dim)).astype(np.float32)
+        vectors[start:start+size] = topics[rng.integers(n_topics, size=size)] + noise
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    vectors = synthetic_embeddings(args.num_vectors + args.num_queries, args.dim)
+    queries, vectors = vectors[:args.num_queries], vectors[args.num_queries:]
+
+    start = time.perf_counter()
+    exact_top = []
+    for query in queries:
+        scores = vectors @ query
+        exact_top.append(set(np.argpartition(-scores, args.k)[:args.k].tolist()))
+    exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+    print(f"exact search: {exact_ms:.2f} ms/query")
+
+    index = IVFPQIndex(dim=args.dim, n_lists=args.n_lists,
+                       n_subvectors=args.n_subvectors)
+    start = time.perf_counter()
+    index.train(vectors)
+    print(f"train: {time.perf_counter() - start:.1f} s")
+
+    start = time.perf_counter()
+    index.add(vectors, ids=list(range(len(vectors))))
+    print(f"add: {time.perf_counter() - start:.1f} s")
+    index.search(queries[0], k=args.k)  # compacts the lists
+
+    for nprobe in args.nprobe:
+        latencies = []
+        hits = 0
+        for query, expected in zip(queries, exact_top):
+            start = time.perf_counter()
+            ids, _ = index.search(query, k=args.k, nprobe=nprobe)
+            latencies.append(time.perf_counter() - start)
+            hits += len(expected.intersection(ids))
+
+        latencies = np.array(latencies) * 1000
+        print(f"nprobe={nprobe:<3} recall@{args.k}={hits / (args.k * len(queries)):.3f} "
+              f"p50={np.percentile(latencies, 50):.2f} ms "
+              f"p99={np.percentile(latencies, 99):.2f} ms")
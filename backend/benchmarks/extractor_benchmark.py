@@ -0,0 +1,64 @@
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import pdf_extractors, pdf_utils  # noqa: E402
+from app.config import config  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description='text extraction throughput of every installed PDF backend')
+
+parser.add_argument('--pdf_dir', type=str, required=True,
+                    help='directory of sample PDFs')
+parser.add_argument('--repeat', type=int, default=1)
+
+# pylint:disable=redefined-outer-name,invalid-name
+
+
+def run_backend(backend, file_paths, repeat):
+    pages = 0
+    num_bytes = 0
+    chunks = 0
+    failures = 0
+    elapsed = 0.0
+    for file_path in file_paths:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            try:
+                texts = pdf_extractors.extract_pages(file_path, backend=backend)
+            except Exception:
+                failures += 1
+                continue
+            elapsed += time.perf_counter() - start
+            pages += len(texts)
+            num_bytes += os.path.getsize(file_path)
+
+        # chunk output has to stay comparable across backends
+        try:
+            _, sentences = pdf_utils.parse_pdf(file_path, extractor=backend)
+            chunks += len(pdf_utils.merge_sentences_to_chunks(
+                sentences, config.sentence_size, config.overlapping_num))
+        except Exception:
+            pass
+
+    return {"pages/s": pages / elapsed if elapsed else 0.0,
+            "MB/s": num_bytes / 1024 / 1024 / elapsed if elapsed else 0.0,
+            "chunks": chunks,
+            "failures": failures}
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+    file_paths = sorted(glob.glob(os.path.join(args.pdf_dir, "**", "*.pdf"), recursive=True))
+    print(f"{len(file_paths)} PDFs in {args.pdf_dir}")
+
+    for backend in pdf_extractors.available_extractors() + ["auto"]:
+        result = run_backend(backend, file_paths, args.repeat)
+        print(f"{backend:<9} pages/s={result['pages/s']:8.1f} "
+              f"MB/s={result['MB/s']:6.2f} chunks={result['chunks']:6d} "
+              f"failures={result['failures']}")
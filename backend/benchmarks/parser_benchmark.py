@@ -0,0 +1,140 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import pdf_extractors, pdf_utils  # noqa: E402
+from app.pdf_parser import PDFParser  # noqa: E402
+from synthetic_pdf import cached_pdf  # noqa: E402
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(
+    description='per-stage throughput and peak memory of parse_pdf / merge_sentences_to_chunks / PDFParser')
+
+parser.add_argument('--cache_dir', type=str, default="/tmp/pdf_benchmark")
+parser.add_argument('--baseline', type=str,
+                    default=os.path.join(BENCHMARK_DIR, "parser_baseline.json"))
+parser.add_argument('--save_baseline', action='store_true',
+                    help='store this run as the new baseline')
+parser.add_argument('--check', action='store_true',
+                    help='exit 1 when a stage regresses past --tolerance')
+parser.add_argument('--tolerance', type=float, default=0.2)
+parser.add_argument('--quick', action='store_true', help='small documents only')
+
+# documents: (pages, words per sentence, lines per page)
+DOCUMENTS = [(10, 18, 45), (100, 18, 45), (100, 8, 45), (100, 40, 45), (100, 18, 15), (500, 18, 45)]
+CHUNK_SETTINGS = [(128, 0), (256, 3), (512, 3), (256, 8)]
+
+# pylint:disable=redefined-outer-name,invalid-name
+
+
+# stages are timed over as many runs as fit in this many seconds, at least one
+REPEAT_SECONDS = 0.5
+# peak memory within this many MB of the baseline is noise (lazy imports, caches)
+MEMORY_SLACK_MB = 0.25
+
+
+def measure(func, *args, **kwargs):
+    """
+    Return (result, seconds, peak traced MB). Seconds is the fastest of
+    the timed runs, memory comes from a separate run since tracing
+    allocations slows the code down.
+    """
+    timings = []
+    started = time.perf_counter()
+    while not timings or time.perf_counter() - started < REPEAT_SECONDS:
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    seconds = min(timings)
+
+    tracemalloc.start()
+    func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak / 1024 / 1024
+
+
+def bench_document(file_path):
+    results = {}
+
+    texts, seconds, peak = measure(pdf_extractors.extract_pages, file_path)
+    results["extract"] = {"pages/s": len(texts) / seconds, "peak_mb": peak}
+
+    (_, sentences), seconds, peak = measure(
+        pdf_utils.split_sentences, texts, range(len(texts)))
+    results["sentences"] = {"sentences/s": len(sentences) / seconds, "peak_mb": peak}
+
+    for sentence_size, overlapping_num in CHUNK_SETTINGS:
+        chunks, seconds, peak = measure(pdf_utils.merge_sentences_to_chunks, sentences,
+                                        sentence_size=sentence_size,
+                                        overlapping_num=overlapping_num)
+        results[f"chunk[{sentence_size},{overlapping_num}]"] = {
+            "chunks/s": len(chunks) / seconds, "sentences/s": len(sentences) / seconds,
+            "peak_mb": peak}
+
+    (_, chunks), seconds, peak = measure(PDFParser().parse, file_path)
+    results["parse"] = {"pages/s": len(texts) / seconds, "chunks/s": len(chunks) / seconds,
+                        "peak_mb": peak}
+
+    return results
+
+
+def regressions(results, baseline, tolerance, metrics=None):
+    """
+    Metrics more than `tolerance` below their baseline throughput, or above
+    their baseline peak memory (plus MEMORY_SLACK_MB). `metrics` limits the
+    check to these metric names.
+    """
+    found = []
+    for document, stages in results.items():
+        for stage, stage_metrics in stages.items():
+            for metric, value in stage_metrics.items():
+                expected = baseline.get(document, {}).get(stage, {}).get(metric)
+                if expected is None or (metrics is not None and metric not in metrics):
+                    continue
+                if metric == "peak_mb":
+                    regressed = value > expected * (1 + tolerance) + MEMORY_SLACK_MB
+                else:
+                    regressed = value < expected * (1 - tolerance)
+                if regressed:
+                    found.append(f"{document} {stage} {metric}: {value:.2f} vs baseline {expected:.2f}")
+    return found
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+    pdf_utils.nltk.download('punkt', download_dir=pdf_utils.nltk_download_dir)
+
+    documents = DOCUMENTS[:1] if args.quick else DOCUMENTS
+    results = {}
+    for num_pages, words_per_sentence, lines_per_page in documents:
+        document = f"pages={num_pages},words={words_per_sentence},lines={lines_per_page}"
+        file_path = cached_pdf(args.cache_dir, num_pages=num_pages,
+                               words_per_sentence=words_per_sentence,
+                               lines_per_page=lines_per_page)
+        results[document] = bench_document(file_path)
+
+        for stage, metrics in results[document].items():
+            print(f"{document:<32} {stage:<16} " +
+                  " ".join(f"{metric}={value:.1f}" for metric, value in metrics.items()))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Saved baseline to {args.baseline}")
+
+    if args.check:
+        if not os.path.exists(args.baseline):
+            sys.exit(f"No baseline at {args.baseline}, run with --save_baseline first")
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        sys.exit(1 if found else 0)
@@ -0,0 +1,75 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.embedding_store import EmbeddingStore  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description='recall / latency of file-routed search against exact search of a whole chat')
+
+parser.add_argument('--num_files', type=int, default=200)
+parser.add_argument('--chunks_per_file', type=int, default=500)
+parser.add_argument('--num_queries', type=int, default=200)
+parser.add_argument('--dim', type=int, default=768)
+parser.add_argument('--top_files', type=int, nargs='+', default=[1, 2, 4, 8])
+parser.add_argument('--k', type=int, default=10)
+parser.add_argument('--store_dir', type=str, default='/tmp/routing_benchmark')
+
+# pylint:disable=redefined-outer-name,invalid-name
+
+
+def synthetic_chat(num_files, chunks_per_file, dim, seed=0):
+    """One topic per file with a few sub-topics, queries are drawn like chunks"""
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((num_files, dim)).astype(np.float32)
+    chunks = []
+    for file_id in range(num_files):
+        sub_topics = topics[file_id] + 0.8 * rng.standard_normal((8, dim)).astype(np.float32)
+        vectors = sub_topics[rng.integers(8, size=chunks_per_file)]
+        vectors += 0.6 * rng.standard_normal(vectors.shape).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        for chunk_id, vector in enumerate(vectors):
+            chunks.append({"text": f"file {file_id} chunk {chunk_id}",
+                           "page_number": [chunk_id], "chunk_id": chunk_id,
+                           "file_key": f"bench/{file_id}.pdf",
+                           "file_name": f"{file_id}.pdf",
+                           "embedding": vector})
+    return chunks
+
+
+def result_ids(results):
+    return {item["text"] for item in results}
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    chunks = synthetic_chat(args.num_files, args.chunks_per_file, args.dim)
+    rng = np.random.default_rng(1)
+    queries = [chunks[i]["embedding"] + 0.3 * rng.standard_normal(args.dim)
+               for i in rng.choice(len(chunks), args.num_queries, replace=False)]
+
+    store = EmbeddingStore(root_dir=args.store_dir, dim=args.dim).build("bench", chunks)
+    store.search(queries[0])
+
+    start = time.perf_counter()
+    exact = [result_ids(store.search(query, limit=args.k)) for query in queries]
+    exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+    print(f"exact search over {len(chunks)} chunks: {exact_ms:.2f} ms/query")
+
+    store.rank_files(queries[0])
+    for top_files in args.top_files:
+        start = time.perf_counter()
+        routed = [result_ids(store.search(query, limit=args.k,
+                                          file_keys=store.rank_files(query, limit=top_files)))
+                  for query in queries]
+        routed_ms = (time.perf_counter() - start) / len(queries) * 1000
+
+        recall = np.mean([len(a & b) / args.k for a, b in zip(exact, routed)])
+        print(f"top_files={top_files:3d}  recall@{args.k}={recall:.3f}  "
+              f"{routed_ms:.2f} ms/query")
@@ -0,0 +1,64 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from textblob import TextBlob  # noqa: E402
+from app import pdf_extractors, pdf_utils  # noqa: E402
+from synthetic_pdf import cached_pdf  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description='memory held by parsed sentences: TextBlob objects vs SentenceTable')
+
+parser.add_argument('--num_pages', type=int, default=1000)
+parser.add_argument('--cache_dir', type=str, default="/tmp/pdf_benchmark")
+
+# pylint:disable=redefined-outer-name,invalid-name
+
+
+def sentence_objects(texts):
+    """The representation parse_pdf used to return: one Sentence per sentence"""
+    page_sentence_list = []
+    for page_num, text in enumerate(texts):
+        for sentence in TextBlob(text).sentences:
+            page_sentence_list.append({"page_number": page_num, "sentence": sentence})
+    return page_sentence_list
+
+
+def sentence_table(texts):
+    return pdf_utils.split_sentences(texts, range(len(texts)))[1]
+
+
+def retained(build, texts):
+    """Seconds to build and MB still allocated by the result once built"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build(texts)
+    seconds = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, current / 1024 / 1024, peak / 1024 / 1024
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+    pdf_utils.nltk.download('punkt', download_dir=pdf_utils.nltk_download_dir)
+
+    file_path = cached_pdf(args.cache_dir, num_pages=args.num_pages)
+    texts = pdf_extractors.extract_pages(file_path)
+    text_mb = sum(len(text) for text in texts) / 1024 / 1024
+    print(f"{args.num_pages} pages, {text_mb:.1f} MB of text")
+
+    objects, seconds, current, peak = retained(sentence_objects, texts)
+    print(f"Sentence objects: {seconds:.1f} s, retained {current:.1f} MB, peak {peak:.1f} MB")
+    expected = pdf_utils.merge_sentences_to_chunks(objects, 256, 3)
+    del objects
+
+    table, seconds, current, peak = retained(sentence_table, texts)
+    print(f"SentenceTable:    {seconds:.1f} s, retained {current:.1f} MB, peak {peak:.1f} MB")
+    assert pdf_utils.merge_sentences_to_chunks(table, 256, 3) == expected
+    print("chunks identical")
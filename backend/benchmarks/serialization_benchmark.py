@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import List
+
+import numpy as np
+from fastapi import FastAPI
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.routers.v1.responses import FastJSONResponse, SearchResult  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description='per-request cost of serializing search results: FastAPI default vs FastJSONResponse')
+
+parser.add_argument('--limits', type=int, nargs='+', default=[5, 50, 200, 1000])
+parser.add_argument('--text_words', type=int, default=256)
+parser.add_argument('--repeat', type=int, default=200)
+
+# pylint:disable=redefined-outer-name,invalid-name
+
+
+def synthetic_results(limit, text_words, seed=0):
+    rng = np.random.default_rng(seed)
+    words = ["inflation", "range", "policy", "rate", "growth", "central", "bank", "risk"]
+    return [{"text": " ".join(rng.choice(words, text_words)),
+             "chunk_id": chunk_id,
+             "page_number": [chunk_id // 3, chunk_id // 3 + 1],
+             "score": float(rng.random())}
+            for chunk_id in range(limit)]
+
+
+def make_app(results):
+    app = FastAPI()
+
+    @app.get("/default", response_model=List[SearchResult])
+    async def default():
+        return results
+
+    @app.get("/fast", response_model=List[SearchResult])
+    async def fast():
+        return FastJSONResponse(results)
+
+    return app
+
+
+async def request(app, path):
+    """One request straight through the ASGI app, no network or HTTP client"""
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+             "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+             "root_path": "", "query_string": b"", "headers": [],
+             "client": ("127.0.0.1", 1), "server": ("127.0.0.1", 80)}
+    body = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return b"".join(body)
+
+
+async def timed(app, path, repeat):
+    await request(app, path)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        body = await request(app, path)
+    return (time.perf_counter() - start) / repeat, len(body)
+
+
+async def main(args):
+    print(f"{'limit':>6} {'bytes':>9} {'default ms':>11} {'fast ms':>8} {'speedup':>8}")
+    for limit in args.limits:
+        app = make_app(synthetic_results(limit, args.text_words))
+        default_seconds, size = await timed(app, "/default", args.repeat)
+        fast_seconds, _ = await timed(app, "/fast", args.repeat)
+        print(f"{limit:>6} {size:>9} {default_seconds * 1000:>11.3f} "
+              f"{fast_seconds * 1000:>8.3f} {default_seconds / fast_seconds:>7.1f}x")
+
+
+if __name__ == "__main__":
+
+    asyncio.run(main(parser.parse_args()))
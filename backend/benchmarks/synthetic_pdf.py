@@ -0,0 +1,63 @@
+import os
+import random
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+WORDS = ("inflation protected securities return yield coupon principal index "
+         "market bond treasury maturity rate adjusted investor portfolio risk "
+         "annual report revenue growth quarter segment operating margin cash "
+         "flow guidance forecast policy central bank monetary fiscal").split()
+
+
+def synthetic_sentence(rng, words_per_sentence):
+    size = max(1, int(rng.gauss(words_per_sentence, words_per_sentence / 3)))
+    words = [rng.choice(WORDS) for _ in range(size)]
+    return " ".join(words).capitalize() + "."
+
+
+def generate_pdf(file_path, num_pages=10, words_per_sentence=18, lines_per_page=45,
+                 header=None, footer=None, seed=0):
+    """
+    Write a text-only PDF of `num_pages` pages with `lines_per_page` lines of
+    `words_per_sentence`-word sentences (text density), optionally with a
+    running header / footer line on every page.
+    """
+    rng = random.Random(seed)
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+
+    pdf = canvas.Canvas(file_path, pagesize=A4)
+    width, height = A4
+    for page_num in range(num_pages):
+        if header:
+            pdf.drawString(50, height - 30, header)
+
+        text = pdf.beginText(50, height - 60)
+        text.setFont("Helvetica", 9)
+        line = ""
+        lines = 0
+        while lines < lines_per_page:
+            line += synthetic_sentence(rng, words_per_sentence) + " "
+            while len(line) > 110 and lines < lines_per_page:
+                cut = line.rfind(" ", 0, 110)
+                text.textLine(line[:cut])
+                line = line[cut + 1:]
+                lines += 1
+        pdf.drawText(text)
+
+        if footer:
+            pdf.drawString(50, 30, footer.format(page=page_num + 1))
+        pdf.showPage()
+
+    pdf.save()
+    return file_path
+
+
+def cached_pdf(cache_dir, **kwargs):
+    """Generate once per parameter set, benchmarks reuse the file"""
+    name = "_".join(f"{key}-{value}" for key, value in sorted(kwargs.items())
+                    if value is not None)
+    file_path = os.path.join(cache_dir, f"{name}.pdf".replace(" ", "").replace("/", ""))
+    if not os.path.exists(file_path):
+        generate_pdf(file_path, **kwargs)
+    return file_path
@@ -1,2 +1,2 @@
 #!/bin/bash
-gunicorn --workers=${WORKERS:-1} --threads ${THREADS:-3} --timeout 0 --bind :${PORT:-8000} --worker-class uvicorn.workers.UvicornWorker server:app
\ No newline at end of file
+gunicorn -c gunicorn.conf.py server:app
\ No newline at end of file
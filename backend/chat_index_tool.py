@@ -0,0 +1,64 @@
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+
+import boto3
+import dotenv
+
+from app import chat_archive
+from app.mongodb_engine import AsyncMongoDB
+
+dotenv.load_dotenv()
+
+parser = argparse.ArgumentParser(
+    description="export / import a chat's files and chunks (with embeddings) "
+                "to or from a local path or s3://bucket/key")
+
+parser.add_argument('command', choices=['export', 'import'])
+parser.add_argument('--location', type=str, required=True,
+                    help="archive path, or s3://bucket/key")
+parser.add_argument('--chat_id', type=str, default=None,
+                    help="chat to export, or to import into (defaults to the exported one)")
+parser.add_argument('--replace', action='store_true',
+                    help="on import, delete the chat's existing chunks first")
+parser.add_argument('--mongodb_url', type=str, default=os.getenv("MONGODB_URL"))
+
+# pylint:disable=redefined-outer-name,invalid-name
+
+
+def split_s3_url(location):
+    bucket, _, key = location[len("s3://"):].partition("/")
+    return bucket, key
+
+
+async def main(args):
+    mongo_db_engine = AsyncMongoDB(mongodb_url=args.mongodb_url)
+    tmp_dir = tempfile.mkdtemp()
+    is_s3 = args.location.startswith("s3://")
+    file_path = os.path.join(tmp_dir, "chat.chatidx") if is_s3 else args.location
+
+    try:
+        if args.command == "export":
+            if args.chat_id is None:
+                parser.error("--chat_id is required for export")
+            manifest = await chat_archive.export_chat(mongo_db_engine, args.chat_id, file_path)
+            if is_s3:
+                boto3.client('s3').upload_file(file_path, *split_s3_url(args.location))
+        else:
+            if is_s3:
+                boto3.client('s3').download_file(*split_s3_url(args.location), file_path)
+            manifest = await chat_archive.import_chat(
+                mongo_db_engine, file_path, chat_id=args.chat_id, replace=args.replace)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        mongo_db_engine.close()
+
+    print(f"{args.command}ed chat {manifest['chat_id']}: "
+          f"{manifest['num_files']} files, {manifest['num_chunks']} chunks")
+
+
+if __name__ == "__main__":
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,28 @@
+# Production serving: `gunicorn -c gunicorn.conf.py server:app` (see boot.sh).
+# The app is imported once in the master and the workers are forked from it,
+# sharing its memory copy-on-write. `kill -HUP <master>` replaces the workers
+# gracefully; with a preloaded app, deploying new code needs a new master.
+import os
+
+from app import serving
+from app.config import config as app_config  # "config" is a gunicorn setting
+
+bind = f":{os.getenv('PORT', '8000')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = serving.worker_count(int(os.getenv("WORKERS", "0")) or app_config.workers)
+preload_app = True
+
+# each worker budgets its own /tmp usage (app/uploads.py): share the host's quota,
+# set before the preloaded app creates its TempSpace
+app_config.tmp_quota_bytes //= workers
+
+timeout = 0
+graceful_timeout = app_config.worker_graceful_timeout
+max_requests = app_config.worker_max_requests
+max_requests_jitter = app_config.worker_max_requests_jitter
+
+
+def on_starting(server):
+    # runs in the master after the preloaded app is imported, before any fork
+    serving.preload()
+    server.log.info(f"Preloaded the app, starting {workers} workers")
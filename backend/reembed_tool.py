@@ -0,0 +1,60 @@
+import argparse
+import asyncio
+import os
+
+import dotenv
+
+from app.config import config
+from app.embedding_controller import AdaptiveBatchController
+from app.jina_ai import AsyncJinaAI
+from app.mongodb_engine import AsyncMongoDB
+from app.reembed import ReembedJob
+
+dotenv.load_dotenv()
+
+parser = argparse.ArgumentParser(
+    description="re-embed every chunk's text with another model into a parallel field; "
+                "rerun to resume an interrupted job or to catch up with new chunks")
+
+parser.add_argument('--model', type=str, required=True,
+                    help="Jina embedding model, e.g. jina-embeddings-v3")
+parser.add_argument('--field', type=str, required=True,
+                    help="chunk field for the new vectors, e.g. embedding_v3")
+parser.add_argument('--job_id', type=str, default=None,
+                    help="job to create or resume (defaults to the field)")
+parser.add_argument('--read_batch', type=int, default=config.reembed_read_batch)
+parser.add_argument('--max_chunks_per_second', type=float,
+                    default=config.reembed_max_chunks_per_second)
+parser.add_argument('--max_concurrency', type=int, default=config.max_embedding_concurrency)
+parser.add_argument('--mongodb_url', type=str, default=os.getenv("MONGODB_URL"))
+
+# pylint:disable=redefined-outer-name,invalid-name
+
+
+async def main(args):
+    mongo_db_engine = AsyncMongoDB(mongodb_url=args.mongodb_url)
+    jina_ai = AsyncJinaAI(api_key=os.getenv("JINA_API_KEY"),
+                          timeout=config.http_timeout,
+                          concurrency=config.embedding_concurrency,
+                          controller=AdaptiveBatchController(
+                              batch_size=config.batch_size,
+                              min_batch_size=config.min_batch_size,
+                              max_batch_size=config.max_batch_size,
+                              concurrency=config.embedding_concurrency,
+                              max_concurrency=args.max_concurrency,
+                              max_batch_tokens=config.embedding_max_batch_tokens,
+                              target_latency=config.embedding_target_latency),
+                          model=args.model)
+    job = ReembedJob(mongo_db_engine, jina_ai, args.field, job_id=args.job_id,
+                     read_batch=args.read_batch,
+                     max_chunks_per_second=args.max_chunks_per_second)
+    try:
+        await job.run()
+    finally:
+        await jina_ai.close()
+        mongo_db_engine.close()
+
+
+if __name__ == "__main__":
+
+    asyncio.run(main(parser.parse_args()))
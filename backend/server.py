@@ -1,14 +1,27 @@
 import dotenv
 import datetime
 import uvicorn
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse
+from app import admission, profiling
+from app.config import config
 from app.routers import v1
 from mangum import Mangum
 
 dotenv.load_dotenv(".env")
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # pooled MongoDB / HTTP clients live as long as the worker
+    await v1.endpoints.startup()
+    yield
+    await v1.endpoints.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "*",
@@ -22,9 +35,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(profiling.ProfilingMiddleware)
+
 
 PREFIX = "/api"
 
+if config.use_admission_control:
+    # outermost, so shed requests cost as little as possible
+    app.add_middleware(
+        admission.AdmissionMiddleware,
+        controller=v1.endpoints.admission_control,
+        routes={f"{PREFIX}{v1.endpoints.router.prefix}{path}": lane
+                for path, lane in v1.endpoints.ADMISSION_ROUTES.items()})
+
 app.include_router(v1.endpoints.router, prefix=PREFIX)
 
 
@@ -40,7 +63,27 @@ async def health_check():
     return {"message": response, "start_hk_time": start_time}
 
 
-handler = Mangum(app)
+@app.get(f"{PREFIX}/profiles")
+async def list_profiles(x_profile_token: str = Header(None)):
+    if not profiling.is_authorized(x_profile_token):
+        raise HTTPException(status_code=403, detail="Profiling not authorized")
+    return profiling.list_profiles()
+
+
+@app.get(f"{PREFIX}/profiles/{{profile_id}}")
+async def get_profile(profile_id: str, x_profile_token: str = Header(None)):
+    if not profiling.is_authorized(x_profile_token):
+        raise HTTPException(status_code=403, detail="Profiling not authorized")
+
+    file_path = profiling.profile_path(profile_id)
+    if file_path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(file_path, media_type="text/plain")
+
+
+# Mangum runs the lifespan around every invocation when it is on, which would close
+# the clients warm Lambda containers reuse; they open on first use instead
+handler = Mangum(app, lifespan="off")
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8080)
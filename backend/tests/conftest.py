@@ -12,6 +12,10 @@ sys.path.insert(0, project_root)
 
 from app.config import config
 
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true",
+                     help="also check parser throughput against benchmarks/parser_baseline.json")
+
 def pytest_configure(config):
     """Register custom markers"""
     config.addinivalue_line(
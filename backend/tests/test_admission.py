@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from app.admission import (INGEST, SEARCH, AdmissionController, AdmissionMiddleware, Lane,
+                           Rejected, release_slot)
+from app.single_flight import SingleFlight
+
+
+def make_controller(search_queue_time=1.0):
+    return AdmissionController([
+        Lane(SEARCH, max_concurrency=1, max_queue=1, max_queue_time=search_queue_time),
+        Lane(INGEST, max_concurrency=1, max_queue=1, max_queue_time=1.0)])
+
+
+def test_full_queue_and_queue_timeout_are_rejected():
+
+    async def run():
+        controller = make_controller(search_queue_time=0.05)
+        await controller.acquire(SEARCH)
+
+        queued = asyncio.ensure_future(controller.acquire(SEARCH))
+        await asyncio.sleep(0)
+        with pytest.raises(Rejected) as rejected:
+            await controller.acquire(SEARCH)
+        assert rejected.value.reason == "queue_full"
+        assert rejected.value.retry_after >= 1
+
+        with pytest.raises(Rejected) as rejected:
+            await queued
+        assert rejected.value.reason == "queue_timeout"
+
+        stats = controller.stats()[SEARCH]
+        assert stats["admitted"] == 1
+        assert stats["rejected"] == {"queue_full": 1, "queue_timeout": 1}
+
+    asyncio.run(run())
+
+
+def test_queued_searches_go_before_ingests():
+
+    async def run():
+        controller = make_controller()
+        await controller.acquire(SEARCH)
+
+        order = []
+
+        async def request(lane):
+            await controller.acquire(lane)
+            order.append(lane)
+            controller.release(lane, 0.01)
+
+        search = asyncio.ensure_future(request(SEARCH))
+        await asyncio.sleep(0)
+        # the ingest lane is idle but a search is queued
+        ingest = asyncio.ensure_future(request(INGEST))
+        await asyncio.sleep(0)
+        assert order == []
+
+        controller.release(SEARCH, 0.01)
+        await asyncio.gather(search, ingest)
+        assert order == [SEARCH, INGEST]
+
+    asyncio.run(run())
+
+
+def test_coalesced_followers_do_not_hold_a_slot():
+
+    async def run():
+        controller = AdmissionController([
+            Lane(SEARCH, max_concurrency=2, max_queue=1, max_queue_time=1.0)])
+        flights = SingleFlight()
+        done = asyncio.Event()
+
+        async def search(query):
+            await done.wait()
+            return query
+
+        route = flights.wrap(search, on_follow=release_slot)
+
+        async def app(scope, receive, send):
+            await route(query="q")
+
+        middleware = AdmissionMiddleware(app, controller, {"/search": SEARCH})
+        requests = [asyncio.ensure_future(middleware({"type": "http", "path": "/search"},
+                                                     None, None))
+                    for _ in range(4)]
+        await asyncio.sleep(0.01)
+        stats = controller.stats()[SEARCH]
+        assert stats["active"] == 1
+        assert stats["admitted"] == 4 and stats["rejected"] == {}
+
+        done.set()
+        await asyncio.gather(*requests)
+        assert controller.stats()[SEARCH]["active"] == 0
+
+    asyncio.run(run())
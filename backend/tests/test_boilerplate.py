@@ -0,0 +1,54 @@
+from app.boilerplate import detect_boilerplate, savings, strip_boilerplate
+
+
+TOPICS = ["revenue", "costs", "hiring", "outlook", "risks",
+          "markets", "products", "suppliers", "litigation", "governance"]
+
+
+def make_pages(num_pages):
+    return [f"ACME Corp Annual Report 2023\n"
+            f"This section of the report covers {TOPICS[page % 10]} for the year 2023.\n"
+            f"Confidential - do not distribute\n"
+            f"Page {page + 1} of {num_pages}"
+            for page in range(num_pages)]
+
+
+def test_headers_footers_and_page_numbers_are_removed():
+    pages, stats = strip_boilerplate(make_pages(10))
+
+    assert pages[3] == "This section of the report covers outlook for the year 2023."
+    assert stats["lines_removed"] == 30
+    assert savings(stats, sentence_size=10)["estimated_chunks_saved"] > 0
+
+
+def test_short_documents_and_unique_lines_are_kept():
+    assert detect_boilerplate(make_pages(2)) == set()
+
+    pages = ["Introduction\nFirst page text.", "Methods\nSecond page text.",
+             "Results\nThird page text.", "Discussion\nFourth page text."]
+    assert strip_boilerplate(pages)[0] == pages
+
+
+def test_page_numbers_and_separators_need_to_repeat():
+    # roman page numbers in the front matter
+    pages = [f"On {topic}\nSome text about {topic}.\n{numeral}"
+             for topic, numeral in zip(TOPICS, ["i", "ii", "iii", "iv", "v"])]
+    pages[2] += "\n-----"
+
+    stripped, _ = strip_boilerplate(pages)
+    assert stripped[0] == "On revenue\nSome text about revenue."
+    assert stripped[2] == "On hiring\nSome text about hiring.\n-----"
+
+    # a single roman numeral or rule on a page is content, not a page number
+    pages = ["Section v\nText.\n-----", "Section w\nMore text.", "Section x\nEven more text."]
+    assert strip_boilerplate(pages)[0] == pages
+
+
+def test_short_segments_strip_what_earlier_segments_found():
+    known = detect_boilerplate(make_pages(10))
+    last_pages = make_pages(12)[10:]
+
+    assert detect_boilerplate(last_pages) == set()
+    stripped, stats = strip_boilerplate(last_pages, detect_boilerplate(last_pages, known=known))
+    assert stripped[1] == "This section of the report covers costs for the year 2023."
+    assert stats["lines_removed"] == 6
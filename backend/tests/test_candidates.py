@@ -0,0 +1,40 @@
+from app.candidates import collapse_adjacent, mmr, select_for_rerank
+
+
+def test_neighbouring_chunks_collapse_to_the_best_ranked():
+    candidates = [{"file_key": "a", "chunk_id": 5},
+                  {"file_key": "a", "chunk_id": 4},
+                  {"file_key": "b", "chunk_id": 5},
+                  {"file_key": "a", "chunk_id": 9},
+                  {"file_key": "a", "chunk_id": 6}]
+
+    assert collapse_adjacent(candidates) == [{"file_key": "a", "chunk_id": 5},
+                                             {"file_key": "b", "chunk_id": 5},
+                                             {"file_key": "a", "chunk_id": 9}]
+
+
+def test_a_chain_of_neighbours_does_not_collapse_to_one_chunk():
+    candidates = [{"file_key": "a", "chunk_id": chunk_id} for chunk_id in [2, 1, 3, 0, 4]]
+
+    assert collapse_adjacent(candidates) == [{"file_key": "a", "chunk_id": 2},
+                                             {"file_key": "a", "chunk_id": 0},
+                                             {"file_key": "a", "chunk_id": 4}]
+
+
+def test_mmr_skips_near_duplicates():
+    query = [1.0, 0.0]
+    vectors = [[1.0, 0.0], [0.99, 0.01], [0.7, 0.7]]
+
+    assert mmr(query, vectors, k=2, diversity=0.0) == [0, 1]
+    assert mmr(query, vectors, k=2, diversity=0.7) == [0, 2]
+
+
+def test_select_for_rerank_keeps_k_candidates():
+    candidates = [{"file_key": "a", "chunk_id": i * 10, "embedding": [1.0, i / 10]}
+                  for i in range(6)]
+    candidates.append({"file_key": "a", "chunk_id": 1, "embedding": None})
+
+    selected = select_for_rerank([1.0, 0.0], candidates, k=3)
+    assert len(selected) == 3
+    assert selected[0]["chunk_id"] == 0
+    assert all(candidate["embedding"] for candidate in selected)
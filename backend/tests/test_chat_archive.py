@@ -0,0 +1,116 @@
+import asyncio
+
+from pymongo import ReplaceOne
+
+from app import chat_archive
+from app.chat_archive import ChatArchiveReader, ChatArchiveWriter
+from app.mongodb_engine import file_record_operations
+
+
+def make_chunk(chunk_id, embedding):
+    return {"text": f"chunk {chunk_id} ünïcode",
+            "page_number": [chunk_id, chunk_id + 1],
+            "word_size": 3,
+            "chunk_id": chunk_id,
+            "chat_id": "test_chat",
+            "file_key": "test/test.pdf",
+            "file_name": "test.pdf",
+            "embedding": embedding}
+
+
+def test_archive_round_trip(tmp_path):
+    chunks = [make_chunk(chunk_id, [float(chunk_id), 0.5, -1.0]) for chunk_id in range(5)]
+    chunks[1]["uploaded_file_id"] = "abc"
+    file_record = {"_id": "ignored", "file_key": "test/test.pdf", "file_name": "test.pdf",
+                   "full_text": "\nchunk"}
+
+    writer = ChatArchiveWriter(str(tmp_path / "chat.chatidx"), "test_chat")
+    writer.add_chunks(chunks[:3])
+    writer.add_chunks(chunks[3:])
+    writer.add_files([file_record])
+    manifest = writer.close()
+    assert manifest["num_chunks"] == 5 and manifest["dim"] == 3
+
+    reader = ChatArchiveReader(str(tmp_path / "chat.chatidx"))
+    restored = [chunk for batch in reader.iter_chunks(batch_size=2) for chunk in batch]
+    files = reader.files()
+    reader.close()
+
+    assert restored == chunks
+    assert files == [{key: value for key, value in file_record.items() if key != "_id"}]
+
+
+def test_archive_keeps_every_embedding_field(tmp_path):
+    chunks = [make_chunk(chunk_id, [float(chunk_id), 0.5]) for chunk_id in range(4)]
+    for chunk in chunks:
+        chunk["embedding_v3"] = [1.0, float(chunk["chunk_id"]), -0.5]
+    chunks[3]["embedding_v4"] = [0.25] * 4
+
+    writer = ChatArchiveWriter(str(tmp_path / "chat.chatidx"), "test_chat",
+                               embedding_field="embedding_v3")
+    writer.add_chunks(chunks[:2])
+    writer.add_chunks(chunks[2:])
+    manifest = writer.close()
+    assert manifest["dim"] == 3
+    assert manifest["vectors"] == {"embedding": 2, "embedding_v4": 4}
+
+    reader = ChatArchiveReader(str(tmp_path / "chat.chatidx"))
+    restored = [chunk for batch in reader.iter_chunks(batch_size=3) for chunk in batch]
+    extra = reader.archive.read(chat_archive.EXTRA_FILE)
+    reader.close()
+
+    assert restored == chunks
+    assert b"embedding" not in extra
+
+
+class FakeMongo():
+    """Chunks and UploadedFile records, the records keyed like `file_record_operations`"""
+
+    def __init__(self):
+        self.chunks = []
+        self.files = {}
+
+    async def count_chunks(self, chat_id):
+        return sum(chunk["chat_id"] == chat_id for chunk in self.chunks)
+
+    async def iter_chunks(self, chat_id, batch_size=1000):
+        yield [dict(chunk) for chunk in self.chunks if chunk["chat_id"] == chat_id]
+
+    async def insert_embedding(self, chunks):
+        self.chunks.extend(chunks)
+
+    async def find_files(self, file_keys, chat_id=None):
+        return [dict(record) for (record_chat, file_key), record in self.files.items()
+                if file_key in file_keys and record_chat in (chat_id, None)]
+
+    async def upsert_file_records(self, records):
+        for record in records:
+            self.files[(record.get("chat_id"), record["file_key"])] = dict(record)
+
+    async def bump_chat_version(self, chat_id):
+        return 1
+
+
+def test_import_under_another_chat_id_keeps_the_source_chat(tmp_path):
+    mongo = FakeMongo()
+    mongo.chunks = [make_chunk(chunk_id, [1.0, 0.0, float(chunk_id)]) for chunk_id in range(3)]
+    source_record = {"chat_id": "test_chat", "file_key": "test/test.pdf",
+                     "file_name": "test.pdf", "full_text": "chunk",
+                     "neighbour_map": {"first_page": [0, 1, 2]}}
+    mongo.files[("test_chat", "test/test.pdf")] = dict(source_record)
+
+    async def scenario():
+        await chat_archive.export_chat(mongo, "test_chat", str(tmp_path / "chat.chatidx"))
+        return await chat_archive.import_chat(mongo, str(tmp_path / "chat.chatidx"),
+                                              chat_id="copy_chat")
+
+    manifest = asyncio.run(scenario())
+    assert manifest["chat_id"] == "copy_chat"
+    assert mongo.files[("test_chat", "test/test.pdf")] == source_record
+    assert mongo.files[("copy_chat", "test/test.pdf")] == {**source_record, "chat_id": "copy_chat"}
+    assert sum(chunk["chat_id"] == "copy_chat" for chunk in mongo.chunks) == 3
+    assert sum(chunk["chat_id"] == "test_chat" for chunk in mongo.chunks) == 3
+
+    copy_record = mongo.files[("copy_chat", "test/test.pdf")]
+    assert file_record_operations([copy_record]) == [ReplaceOne(
+        {"chat_id": "copy_chat", "file_key": "test/test.pdf"}, copy_record, upsert=True)]
@@ -0,0 +1,164 @@
+import asyncio
+
+from app import chat_tiering
+from app.chat_tiering import ChatTiering
+from app.config import config
+from app.mongodb_engine import chunk_collection, chunk_collections
+from app.uploads import TempSpace, UploadScope
+
+
+class FakeMongo():
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.files = []
+        self.activity = {}
+        self.versions = {}
+
+    async def touch_chat(self, chat_id, now):
+        record = self.activity.setdefault(
+            chat_id, {"chat_id": chat_id, "state": "hot", "changed_at": now})
+        record["last_access"] = now
+        return dict(record)
+
+    async def get_chat_activity(self, chat_id):
+        record = self.activity.get(chat_id)
+        return dict(record) if record else None
+
+    async def find_idle_chats(self, before, limit=20):
+        return [dict(record) for record in self.activity.values()
+                if record["state"] == "hot" and record["last_access"] < before][:limit]
+
+    async def set_chat_state(self, chat_id, from_states, state, last_access=None,
+                             changed_before=None, **fields):
+        record = self.activity.get(chat_id)
+        if (record is None or record["state"] not in from_states
+                or (last_access is not None and record["last_access"] != last_access)
+                or (changed_before is not None and record["changed_at"] >= changed_before)):
+            return None
+        record.update(state=state, **fields)
+        return dict(record)
+
+    async def count_chunks(self, chat_id):
+        return sum(chunk["chat_id"] == chat_id for chunk in self.chunks)
+
+    async def iter_chunks(self, chat_id, batch_size=1000):
+        yield [dict(chunk) for chunk in self.chunks if chunk["chat_id"] == chat_id]
+
+    async def delete_chunks(self, chat_id):
+        self.chunks = [chunk for chunk in self.chunks if chunk["chat_id"] != chat_id]
+
+    async def insert_embedding(self, chunks):
+        self.chunks.extend(chunks)
+
+    async def find_files(self, file_keys, chat_id=None):
+        return [record for record in self.files if record["file_key"] in file_keys]
+
+    async def upsert_file_records(self, records):
+        pass
+
+    async def bump_chat_version(self, chat_id):
+        self.versions[chat_id] = self.versions.get(chat_id, 0) + 1
+        return self.versions[chat_id]
+
+
+class FakeS3():
+
+    def __init__(self):
+        self.objects = {}
+
+    def upload_file(self, path, bucket, key):
+        with open(path, "rb") as f:
+            self.objects[key] = f.read()
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": len(self.objects[Key])}
+
+    def download_fileobj(self, bucket, key, buffer):
+        buffer.write(self.objects[key])
+
+    def download_file(self, bucket, key, path):
+        with open(path, "wb") as f:
+            f.write(self.objects[key])
+
+
+def make_tiering(tmp_path, mongo, s3, changed):
+    temp_space = TempSpace(quota_bytes=64 * 1024 * 1024)
+    return ChatTiering(mongo, s3, bucket="bucket", prefix="cold/",
+                       scope_factory=lambda: UploadScope(temp_space, spool_threshold=1024,
+                                                         tmp_dir=str(tmp_path)),
+                       idle_seconds=100, touch_interval=0, on_change=changed.append)
+
+
+def make_chunks(chat_id, count):
+    return [{"chat_id": chat_id, "chunk_id": i, "text": f"chunk {i}", "page_number": [i],
+             "file_key": "a.pdf", "embedding": [float(i), 1.0]} for i in range(count)]
+
+
+def test_idle_chat_is_offloaded_and_restored_on_access(tmp_path):
+    mongo = FakeMongo(make_chunks("idle", 3) + make_chunks("active", 2))
+    s3 = FakeS3()
+    changed = []
+    tiering = make_tiering(tmp_path, mongo, s3, changed)
+
+    async def scenario():
+        await tiering.access("idle")
+        await tiering.access("active")
+        mongo.activity["idle"]["last_access"] -= 1000
+
+        offloaded = await tiering.offload_idle()
+        assert offloaded == [{"chat_id": "idle", "num_chunks": 3, "s3_key": "cold/idle.chatidx"}]
+        assert mongo.activity["idle"]["state"] == chat_tiering.COLD
+        assert await mongo.count_chunks("idle") == 0
+        assert await mongo.count_chunks("active") == 2
+
+        # concurrent accesses restore it once
+        await asyncio.gather(tiering.access("idle"), tiering.access("idle"))
+        assert mongo.activity["idle"]["state"] == chat_tiering.HOT
+        restored = sorted((c for c in mongo.chunks if c["chat_id"] == "idle"),
+                          key=lambda chunk: chunk["chunk_id"])
+        assert [chunk["text"] for chunk in restored] == ["chunk 0", "chunk 1", "chunk 2"]
+        assert tiering.restored == 1
+        # other workers' copies of the chat are invalidated by both changes
+        assert mongo.versions == {"idle": 2}
+
+    asyncio.run(scenario())
+    assert changed == ["idle", "idle"]
+
+
+def test_access_during_export_cancels_the_offload(tmp_path):
+    mongo = FakeMongo(make_chunks("chat", 2))
+    s3 = FakeS3()
+    tiering = make_tiering(tmp_path, mongo, s3, [])
+    upload_file = s3.upload_file
+
+    def upload_while_accessed(path, bucket, key):
+        upload_file(path, bucket, key)
+        # what `access` from another worker does meanwhile
+        mongo.activity["chat"]["last_access"] += 1
+        mongo.activity["chat"]["state"] = chat_tiering.HOT
+
+    s3.upload_file = upload_while_accessed
+
+    async def scenario():
+        await tiering.access("chat")
+        last_access = mongo.activity["chat"]["last_access"]
+        assert await tiering.offload("chat", last_access) is None
+        assert mongo.activity["chat"]["state"] == chat_tiering.HOT
+        assert await mongo.count_chunks("chat") == 2
+
+    asyncio.run(scenario())
+
+
+def test_chunk_collection_is_stable_and_groups_tenants(monkeypatch):
+    assert chunk_collection("any") == "Embedding"
+
+    monkeypatch.setattr(config, "chat_partitions", 16)
+    collections = chunk_collections()
+    assert len(collections) == 16 and collections[0] == "Embedding_000"
+    assert chunk_collection("chat-1") == chunk_collection("chat-1")
+    assert chunk_collection("chat-1") in collections
+    assert len({chunk_collection(f"chat-{i}") for i in range(200)}) == 16
+
+    monkeypatch.setattr(config, "partition_by_tenant", True)
+    assert len({chunk_collection(f"acme:chat-{i}") for i in range(50)}) == 1
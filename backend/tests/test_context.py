@@ -0,0 +1,71 @@
+import asyncio
+
+from app import context, pdf_utils
+
+
+class Sentences(pdf_utils.SentenceTable):
+    """Already split sentences, as (page_number, sentence, word count)"""
+
+    def __init__(self, items):
+        super().__init__()
+        self.items = items
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def make_chunks(file_key="a.pdf"):
+    sentences = [f"Sentence number {i} of the file." for i in range(12)]
+    table = Sentences([(i // 3, sentence, 6) for i, sentence in enumerate(sentences)])
+    chunks = pdf_utils.merge_sentences_to_chunks(table, sentence_size=20, overlapping_num=1)
+    for chunk in chunks:
+        chunk["file_key"] = file_key
+    return chunks, sentences
+
+
+class FakeMongo():
+
+    def __init__(self, chunks, maps):
+        self.chunks = chunks
+        self.maps = maps
+        self.queries = 0
+
+    async def find_neighbour_maps(self, file_keys, chat_id=None):
+        return {file_key: self.maps[file_key] for file_key in file_keys if file_key in self.maps}
+
+    async def find_neighbours(self, chat_id, chunk_ids, fields):
+        self.queries += 1
+        return [{field: chunk[field] for field in fields} for chunk in self.chunks
+                if chunk["chunk_id"] in chunk_ids.get(chunk["file_key"], [])]
+
+
+def test_merged_window_keeps_each_sentence_once():
+    chunks, sentences = make_chunks()
+    assert len(chunks) > 3
+    neighbour_map = context.neighbour_map(chunks)
+    assert all("overlap" not in chunk for chunk in chunks)
+    assert neighbour_map["overlap"][0] == 0 and all(neighbour_map["overlap"][1:])
+
+    assert context.merge_window(chunks, neighbour_map["overlap"]).split("\n") == sentences
+    # files ingested without a map: the overlap is found from the texts
+    assert context.merge_window(chunks).split("\n") == sentences
+
+
+def test_expand_results_in_one_query():
+    chunks, sentences = make_chunks()
+    mongo = FakeMongo(chunks, {"a.pdf": context.neighbour_map(chunks)})
+    results = [{"text": chunks[1]["text"], "chunk_id": 1, "file_key": "a.pdf"},
+               {"text": chunks[-1]["text"], "chunk_id": chunks[-1]["chunk_id"],
+                "file_key": "a.pdf"}]
+
+    asyncio.run(context.expand_results(mongo, "chat", results, expand=1))
+
+    assert mongo.queries == 1
+    first, last = results[0]["context"], results[1]["context"]
+    assert first["chunk_ids"] == [0, 2]
+    assert first["text"] == "\n".join(
+        sentences[:sentences.index(chunks[2]["text"].split("\n")[-1]) + 1])
+    assert first["page_number"] == list(range(chunks[0]["page_number"][0],
+                                              max(chunks[2]["page_number"]) + 1))
+    assert last["chunk_ids"] == [chunks[-2]["chunk_id"], chunks[-1]["chunk_id"]]
+    assert last["text"].endswith(sentences[-1])
@@ -0,0 +1,31 @@
+from app.embedding_controller import AdaptiveBatchController
+
+
+def test_batches_grow_when_fast_and_stay_in_bounds():
+    controller = AdaptiveBatchController(batch_size=16, max_batch_size=40, batch_step=16,
+                                         target_latency=1.0)
+    for _ in range(5):
+        controller.record_success(["text"] * controller.batch_size, None, 0.1)
+
+    assert controller.batch_size == 40
+    assert controller.decisions[-1]["batch_size"] == 40
+
+
+def test_413_shrinks_batches_and_token_cap():
+    controller = AdaptiveBatchController(batch_size=64, min_batch_size=1,
+                                         max_batch_tokens=100000)
+    batch = ["x" * 400] * 64
+    controller.record_error(413, batch)
+
+    assert controller.batch_size == 32
+    assert controller.max_batch_tokens < sum(controller.estimate_tokens(chunk) for chunk in batch)
+    assert controller.next_batch(batch, 0) == 32
+
+
+def test_429_halves_concurrency_and_pauses():
+    controller = AdaptiveBatchController(concurrency=8, max_concurrency=8)
+    controller.record_error(429, ["text"], retry_after=5)
+    controller.record_error(429, ["text"], retry_after=5)
+
+    assert controller.concurrency == 4
+    assert controller.pause() > 4
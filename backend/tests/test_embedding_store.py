@@ -0,0 +1,116 @@
+import os
+
+import numpy as np
+
+from app.embedding_store import EmbeddingStore
+
+
+def make_chunk(chunk_id, embedding):
+    return {"text": f"chunk {chunk_id}",
+            "page_number": [chunk_id],
+            "chunk_id": chunk_id,
+            "file_key": "test/test.pdf",
+            "file_name": "test.pdf",
+            "embedding": embedding}
+
+
+def test_build_append_and_search(tmp_path):
+    store = EmbeddingStore(root_dir=str(tmp_path), dim=3)
+    chat_store = store.build("test_chat", [make_chunk(0, [1.0, 0.0, 0.0]),
+                                           make_chunk(1, [0.0, 1.0, 0.0])], chat_version=4)
+    assert chat_store.search([0.0, 1.0, 0.0], limit=1)[0]["chunk_id"] == 1
+
+    assert store.append("test_chat", [make_chunk(2, [0.0, 0.0, 1.0])], 4, 6)
+    results = store.open("test_chat").search([0.1, 0.2, 0.9], limit=3)
+    assert store.open("test_chat").chat_version == 6
+
+    assert [item["chunk_id"] for item in results] == [2, 1, 0]
+    assert results[0] == {"text": "chunk 2", "page_number": [2],
+                          "chunk_id": 2, "score": results[0]["score"]}
+
+
+def test_store_survives_reopen_and_drop(tmp_path):
+    EmbeddingStore(root_dir=str(tmp_path), dim=3).build(
+        "test_chat", [make_chunk(0, [1.0, 0.0, 0.0])])
+
+    reopened = EmbeddingStore(root_dir=str(tmp_path), dim=3)
+    assert reopened.open("test_chat").count == 1
+
+    reopened.drop("test_chat")
+    assert reopened.open("test_chat") is None
+
+
+def test_rank_files_and_filtered_search(tmp_path):
+    chunks = [make_chunk(0, [1.0, 0.0, 0.0]), make_chunk(1, [0.9, 0.1, 0.0]),
+              make_chunk(2, [0.0, 1.0, 0.0]), make_chunk(3, [0.0, 0.8, 0.2])]
+    for chunk in chunks[2:]:
+        chunk["file_key"] = "test/other.pdf"
+    chat_store = EmbeddingStore(root_dir=str(tmp_path), dim=3).build("test_chat", chunks)
+
+    assert chat_store.rank_files([0.0, 1.0, 0.0], limit=1) == ["test/other.pdf"]
+
+    results = chat_store.search([1.0, 0.0, 0.0], limit=4, file_keys=["test/other.pdf"])
+    assert sorted(item["chunk_id"] for item in results) == [2, 3]
+    assert chat_store.search([1.0, 0.0, 0.0], file_keys=["missing.pdf"]) == []
+
+
+def test_processes_share_the_store(tmp_path):
+    # two EmbeddingStore instances stand for two workers of the host
+    worker_1 = EmbeddingStore(root_dir=str(tmp_path), dim=3)
+    worker_2 = EmbeddingStore(root_dir=str(tmp_path), dim=3)
+    worker_1.build("test_chat", [make_chunk(0, [1.0, 0.0, 0.0])], chat_version=1)
+    assert len(worker_2.open("test_chat").search([1.0, 0.0, 0.0])) == 1
+
+    assert worker_2.append("test_chat", [make_chunk(1, [0.0, 1.0, 0.0])], 1, 3)
+    # an append from an older version would duplicate or lose rows: refused
+    assert not worker_1.append("test_chat", [make_chunk(2, [0.0, 0.0, 1.0])], 1, 3)
+    results = worker_1.open("test_chat").search([0.0, 1.0, 0.0], limit=5)
+    assert [item["chunk_id"] for item in results] == [1, 0]
+
+    worker_2.build("test_chat", [make_chunk(5, [0.0, 0.0, 1.0])], chat_version=7)
+    chat_store = worker_1.open("test_chat")
+    assert chat_store.chat_version == 7
+    assert [item["chunk_id"] for item in chat_store.search([0.0, 0.0, 1.0])] == [5]
+
+    worker_2.drop("test_chat")
+    assert worker_1.open("test_chat") is None
+
+
+def test_large_stores_search_through_the_ann_index(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((1200, 32)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    chunks = [make_chunk(i, vector.tolist()) for i, vector in enumerate(vectors)]
+
+    store = EmbeddingStore(root_dir=str(tmp_path), dim=32, ann_min_rows=1000,
+                           nprobe=4, rerank_size=1200)
+    chat_store = store.build("test_chat", chunks[:1000], chat_version=1)
+    results = chat_store.search(vectors[17], limit=5)
+    expected = np.argsort(-(vectors[:1000] @ vectors[17]))[:5].tolist()
+    assert [item["chunk_id"] for item in results] == expected
+    assert os.path.exists(os.path.join(
+        store.chat_dir("test_chat"), f"ann-{chat_store.manifest['build_id']}.npz"))
+
+    # appended rows are added to the index, another process loads the saved one
+    assert store.append("test_chat", chunks[1000:], 1, 3)
+    other = EmbeddingStore(root_dir=str(tmp_path), dim=32, ann_min_rows=1000,
+                           nprobe=4, rerank_size=1200).open("test_chat")
+    assert other.search(vectors[1100], limit=1)[0]["chunk_id"] == 1100
+    assert len(other._ann) == 1200
+
+
+def test_chat_ids_cannot_name_paths_outside_the_store(tmp_path):
+    root_dir = tmp_path / "store"
+    (tmp_path / "uploads").mkdir()
+    (tmp_path / "uploads" / "keep.pdf").write_bytes(b"pdf")
+    store = EmbeddingStore(root_dir=str(root_dir), dim=3)
+
+    for chat_id in ("..", ".", "a/b", "c/b"):
+        store.build(chat_id, [make_chunk(0, [1.0, 0.0, 0.0])])
+        assert os.path.dirname(store.chat_dir(chat_id)) == str(root_dir)
+    assert store.chat_dir("a/b") != store.chat_dir("c/b")
+
+    store.drop("..")
+    store.drop(".")
+    assert (tmp_path / "uploads" / "keep.pdf").exists()
+    assert store.open("a/b").count == 1
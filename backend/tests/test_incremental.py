@@ -0,0 +1,50 @@
+from app import incremental
+from app.pdf_utils import content_hash
+
+
+def make_chunk(text, chunk_id, page_number=None):
+    return {"text": text,
+            "chunk_id": chunk_id,
+            "page_number": page_number or [0],
+            "word_size": len(text.split()),
+            "file_name": "test.pdf",
+            "content_hash": content_hash(text)}
+
+
+def test_unchanged_document_needs_no_writes():
+    chunks = [make_chunk("first chunk", 0), make_chunk("second chunk", 1)]
+    stored = [dict(chunk, _id=i) for i, chunk in enumerate(chunks)]
+
+    new_chunks, moved, removed_ids = incremental.diff_chunks(chunks, stored)
+
+    assert new_chunks == []
+    assert moved == []
+    assert removed_ids == []
+
+
+def test_only_changed_chunks_are_embedded():
+    stored = [dict(make_chunk("first chunk", 0), _id="a"),
+              dict(make_chunk("old second chunk", 1), _id="b"),
+              dict(make_chunk("third chunk", 2), _id="c")]
+    chunks = [make_chunk("first chunk", 0),
+              make_chunk("new second chunk", 1),
+              make_chunk("extra chunk", 2),
+              make_chunk("third chunk", 3)]
+
+    new_chunks, moved, removed_ids = incremental.diff_chunks(chunks, stored)
+
+    assert [chunk["text"] for chunk in new_chunks] == ["new second chunk", "extra chunk"]
+    assert moved == [("c", {"chunk_id": 3})]
+    assert removed_ids == ["b"]
+
+
+def test_legacy_chunks_without_hash_are_matched_by_text():
+    stored = [{"_id": "a", "text": "first chunk", "chunk_id": 0,
+               "page_number": [0], "word_size": 2, "file_name": "test.pdf"}]
+    chunks = [make_chunk("first chunk", 0)]
+
+    new_chunks, moved, removed_ids = incremental.diff_chunks(chunks, stored)
+
+    assert new_chunks == []
+    assert moved == [("a", {"content_hash": content_hash("first chunk")})]
+    assert removed_ids == []
@@ -0,0 +1,331 @@
+import asyncio
+import copy
+import io
+import zipfile
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.embedding_store import EmbeddingStore
+from app.pdf_parser import PDFParser
+from app.routers.v1 import endpoints
+from app.uploads import upload_keys
+
+
+class FakeS3():
+    def __init__(self):
+        self.objects = {}
+
+    def upload_file(self, path, bucket, key):
+        with open(path, "rb") as f:
+            self.objects[key] = f.read()
+
+    def upload_fileobj(self, f, bucket, key):
+        self.objects[key] = f.read()
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete["Objects"]:
+            self.objects.pop(item["Key"], None)
+
+
+class FakeParser():
+    def parse_many(self, sources, max_workers=None, with_stats=False):
+        results = []
+        for source in sources:
+            text = source.decode() if isinstance(source, bytes) else open(source).read()
+            chunks = PDFParser.annotate(
+                [{"text": text, "page_number": [0], "word_size": 1, "chunk_id": 0}], None)
+            results.append((text, chunks, None))
+        return results
+
+
+class FakeJina():
+    async def get_embeddings_in_batches(self, texts):
+        if any("unembeddable" in text for text in texts):
+            raise RuntimeError("embedding failed")
+        return [[1.0, 0.0] for _ in texts]
+
+
+class FakeMongo():
+    def __init__(self):
+        self.files = []
+        self.chunks = []
+        self.version = 0
+        self.writes = 0
+
+    async def find_chunks(self, chat_id, fields, file_key=None, unclaimed_by=None,
+                          claimed_from=None):
+        return [dict(chunk) for chunk in self.chunks
+                if file_key is None or chunk["file_key"] == file_key
+                if unclaimed_by is None or chunk["ingest_id"] != unclaimed_by
+                or (claimed_from is not None and chunk["chunk_id"] >= claimed_from)]
+
+    async def upsert_file_records(self, records):
+        keys = {(record["chat_id"], record["file_key"]) for record in records}
+        self.files = [record for record in self.files
+                      if (record["chat_id"], record["file_key"]) not in keys] + records
+
+    async def write_chunk_changes(self, new_chunks, moved, removed_ids, chat_id):
+        self.writes += 1
+        changes = dict(moved)
+        self.chunks = [{**chunk, **changes.get(chunk["_id"], {})} for chunk in self.chunks
+                       if chunk["_id"] not in removed_ids]
+        self.chunks += [{**chunk, "_id": f"{self.writes}-{index}"}
+                        for index, chunk in enumerate(new_chunks)]
+
+    async def bump_chat_version(self, chat_id):
+        self.version += 1
+        return self.version
+
+
+def zip_of(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def client_with_fakes(tmp_path, monkeypatch):
+    s3, mongo = FakeS3(), FakeMongo()
+    monkeypatch.setattr(endpoints, "s3", s3)
+    monkeypatch.setattr(endpoints, "mongo_db_engine", mongo)
+    monkeypatch.setattr(endpoints, "jina_ai", FakeJina())
+    monkeypatch.setattr(endpoints, "pdf_parser", FakeParser())
+    monkeypatch.setattr(endpoints, "chat_tiering", None)
+    monkeypatch.setattr(endpoints, "embedding_store",
+                        EmbeddingStore(root_dir=str(tmp_path / "store"), dim=2))
+    monkeypatch.setattr(endpoints.config, "upload_spool_threshold", 8)
+
+    app = FastAPI()
+    app.include_router(endpoints.router)
+    return TestClient(app), s3, mongo
+
+
+def test_same_file_name_in_two_zip_folders_gets_two_keys(tmp_path, monkeypatch):
+    client, s3, mongo = client_with_fakes(tmp_path, monkeypatch)
+    archive = zip_of({"2023/report.pdf": "old report", "2024/report.pdf": "new report",
+                      "__MACOSX/2024/._report.pdf": "fork", "notes.txt": "skip"})
+
+    response = client.post(
+        f"/{endpoints.ROUTE_NAME}/ingest_files",
+        data={"key_prefix": "docs/", "chat_id": "chat"},
+        files=[("files", ("reports.zip", archive, "application/zip")),
+               ("files", ("report.pdf", b"loose report", "application/pdf"))])
+
+    assert response.status_code == 200
+    statuses = response.json()["files"]
+    assert [status["file_key"] for status in statuses] == [
+        "docs/2023/report.pdf", "docs/2024/report.pdf", "docs/report.pdf"]
+    assert all(status["status"] == "ingested" for status in statuses)
+
+    assert s3.objects == {"docs/2023/report.pdf": b"old report",
+                          "docs/2024/report.pdf": b"new report",
+                          "docs/report.pdf": b"loose report"}
+    assert {chunk["file_key"]: chunk["text"] for chunk in mongo.chunks} == {
+        "docs/2023/report.pdf": "old report", "docs/2024/report.pdf": "new report",
+        "docs/report.pdf": "loose report"}
+    assert [record["file_name"] for record in mongo.files] == ["report.pdf"] * 3
+    assert mongo.version == 2
+
+
+def test_reuploaded_files_replace_their_records_and_keep_unchanged_chunks(tmp_path,
+                                                                            monkeypatch):
+    client, s3, mongo = client_with_fakes(tmp_path, monkeypatch)
+
+    def upload(files):
+        response = client.post(f"/{endpoints.ROUTE_NAME}/ingest_files",
+                               data={"key_prefix": "docs", "chat_id": "chat"},
+                               files=[("files", (name, data, "application/pdf"))
+                                      for name, data in files.items()])
+        assert response.status_code == 200
+
+    upload({"a.pdf": b"first", "b.pdf": b"second"})
+    first_ids = {chunk["file_key"]: chunk["_id"] for chunk in mongo.chunks}
+    upload({"a.pdf": b"first", "b.pdf": b"second, revised"})
+
+    assert sorted(record["file_key"] for record in mongo.files) == ["docs/a.pdf", "docs/b.pdf"]
+    assert {chunk["file_key"]: chunk["text"] for chunk in mongo.chunks} == {
+        "docs/a.pdf": "first", "docs/b.pdf": "second, revised"}
+    assert len(mongo.chunks) == 2
+    ids = {chunk["file_key"]: chunk["_id"] for chunk in mongo.chunks}
+    assert ids["docs/a.pdf"] == first_ids["docs/a.pdf"]
+    assert ids["docs/b.pdf"] != first_ids["docs/b.pdf"]
+
+
+def test_a_file_failing_to_embed_fails_alone(tmp_path, monkeypatch):
+    client, s3, mongo = client_with_fakes(tmp_path, monkeypatch)
+
+    response = client.post(f"/{endpoints.ROUTE_NAME}/ingest_files",
+                           data={"key_prefix": "docs", "chat_id": "chat"},
+                           files=[("files", ("a.pdf", b"first", "application/pdf")),
+                                  ("files", ("b.pdf", b"unembeddable", "application/pdf"))])
+
+    assert response.status_code == 200
+    assert response.json()["messages"] == "Ingested 1 of 2 files"
+    assert [status["status"] for status in response.json()["files"]] == ["ingested", "failed"]
+    assert list(s3.objects) == ["docs/a.pdf"]
+    assert [chunk["file_key"] for chunk in mongo.chunks] == ["docs/a.pdf"]
+    assert [record["file_key"] for record in mongo.files] == ["docs/a.pdf"]
+
+
+def test_repeated_names_are_suffixed():
+    assert upload_keys("docs", ["a.pdf", "dir/a.pdf", "a.pdf", "/../a.pdf", "dir\\a.pdf"]) == [
+        "docs/a.pdf", "docs/dir/a.pdf", "docs/a-2.pdf", "docs/a-3.pdf", "docs/dir/a-2.pdf"]
+
+
+class EchoParser(PDFParser):
+    def parse(self, file_path, with_stats=False):
+        return file_path
+
+
+def test_parse_many_reuses_its_pool():
+    parser = EchoParser()
+    try:
+        assert parser.parse_many(["a", "b"], max_workers=2) == ["a", "b"]
+        executor = parser._executor
+        assert parser.parse_many(["c"]) == ["c"]
+        assert parser._executor is executor
+    finally:
+        parser.close()
+    assert parser._executor is None
+
+
+class SegmentParser():
+    """Pages "page N", one chunk per page"""
+
+    def __init__(self):
+        self.probes = 0
+        self.extractors = []
+
+    def probe(self, source):
+        self.probes += 1
+        return "pdfium"
+
+    def parse_pages(self, source, page_numbers, known_boilerplate=(), extractor=None):
+        self.extractors.append(extractor)
+        return "".join(f"\npage {page}" for page in page_numbers), page_numbers
+
+    def boilerplate_savings(self, pages):
+        return None
+
+    def chunker(self, state=None):
+        return PageChunker(state)
+
+    annotate = staticmethod(PDFParser.annotate)
+
+
+class PageChunker():
+    def __init__(self, state):
+        self.chunk_id = (state or {}).get("chunk_id", 0)
+
+    def add(self, pages):
+        chunks = []
+        for page in pages:
+            chunks.append({"text": f"page {page}", "page_number": [page], "word_size": 2,
+                           "chunk_id": self.chunk_id})
+            self.chunk_id += 1
+        return chunks
+
+    def finish(self):
+        return []
+
+    def state(self):
+        return {"chunk_id": self.chunk_id}
+
+
+class SegmentMongo(FakeMongo):
+    def __init__(self, failing_write=None, failing_save=None):
+        super().__init__()
+        self.record = None
+        self.checkpoint = None
+        self.saves = 0
+        self.failing_write = failing_write
+        self.failing_save = failing_save
+
+    async def append_file_text(self, file_name, file_key, text, reset=False, chat_id=None,
+                               neighbour_map=None, text_offset=None, map_offset=None):
+        if reset:
+            self.record = {"full_text": text, "neighbour_map": neighbour_map}
+            return
+        self.record["full_text"] = self.record["full_text"][:text_offset] + text
+        self.record["neighbour_map"] = {
+            column: self.record["neighbour_map"][column][:map_offset] + values
+            for column, values in neighbour_map.items()}
+
+    async def write_chunk_changes(self, new_chunks, moved, removed_ids, chat_id):
+        if self.writes + 1 == self.failing_write:
+            self.writes += 1
+            raise RuntimeError("write failed")
+        await super().write_chunk_changes(new_chunks, moved, removed_ids, chat_id)
+
+    async def set_file_summary(self, file_key, summary, chat_id=None):
+        pass
+
+    async def save_checkpoint(self, checkpoint):
+        self.saves += 1
+        if self.saves == self.failing_save:
+            raise RuntimeError("save failed")
+        self.checkpoint = copy.deepcopy(checkpoint)
+
+
+def segment_fakes(tmp_path, monkeypatch, mongo):
+    monkeypatch.setattr(endpoints, "mongo_db_engine", mongo)
+    monkeypatch.setattr(endpoints, "jina_ai", FakeJina())
+    monkeypatch.setattr(endpoints, "pdf_parser", SegmentParser())
+    monkeypatch.setattr(endpoints, "embedding_store",
+                        EmbeddingStore(root_dir=str(tmp_path / "store"), dim=2))
+    monkeypatch.setattr(endpoints.config, "ingest_segment_pages", 2)
+    return {"extractor": None, "chat_id": "chat", "file_key": "docs/a.pdf", "ingest_id": "ingest",
+            "page_count": 5, "next_page": 0, "chunker": None,
+            "boilerplate_lines": [], "text_length": 0, "status": "running"}
+
+
+def ingest(checkpoint):
+    return asyncio.run(endpoints.ingest_segments(b"pdf", checkpoint, float("inf")))
+
+
+def test_segment_retried_after_a_failed_write_is_not_appended_twice(tmp_path, monkeypatch):
+    mongo = SegmentMongo(failing_write=2)
+    checkpoint = segment_fakes(tmp_path, monkeypatch, mongo)
+
+    # the second segment's text is appended, then its chunk write fails
+    with pytest.raises(RuntimeError):
+        ingest(checkpoint)
+    assert mongo.checkpoint["next_page"] == 2
+    assert mongo.record["full_text"] == "\npage 0\npage 1\npage 2\npage 3"
+
+    ingest(copy.deepcopy(mongo.checkpoint))
+    assert mongo.checkpoint["status"] == "complete"
+    assert mongo.record["full_text"] == "".join(f"\npage {page}" for page in range(5))
+    assert mongo.record["neighbour_map"]["first_page"] == [0, 1, 2, 3, 4]
+    assert [chunk["chunk_id"] for chunk in mongo.chunks] == [0, 1, 2, 3, 4]
+
+
+def test_segment_retried_after_a_failed_checkpoint_reuses_its_chunks(tmp_path, monkeypatch):
+    mongo = SegmentMongo(failing_save=2)
+    checkpoint = segment_fakes(tmp_path, monkeypatch, mongo)
+
+    # the second segment's chunks are written, then saving the checkpoint fails
+    with pytest.raises(RuntimeError):
+        ingest(checkpoint)
+    assert mongo.checkpoint["next_page"] == 2
+    assert len(mongo.chunks) == 4
+
+    ingest(copy.deepcopy(mongo.checkpoint))
+    assert mongo.checkpoint["status"] == "complete"
+    pairs = [(chunk["file_key"], chunk["chunk_id"]) for chunk in mongo.chunks]
+    assert sorted(pairs) == [("docs/a.pdf", chunk_id) for chunk_id in range(5)]
+
+
+def test_the_extractor_is_probed_once_per_document(tmp_path, monkeypatch):
+    mongo = SegmentMongo(failing_write=2)
+    checkpoint = segment_fakes(tmp_path, monkeypatch, mongo)
+
+    with pytest.raises(RuntimeError):
+        ingest(checkpoint)
+    ingest(copy.deepcopy(mongo.checkpoint))
+
+    assert endpoints.pdf_parser.probes == 1
+    assert endpoints.pdf_parser.extractors == ["pdfium"] * 4
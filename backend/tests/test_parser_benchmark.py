@@ -0,0 +1,49 @@
+import json
+import os
+import sys
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             "benchmarks")
+sys.path.insert(0, BENCHMARK_DIR)
+
+import parser_benchmark  # noqa: E402
+from synthetic_pdf import cached_pdf  # noqa: E402
+
+
+def test_regressions_flag_slower_stages_and_memory_growth():
+    baseline = {"doc": {"parse": {"pages/s": 100.0, "peak_mb": 10.0}}}
+
+    assert parser_benchmark.regressions(
+        {"doc": {"parse": {"pages/s": 85.0, "peak_mb": 11.0}}}, baseline, 0.2) == []
+    assert len(parser_benchmark.regressions(
+        {"doc": {"parse": {"pages/s": 70.0, "peak_mb": 13.0}}}, baseline, 0.2)) == 2
+    assert parser_benchmark.regressions(
+        {"doc": {"parse": {"pages/s": 70.0, "peak_mb": 11.0}}}, baseline, 0.2,
+        metrics=["peak_mb"]) == []
+    # stages and documents missing from the baseline are not compared
+    assert parser_benchmark.regressions({"other": {"parse": {"pages/s": 1.0}}}, baseline, 0.2) == []
+
+
+def test_quick_document_stays_within_the_baseline(tmp_path, monkeypatch, pytestconfig):
+    """
+    Peak memory is checked on every run. Throughput depends on the machine,
+    it is checked with --benchmark on the one that recorded the baseline.
+    """
+    with open(os.path.join(BENCHMARK_DIR, "parser_baseline.json")) as f:
+        baseline = json.load(f)
+
+    check_throughput = pytestconfig.getoption("benchmark")
+    if not check_throughput:
+        monkeypatch.setattr(parser_benchmark, "REPEAT_SECONDS", 0)
+
+    num_pages, words_per_sentence, lines_per_page = parser_benchmark.DOCUMENTS[0]
+    document = f"pages={num_pages},words={words_per_sentence},lines={lines_per_page}"
+    file_path = cached_pdf(str(tmp_path), num_pages=num_pages,
+                           words_per_sentence=words_per_sentence,
+                           lines_per_page=lines_per_page)
+    results = {document: parser_benchmark.bench_document(file_path)}
+
+    assert document in baseline
+    assert parser_benchmark.regressions(
+        results, baseline, tolerance=0.2,
+        metrics=None if check_throughput else ["peak_mb"]) == []
@@ -0,0 +1,89 @@
+import io
+
+from pypdf import PdfWriter
+
+from app import pdf_extractors, pdf_utils
+
+
+class FakeSentence(str):
+    @property
+    def words(self):
+        return self.split()
+
+
+def make_sentences(num_sentences, sentences_per_page=4):
+    return [{"page_number": i // sentences_per_page,
+             "sentence": FakeSentence(" ".join(["word"] * (3 + i % 7)) + f" s{i}.")}
+            for i in range(num_sentences)]
+
+
+def test_chunks_respect_size_and_overlap():
+    chunks = pdf_utils.merge_sentences_to_chunks(
+        make_sentences(40), sentence_size=30, overlapping_num=2)
+
+    assert [chunk["chunk_id"] for chunk in chunks] == list(range(len(chunks)))
+    for previous, chunk in zip(chunks, chunks[1:]):
+        # the last two sentences of a chunk open the next one
+        assert previous["text"].split("\n")[-2:] == chunk["text"].split("\n")[:2]
+
+
+def test_segmented_chunking_matches_single_pass():
+    sentences = make_sentences(100)
+    expected = pdf_utils.merge_sentences_to_chunks(
+        sentences, sentence_size=40, overlapping_num=3)
+
+    chunks = []
+    state = None
+    for start in range(0, len(sentences), 13):
+        builder = pdf_utils.ChunkBuilder(sentence_size=40, overlapping_num=3, state=state)
+        chunks += builder.add(sentences[start:start+13])
+        state = builder.state()
+    chunks += pdf_utils.ChunkBuilder(sentence_size=40, overlapping_num=3, state=state).finish()
+
+    assert chunks == expected
+
+
+def test_sentence_table_slices_page_buffers():
+    texts = ["First sentence here. Second one follows.", "Page two has one sentence."]
+    full_text, sentence_table = pdf_utils.split_sentences(texts, [0, 1])
+
+    assert full_text == "\n" + "\n".join(texts)
+    assert len(sentence_table) == 3
+    assert sentence_table.sentence(1) == "Second one follows."
+    assert list(sentence_table)[2] == (1, "Page two has one sentence.", 5)
+
+
+def test_sentence_table_chunks_match_sentence_objects():
+    from textblob import TextBlob
+
+    texts = [" ".join(f"Sentence number {i} on page {page}." for i in range(30))
+             for page in range(5)]
+    _, sentence_table = pdf_utils.split_sentences(texts, range(len(texts)))
+    sentence_objects = [{"page_number": page, "sentence": sentence}
+                        for page, text in enumerate(texts)
+                        for sentence in TextBlob(text).sentences]
+
+    assert pdf_utils.merge_sentences_to_chunks(sentence_table, 40, 3) == \
+        pdf_utils.merge_sentences_to_chunks(sentence_objects, 40, 3)
+
+
+def test_chunks_without_overlap_do_not_repeat_sentences():
+    chunks = pdf_utils.merge_sentences_to_chunks(
+        make_sentences(40), sentence_size=30, overlapping_num=0)
+
+    sentences = [line for chunk in chunks for line in chunk["text"].split("\n")]
+    assert sentences == [item["sentence"] for item in make_sentences(40)]
+    assert all(chunk["overlap"] == 0 and chunk["word_size"] <= 30 for chunk in chunks)
+
+
+def test_a_scanned_pdf_is_probed_as_having_no_text_layer():
+    writer = PdfWriter()
+    for _ in range(3):
+        writer.add_blank_page(width=200, height=200)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    source = buffer.getvalue()
+
+    backend = pdf_extractors.probe_extractor(source)
+    assert backend == pdf_extractors.NO_TEXT_LAYER
+    assert pdf_extractors.extract_pages(source, backend, page_numbers=[1, 2]) == ["", ""]
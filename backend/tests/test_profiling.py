@@ -0,0 +1,87 @@
+import asyncio
+import os
+import time
+
+from app import profiling
+from app.config import config
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def profiled_work():
+    busy(0.2)
+
+
+def other_work():
+    busy(0.3)
+
+
+async def loop_work():
+    busy(0.1)
+
+
+async def app(scope, receive, send):
+    if scope["path"] == "/profiled":
+        await asyncio.gather(profiling.run_in_threadpool(profiled_work), loop_work())
+    else:
+        await profiling.to_thread(other_work)
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"{}"})
+
+
+def request(path, token):
+    return {"type": "http", "path": path, "query_string": b"",
+            "headers": [(b"x-profile-token", token.encode())] if token else []}
+
+
+async def call(middleware, scope):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    await middleware(scope, None, send)
+    return dict(messages[0]["headers"])
+
+
+def test_profile_only_samples_its_own_request(tmp_path, monkeypatch):
+    monkeypatch.setenv("PROFILE_TOKEN", "secret")
+    monkeypatch.setattr(config, "profile_dir", str(tmp_path))
+    monkeypatch.setattr(config, "profile_interval", 0.001)
+    middleware = profiling.ProfilingMiddleware(app)
+
+    async def scenario():
+        results = await asyncio.gather(call(middleware, request("/profiled", "secret")),
+                                       call(middleware, request("/other", None)),
+                                       call(middleware, request("/other", "wrong")))
+        # the task factory is only installed while a request is profiled
+        assert asyncio.get_running_loop().get_task_factory() is None
+        return results
+
+    profiled, other, rejected = asyncio.run(scenario())
+    assert b"x-profile-id" not in other and b"x-profile-id" not in rejected
+
+    profile_id = profiled[b"x-profile-id"].decode()
+    assert [item["profile_id"] for item in profiling.list_profiles()] == [profile_id]
+    with open(profiling.profile_path(profile_id)) as f:
+        stacks = f.read()
+
+    assert "profiled_work" in stacks
+    assert "loop_work" in stacks
+    assert "other_work" not in stacks
+    assert "selectors.py" not in stacks
+    assert os.path.basename(profiling.profile_path(profile_id)) == profile_id + ".folded"
+
+
+def test_token_check(monkeypatch):
+    monkeypatch.delenv("PROFILE_TOKEN", raising=False)
+    assert not profiling.is_authorized("secret")
+
+    monkeypatch.setenv("PROFILE_TOKEN", "secret")
+    assert profiling.is_authorized("secret")
+    assert not profiling.is_authorized("secreT")
+    assert not profiling.is_authorized(None)
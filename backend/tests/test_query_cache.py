@@ -0,0 +1,41 @@
+from app.query_cache import SemanticQueryCache
+
+
+def test_near_duplicate_queries_hit_the_cache():
+    cache = SemanticQueryCache(threshold=0.9, max_entries=2)
+    results = [{"text": "inflation range", "chunk_id": 3, "score": 0.8}]
+    cache.put("test_chat", [1.0, 0.0, 0.0], results, params=(5, 0))
+
+    assert cache.get("test_chat", [0.95, 0.1, 0.0], params=(5, 0)) == results
+    assert cache.get("test_chat", [0.0, 1.0, 0.0], params=(5, 0)) is None
+    assert cache.get("test_chat", [1.0, 0.0, 0.0], params=(10, 0)) is None
+    assert cache.get("other_chat", [1.0, 0.0, 0.0], params=(5, 0)) is None
+
+    cache.invalidate("test_chat")
+    assert cache.get("test_chat", [1.0, 0.0, 0.0], params=(5, 0)) is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SemanticQueryCache(threshold=0.9, max_entries=2)
+    cache.put("test_chat", [1.0, 0.0, 0.0], [{"chunk_id": 0}])
+    cache.put("test_chat", [0.0, 1.0, 0.0], [{"chunk_id": 1}])
+    cache.get("test_chat", [1.0, 0.0, 0.0])
+    cache.put("test_chat", [0.0, 0.0, 1.0], [{"chunk_id": 2}])
+
+    assert cache.get("test_chat", [1.0, 0.0, 0.0]) == [{"chunk_id": 0}]
+    assert cache.get("test_chat", [0.0, 1.0, 0.0]) is None
+
+
+def test_results_of_another_chat_version_are_not_returned():
+    cache = SemanticQueryCache(threshold=0.9)
+    cache.put("test_chat", [1.0, 0.0, 0.0], [{"chunk_id": 0}], chat_version=2)
+    assert cache.get("test_chat", [1.0, 0.0, 0.0], chat_version=2) == [{"chunk_id": 0}]
+
+    # changed by another worker: a miss, without an invalidate in this process
+    assert cache.get("test_chat", [1.0, 0.0, 0.0], chat_version=4) is None
+
+    # results read before the change do not replace newer ones
+    cache.put("test_chat", [0.0, 1.0, 0.0], [{"chunk_id": 1}], chat_version=4)
+    cache.put("test_chat", [1.0, 0.0, 0.0], [{"chunk_id": 0}], chat_version=2)
+    assert cache.get("test_chat", [1.0, 0.0, 0.0], chat_version=4) is None
+    assert cache.get("test_chat", [0.0, 1.0, 0.0], chat_version=4) == [{"chunk_id": 1}]
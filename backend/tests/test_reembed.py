@@ -0,0 +1,76 @@
+import asyncio
+
+from app.reembed import ReembedJob
+
+
+class FakeMongo():
+
+    def __init__(self, texts):
+        self.chunks = [{"_id": i, "text": text, "file_key": "a.pdf"} for i, text in enumerate(texts)]
+        self.jobs = {}
+        self.summaries = {}
+        self.fail_after = None
+
+    async def count_chunks_missing(self, field, collection=None):
+        return sum(field not in chunk for chunk in self.chunks)
+
+    async def find_chunks_missing(self, field, after_id=None, limit=1000, collection=None):
+        return [{"_id": chunk["_id"], "text": chunk["text"]} for chunk in self.chunks
+                if field not in chunk and (after_id is None or chunk["_id"] > after_id)][:limit]
+
+    async def set_chunk_vectors(self, field, ids, vectors, collection=None):
+        if self.fail_after is not None and ids[0] >= self.fail_after:
+            raise ConnectionError("lost connection")
+        for _id, vector in zip(ids, vectors):
+            self.chunks[_id][field] = vector
+
+    async def find_file_keys(self, after_id=None, limit=100):
+        return [] if after_id is not None else [{"_id": 0, "file_key": "a.pdf"}]
+
+    async def find_file_vectors(self, file_key, field, chat_id=None):
+        return [chunk[field] for chunk in self.chunks if chunk.get(field)]
+
+    async def set_file_summary(self, file_key, summary, field=None, chat_id=None):
+        self.summaries[(file_key, field)] = summary
+
+    async def get_reembed_job(self, job_id):
+        job = self.jobs.get(job_id)
+        return dict(job) if job else None
+
+    async def save_reembed_job(self, job):
+        self.jobs[job["job_id"]] = dict(job)
+
+
+class FakeJina():
+    model = "new-model"
+
+    def __init__(self):
+        self.embedded = []
+
+    async def get_embeddings_in_batches(self, chunks):
+        self.embedded.extend(chunks)
+        return [[float(len(text)), 1.0] for text in chunks]
+
+
+def test_job_resumes_after_a_failure():
+    mongo = FakeMongo([f"chunk {i}" for i in range(10)] + [""])
+    jina = FakeJina()
+
+    mongo.fail_after = 6
+    job = ReembedJob(mongo, jina, "embedding_v3", read_batch=3)
+    try:
+        asyncio.run(job.run())
+    except ConnectionError:
+        pass
+    assert mongo.jobs["embedding_v3"]["processed"] == 6
+
+    mongo.fail_after = None
+    result = asyncio.run(ReembedJob(mongo, jina, "embedding_v3", read_batch=3).run())
+
+    assert result["status"] == "complete"
+    assert result["processed"] == result["total"] == 11
+    assert all("embedding_v3" in chunk for chunk in mongo.chunks)
+    assert mongo.chunks[-1]["embedding_v3"] is None
+    # chunks 0-5 were embedded once, 6-8 twice (the failed batch is redone)
+    assert len(jina.embedded) == 13
+    assert ("a.pdf", "summary_embedding_v3") in mongo.summaries
@@ -0,0 +1,22 @@
+import json
+
+import numpy as np
+
+from app.routers.v1 import responses
+from app.routers.v1.responses import FastJSONResponse, SearchResult
+
+
+def test_fast_response_matches_the_declared_model():
+    results = [{"text": "inflation range", "chunk_id": 3, "page_number": [1, 2],
+                "score": np.float32(0.5)}]
+
+    body = json.loads(FastJSONResponse(results).body)
+    assert body == [{"text": "inflation range", "chunk_id": 3, "page_number": [1, 2],
+                     "score": 0.5}]
+    assert SearchResult(**body[0]).chunk_id == 3
+
+
+def test_json_fallback_without_orjson(monkeypatch):
+    monkeypatch.setattr(responses, "orjson", None)
+    body = FastJSONResponse({"messages": "ok", "score": np.float64(0.25)}).body
+    assert json.loads(body) == {"messages": "ok", "score": 0.25}
@@ -0,0 +1,39 @@
+import asyncio
+
+import server
+from app.routers import v1
+
+
+def api_gateway_event(path):
+    return {"resource": "/{proxy+}", "path": path, "httpMethod": "GET",
+            "headers": {"host": "localhost"}, "multiValueHeaders": {},
+            "queryStringParameters": None, "multiValueQueryStringParameters": None,
+            "requestContext": {"resourcePath": "/{proxy+}", "httpMethod": "GET",
+                               "path": path, "stage": "test",
+                               "identity": {"sourceIp": "127.0.0.1"}},
+            "pathParameters": None, "stageVariables": None,
+            "body": None, "isBase64Encoded": False}
+
+
+def test_lambda_handler_keeps_the_clients_open_across_invocations(monkeypatch):
+    calls = []
+
+    async def record(name):
+        calls.append(name)
+
+    monkeypatch.setattr(v1.endpoints, "startup", lambda: record("startup"))
+    monkeypatch.setattr(v1.endpoints, "shutdown", lambda: record("shutdown"))
+
+    # Mangum runs on the thread's event loop, as on a Lambda container
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        for _ in range(2):
+            response = server.handler(api_gateway_event("/api/health_check"), None)
+            assert response["statusCode"] == 200
+            assert "The server is up since" in response["body"]
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    assert calls == []
@@ -0,0 +1,26 @@
+import multiprocessing
+
+from app.serving import worker_count
+from app.shared_cache import SharedEmbeddingCache
+
+
+def put_in_child(cache):
+    cache.put("model", "what is the inflation range", [0.5, 0.25, 0.125])
+
+
+def test_entries_written_by_a_forked_worker_are_shared():
+    cache = SharedEmbeddingCache(dim=3, slots=64)
+    assert cache.get("model", "what is the inflation range") is None
+
+    child = multiprocessing.get_context("fork").Process(target=put_in_child, args=(cache,))
+    child.start()
+    child.join()
+
+    assert cache.get("model", "what is the inflation range") == [0.5, 0.25, 0.125]
+    assert cache.get("other-model", "what is the inflation range") is None
+    assert cache.stats()["hits"] == 1
+
+
+def test_worker_count_defaults_to_available_cores():
+    assert worker_count(3) == 3
+    assert worker_count(None) >= 1
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from app.single_flight import SingleFlight
+
+
+def test_identical_concurrent_calls_share_one_execution():
+
+    async def run():
+        flights = SingleFlight()
+        executions = []
+
+        async def search(query):
+            executions.append(query)
+            await asyncio.sleep(0.01)
+            return [query]
+
+        results = await asyncio.gather(*[flights.do(("q", "a"), search, "a") for _ in range(5)],
+                                       flights.do(("q", "b"), search, "b"))
+        assert results == [["a"]] * 5 + [["b"]]
+        assert sorted(executions) == ["a", "b"]
+        assert flights.stats()["coalesced"] == 4
+
+        # finished calls are not cached
+        await flights.do(("q", "a"), search, "a")
+        assert len(executions) == 3
+
+    asyncio.run(run())
+
+
+def test_followers_get_the_leader_error_and_survive_its_cancellation():
+
+    async def run():
+        flights = SingleFlight()
+
+        async def failing():
+            await asyncio.sleep(0.01)
+            raise ValueError("upstream failed")
+
+        calls = [asyncio.ensure_future(flights.do("key", failing)) for _ in range(3)]
+        for call in calls:
+            with pytest.raises(ValueError):
+                await call
+
+        async def slow():
+            await asyncio.sleep(0.01)
+            return "done"
+
+        leader = asyncio.ensure_future(flights.do("key", slow))
+        follower = asyncio.ensure_future(flights.do("key", slow))
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert await follower == "done"
+
+    asyncio.run(run())
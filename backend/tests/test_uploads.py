@@ -0,0 +1,83 @@
+import asyncio
+import io
+import os
+import tempfile
+
+from app.uploads import TempSpace, UploadScope
+
+
+class FakeUploadFile():
+    def __init__(self, filename, data, max_size=None):
+        self.filename = filename
+        if max_size is None:
+            self.file = io.BytesIO(data)
+        else:
+            # what Starlette hands over: spooled to a temporary file past max_size
+            self.file = tempfile.SpooledTemporaryFile(max_size=max_size)
+            self.file.write(data)
+            self.file.seek(0)
+
+    async def read(self):
+        return self.file.read()
+
+
+def test_small_uploads_stay_in_memory_and_large_ones_are_removed(tmp_path):
+    async def run():
+        temp_space = TempSpace(quota_bytes=1000)
+        async with UploadScope(temp_space, spool_threshold=10, tmp_dir=str(tmp_path)) as scope:
+            small = await scope.spool(FakeUploadFile("small.pdf", b"12345"))
+            large = await scope.spool(FakeUploadFile("large.pdf", b"x" * 100))
+            assert small.source == b"12345" and small.path is None
+            assert os.path.exists(large.path) and large.size == 100
+            assert temp_space.used_bytes == 100
+
+        assert not os.path.exists(large.path)
+        assert temp_space.used_bytes == 0
+
+    asyncio.run(run())
+
+
+def test_reservations_wait_for_quota(tmp_path):
+    async def run():
+        temp_space = TempSpace(quota_bytes=100)
+        first = UploadScope(temp_space, spool_threshold=0, tmp_dir=str(tmp_path))
+        await first.reserve_path("a.pdf", 80)
+
+        second = UploadScope(temp_space, spool_threshold=0, tmp_dir=str(tmp_path))
+        waiting = asyncio.ensure_future(second.reserve_path("b.pdf", 80))
+        await asyncio.sleep(0.01)
+        assert not waiting.done() and temp_space.waiting == 1
+
+        await first.cleanup()
+        await asyncio.wait_for(waiting, 1)
+        assert temp_space.used_bytes == 80
+        await second.cleanup()
+
+    asyncio.run(run())
+
+
+def test_starlette_spool_file_counts_toward_the_quota(tmp_path):
+    class RecordingTempSpace(TempSpace):
+        reservations = []
+
+        async def reserve(self, size):
+            self.reservations.append(size)
+            await super().reserve(size)
+
+    async def run():
+        temp_space = RecordingTempSpace(quota_bytes=1000)
+        async with UploadScope(temp_space, spool_threshold=50, tmp_dir=str(tmp_path)) as scope:
+            large = FakeUploadFile("large.pdf", b"x" * 100, max_size=10)
+            small = FakeUploadFile("small.pdf", b"y" * 20, max_size=10)
+            spooled = await scope.spool(large)
+            in_memory = await scope.spool(small)
+
+            # both copies were reserved together, Starlette's is gone once copied
+            assert temp_space.reservations == [200, 20]
+            assert large.file.closed and small.file.closed
+            assert spooled.size == 100 and in_memory.source == b"y" * 20
+            assert temp_space.used_bytes == 100
+
+        assert temp_space.used_bytes == 0
+
+    asyncio.run(run())